@@ -1,39 +1,132 @@
 # app.py - Main Flask application
-from flask import Flask, request, jsonify, redirect
+from flask import Flask, Response, g, request, jsonify, redirect, stream_with_context
 from flask_cors import CORS
+import atexit
 import logging
 import sys
+import time
 import datetime
 from typing import List
 
 # Import our modules
 from config import get_config
-from models import CosmosDBManager
-from services import AzureSearchService, OpenAIService, AuthService
-from utils import get_user_id_from_token, generate_chat_id, format_chat_response
+from models import CosmosDBManager, ChatConflictError, build_turn_messages, chat_etag, chat_list_etag, chat_to_api, begin_request_usage, current_request_usage
+from persistence import WriteBehindChatStore
+from cache import ChatListCache, SingleFlight
+from ingestion import IngestionService
+from embeddings import EmbeddingService
+from governor import OpenAIOverloadedError
+from health import HealthChecks
+from telemetry import CONTENT_TYPE as METRICS_CONTENT_TYPE, RequestIdFilter, begin_request, record_http, registry, stage
+import telemetry
+from serialization import Compressor, encoded_etag
+import serialization
+from services import AzureSearchService, OpenAIService, AuthService, AnswerCache, QueryPlanner, HistoryCompactor
+from utils import FastJSONProvider, require_auth, generate_chat_id, format_chat_response, format_sse_event, not_modified, with_etag
 
-# Configure logging
+# Configure logging; every line carries the request id of the request that logged it
+log_handler = logging.StreamHandler(sys.stdout)
+log_handler.addFilter(RequestIdFilter())
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s %(levelname)s %(name)s %(message)s',
-    handlers=[logging.StreamHandler(sys.stdout)]
+    format='%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s',
+    handlers=[log_handler]
 )
 logger = logging.getLogger(__name__)
 
+NO_SEARCH_RESPONSE = "I'm not sure how to answer your question without searching for more information."
+
 def create_app():
     """Application factory"""
     app = Flask(__name__)
     config = get_config()
     app.config.from_object(config)
+    app.config['MAX_CONTENT_LENGTH'] = config.INGEST_MAX_UPLOAD_MB * 1024 * 1024
+    
+    # jsonify and request.get_json through orjson when it is installed
+    serialization.configure(config.JSON_ENCODER)
+    app.json = FastJSONProvider(app)
+    compressor = Compressor(config.COMPRESSION_ENABLED, config.COMPRESSION_MIN_BYTES, config.COMPRESSION_LEVEL)
     
     # Initialize CORS
-    CORS(app, origins=config.CORS_ORIGINS, supports_credentials=True)
+    CORS(app, origins=config.CORS_ORIGINS, supports_credentials=True, expose_headers=['X-Continuation-Token', 'ETag'])
     
     # Initialize services
-    db_manager = CosmosDBManager(config)
-    search_service = AzureSearchService(config)
+    db_manager = CosmosDBManager(config, ChatListCache.from_config(config))
+    write_behind = WriteBehindChatStore.from_config(config, db_manager)
+    if write_behind:
+        atexit.register(write_behind.close)
+    chat_store = write_behind or db_manager
     openai_service = OpenAIService(config)
+    embedding_service = EmbeddingService.from_config(config, openai_service)
+    if config.RETRIEVAL_BACKEND == 'local':
+        from local_search import LocalSearchService
+        search_service = LocalSearchService(config)
+    else:
+        query_embeddings = embedding_service if config.SEARCH_QUERY_VECTORS == 'client' else None
+        search_service = AzureSearchService(config, query_embeddings)
     auth_service = AuthService(config)
+    answer_cache = AnswerCache.from_config(config, db_manager)
+    query_planner = QueryPlanner.from_config(config)
+    history_compactor = HistoryCompactor.from_config(config, openai_service)
+    ingestion_service = IngestionService.from_config(config, embedding_service, search_service)
+    single_flight = SingleFlight() if config.SINGLE_FLIGHT_ENABLED else None
+    
+    # Nothing above has touched the network; containers are created by provision.py unless asked here
+    if config.COSMOS_AUTO_PROVISION:
+        db_manager.provision(config.COSMOS_CACHE_CONTAINER_NAME if config.ANSWER_CACHE_BACKEND == 'cosmos' else None)
+    
+    # Dependency checks behind /health/ready; the first run connects the lazy clients
+    health_checks = HealthChecks(config.HEALTH_CHECK_TTL_SECONDS)
+    health_checks.add("cosmos", db_manager.ping)
+    health_checks.add("auth", auth_service.msal_app.get)
+    if config.RETRIEVAL_BACKEND != 'local':
+        health_checks.add("search", search_service.client.get_document_count)
+    if config.WARMUP_ON_START:
+        health_checks.warm_up()
+    
+    # Metrics and tracing
+    telemetry.configure(config.METRICS_ENABLED, config.OTEL_ENABLED)
+    if openai_service.governor:
+        registry.gauge("azdocs_openai_queue_depth", "OpenAI calls waiting for capacity",
+                       lambda: openai_service.governor.stats()["queueDepth"])
+        registry.gauge("azdocs_openai_active_calls", "OpenAI calls in progress",
+                       lambda: openai_service.governor.stats()["active"])
+    if single_flight:
+        registry.gauge("azdocs_single_flight_in_flight", "Chat stages currently running on behalf of waiting requests",
+                       lambda: single_flight.stats()["inFlight"])
+    
+    # Per-request id, latency and Cosmos DB request charge
+    @app.before_request
+    def start_cosmos_usage():
+        g.request_id = begin_request(request.headers.get('X-Request-ID'))
+        g.request_started = time.perf_counter()
+        begin_request_usage()
+    
+    @app.after_request
+    def log_cosmos_usage(response):
+        usage = current_request_usage()
+        if usage and usage.calls and not response.is_streamed:
+            logger.info(f"{request.method} {request.path}: {usage}")
+        response.headers['X-Request-ID'] = g.request_id
+        record_http(request.method, request.url_rule.rule if request.url_rule else "unmatched",
+                    response.status_code, time.perf_counter() - g.request_started)
+        return response
+    
+    # Registered after log_cosmos_usage so it runs before it and the recorded latency includes it
+    @app.after_request
+    def compress_response(response):
+        if response.direct_passthrough or response.is_streamed:
+            return response
+        encoding = compressor.choose(request.headers.get('Accept-Encoding'), response.content_type,
+                                     response.content_length or 0, response.headers.get('Content-Encoding'))
+        if encoding:
+            response.set_data(compressor.compress(response.get_data(), encoding))
+            response.headers['Content-Encoding'] = encoding
+            response.vary.add('Accept-Encoding')
+            if 'ETag' in response.headers:
+                response.headers['ETag'] = encoded_etag(response.headers['ETag'], encoding)
+        return response
     
     # Error handlers
     @app.errorhandler(400)
@@ -92,42 +185,79 @@ def create_app():
     
     # Chat API routes
     @app.route('/api/chats', methods=['GET'])
+    @require_auth(auth_service)
     def get_chats():
-        user_id = get_user_id_from_token(auth_service)
-        if not user_id:
-            return jsonify({"error": "Unauthorized"}), 401
+        user_id = g.user_id
         
         try:
-            chats = db_manager.get_user_chats(user_id)
-            formatted_chats = [format_chat_response(chat) for chat in chats]
-            return jsonify(formatted_chats)
+            # ?full=true keeps the old behaviour of returning every chat with its messages
+            if request.args.get('full', '').lower() == 'true':
+                chats = db_manager.get_user_chats(user_id)
+                formatted_chats = [format_chat_response(chat) for chat in chats]
+                return jsonify(formatted_chats)
+            
+            limit = request.args.get('limit', type=int)
+            summaries, continuation = db_manager.get_chat_summaries(
+                user_id, page_size=max(1, min(limit, 200)) if limit else None,
+                continuation=request.args.get('continuation')
+            )
+            etag = chat_list_etag(user_id, summaries, continuation)
+            response = not_modified(etag) or with_etag(jsonify(summaries), etag)
+            if continuation:
+                response.headers['X-Continuation-Token'] = continuation
+            return response
             
         except Exception as e:
             logger.error(f"Error retrieving chats for user {user_id}: {str(e)}")
             return jsonify({"error": "Failed to retrieve chats"}), 500
     
     @app.route('/api/chats/<chat_id>', methods=['GET'])
+    @require_auth(auth_service)
     def get_chat(chat_id):
-        user_id = get_user_id_from_token(auth_service)
-        if not user_id:
-            return jsonify({"error": "Unauthorized"}), 401
+        user_id = g.user_id
         
         try:
-            chat = db_manager.get_chat_by_id(user_id, chat_id)
-            if not chat:
+            # The header alone answers a revalidation; the messages are only read when it changed
+            header = chat_store.get_chat_header(user_id, chat_id)
+            if not header:
                 return jsonify({"error": "Chat not found"}), 404
+            unchanged = not_modified(chat_etag(header))
+            if unchanged:
+                return unchanged
             
-            return jsonify(chat)
+            chat = chat_store.get_chat_by_id(user_id, chat_id, header=header)
+            return with_etag(jsonify(chat_to_api(chat)), chat_etag(chat))
             
         except Exception as e:
             logger.error(f"Error retrieving chat {chat_id}: {str(e)}")
             return jsonify({"error": "Failed to retrieve chat"}), 500
     
+    @app.route('/api/chats/<chat_id>/messages', methods=['GET'])
+    @require_auth(auth_service)
+    def get_chat_messages(chat_id):
+        """Page through a chat's messages (?limit=50&continuation=<token>)"""
+        user_id = g.user_id
+        
+        try:
+            limit = request.args.get('limit', default=50, type=int)
+            header = chat_store.get_chat_header(user_id, chat_id)
+            if not header:
+                return jsonify({"error": "Chat not found"}), 404
+            
+            messages, continuation = chat_store.get_chat_messages(
+                user_id, chat_id, header, page_size=max(1, min(limit, 500)),
+                continuation=request.args.get('continuation')
+            )
+            return jsonify({"messages": [message.to_api() for message in messages], "continuationToken": continuation})
+            
+        except Exception as e:
+            logger.error(f"Error retrieving messages for chat {chat_id}: {str(e)}")
+            return jsonify({"error": "Failed to retrieve messages"}), 500
+    
     @app.route('/api/chats/new', methods=['POST'])
+    @require_auth(auth_service)
     def new_chat():
-        user_id = get_user_id_from_token(auth_service)
-        if not user_id:
-            return jsonify({"error": "Unauthorized"}), 401
+        user_id = g.user_id
         
         try:
             chat_id = generate_chat_id()
@@ -138,88 +268,146 @@ def create_app():
             logger.error(f"Error creating new chat: {str(e)}")
             return jsonify({"error": "Failed to create chat"}), 500
     
+    # Chat pipeline helpers shared by the blocking and streaming endpoints
+    def overloaded_response(error: OpenAIOverloadedError):
+        """503 with Retry-After when the OpenAI governor sheds the request"""
+        logger.warning(f"Chat request shed: {str(error)}")
+        response = jsonify({"error": "The assistant is busy, please retry shortly"})
+        response.headers['Retry-After'] = str(int(error.retry_after + 0.5))
+        return response, 503
+    
+    def parse_chat_request():
+        """Validate the chat payload, returning (user_message, chat_id, error_response)"""
+        data = request.get_json()
+        if not data:
+            return None, None, (jsonify({"error": "No JSON data provided"}), 400)
+        
+        user_message = data.get('message', '').strip()
+        chat_id = data.get('chat_id', '').strip()
+        
+        if not user_message:
+            return None, None, (jsonify({"error": "No message provided"}), 400)
+        
+        if not chat_id:
+            return None, None, (jsonify({"error": "No chat_id provided"}), 400)
+        
+        return user_message, chat_id, None
+    
+    def build_chat_messages(chat_history: List, user_message: str, history_summary=None):
+        """Build the OpenAI message list, returning it with the history summary to persist"""
+        messages = [{"role": "system", "content": openai_service.system_prompt}]
+        
+        # Add chat history, compacted to the configured token budget
+        with stage("chat.history"):
+            history, history_summary = history_compactor.compact(chat_history, history_summary)
+        messages.extend(history)
+        
+        # Add current user message
+        messages.append({"role": "user", "content": user_message})
+        return messages, history_summary
+    
+    def plan_search_queries(messages: List, chat_history: List, user_message: str) -> List:
+        """Derive the search query locally when possible, else ask the model for tool calls"""
+        with stage("chat.plan"):
+            planned = query_planner.plan_locally(chat_history, user_message)
+            if planned:
+                logger.info(f"Search query planned locally: {planned[0][:50]}")
+                return [planned]
+            return openai_service.generate_search_queries(messages, g.user_id)
+    
+    def coalesced(name: str, turn_key: str, fn):
+        """Run one pipeline stage, sharing it with identical turns already in flight"""
+        with stage(f"chat.{name}"):
+            if not single_flight:
+                return fn()
+            return single_flight.do(f"{name}:{turn_key}", fn)
+    
+    def retrieve_for_turn(messages: List, chat_history: List, user_message: str):
+        """Plan and run the searches, returning (searches, query, search_content, references)"""
+        searches = plan_search_queries(messages, chat_history, user_message)
+        if not searches:
+            return searches, None, "", []
+        
+        # Perform the searches concurrently and fuse the results
+        query = " | ".join(q for q, _ in searches)
+        with stage("chat.search"):
+            search_content, references = search_service.search_many([q for q, _ in searches])
+        return searches, query, search_content, references
+    
+    def build_answer_messages(messages: List, tool_calls: List, search_content: str) -> List:
+        """Append the search tool calls and the fused results to the conversation.
+        
+        Every tool call needs a tool message; the fused results go in the first
+        one so the model reads a single grounded context.
+        """
+        tool_messages = [{"role": "tool", "tool_call_id": tool_calls[0].id, "content": search_content}]
+        tool_messages += [
+            {"role": "tool", "tool_call_id": call.id, "content": "Results merged into the first search."}
+            for call in tool_calls[1:]
+        ]
+        return messages + [
+            {"role": "assistant", "content": "I'll search for information to help answer your question.", "tool_calls": tool_calls}
+        ] + tool_messages
+    
+    def save_chat_turn(user_id: str, chat_id: str, existing_chat, chat_history: List,
+                       user_message: str, assistant_response: str, references: List, history_summary=None):
+        """Append the user/bot exchange to the chat, writing only the new messages"""
+        new_messages = build_turn_messages(len(chat_history) + 1, user_message, assistant_response, references)
+        
+        # Determine chat name (use first user message if new chat)
+        chat_name = existing_chat['title'] if existing_chat else user_message[:50]
+        
+        # Save to database
+        with stage("chat.save"):
+            chat_store.append_messages(user_id, chat_id, chat_name, new_messages, existing_chat, history_summary)
+    
     @app.route('/api/chat', methods=['POST'])
+    @require_auth(auth_service)
     def chat():
-        user_id = get_user_id_from_token(auth_service)
-        if not user_id:
-            return jsonify({"error": "Unauthorized"}), 401
+        user_id = g.user_id
         
         try:
-            data = request.get_json()
-            if not data:
-                return jsonify({"error": "No JSON data provided"}), 400
-            
-            user_message = data.get('message', '').strip()
-            chat_id = data.get('chat_id', '').strip()
-            
-            if not user_message:
-                return jsonify({"error": "No message provided"}), 400
-            
-            if not chat_id:
-                return jsonify({"error": "No chat_id provided"}), 400
+            user_message, chat_id, error = parse_chat_request()
+            if error:
+                return error
             
             logger.info(f"Processing chat message for user {user_id}, chat {chat_id}")
             
             # Get existing chat history
-            existing_chat = db_manager.get_chat_by_id(user_id, chat_id)
+            with stage("chat.load"):
+                existing_chat = chat_store.get_chat_by_id(user_id, chat_id, with_references=False)
             chat_history = existing_chat['messages'] if existing_chat else []
             
-            # Build messages for OpenAI
-            messages = [{"role": "system", "content": openai_service.system_prompt}]
-            
-            # Add chat history
-            for msg in chat_history:
-                role = "assistant" if msg.get("sender") == "bot" else "user"
-                messages.append({"role": role, "content": msg.get("content", "")})
+            messages, history_summary = build_chat_messages(
+                chat_history, user_message, existing_chat.get('historySummary') if existing_chat else None
+            )
             
-            # Add current user message
-            messages.append({"role": "user", "content": user_message})
+            # Generate search queries and search, shared with identical questions in flight
+            turn_key = AnswerCache.turn_key(messages)
+            searches, query, search_content, references = coalesced(
+                "retrieve", turn_key, lambda: retrieve_for_turn(messages, chat_history, user_message)
+            )
             
-            # Generate search query
-            query, tool_call = openai_service.generate_search_query(messages)
-            
-            assistant_response = ""
-            references = []
-            
-            if query and tool_call:
-                # Perform search
-                search_content, references = search_service.search(query)
-                
-                # Generate answer with search results
-                answer_messages = messages + [
-                    {"role": "assistant", "content": "I'll search for information to help answer your question.", "tool_calls": [tool_call]},
-                    {"role": "tool", "tool_call_id": tool_call.id, "content": search_content}
-                ]
+            if searches:
+                def answer():
+                    cached = answer_cache.get(query, references) if answer_cache else None
+                    if cached:
+                        logger.info(f"Answer cache hit for chat {chat_id}")
+                        return cached["answer"]
+                    
+                    # Generate answer with search results
+                    answer_messages = build_answer_messages(messages, [call for _, call in searches], search_content)
+                    assistant_response = openai_service.generate_answer(answer_messages, g.user_id)
+                    if answer_cache:
+                        answer_cache.set(query, references, assistant_response)
+                    return assistant_response
                 
-                assistant_response = openai_service.generate_answer(answer_messages)
+                assistant_response = coalesced("answer", turn_key, answer)
             else:
-                assistant_response = "I'm not sure how to answer your question without searching for more information."
-            
-            # Update chat history
-            timestamp = datetime.datetime.utcnow().isoformat()
-            next_id = len(chat_history) + 1
-            
-            chat_history.extend([
-                {
-                    "id": str(next_id),
-                    "sender": "user",
-                    "content": user_message,
-                    "timestamp": timestamp
-                },
-                {
-                    "id": str(next_id + 1),
-                    "sender": "bot",
-                    "content": assistant_response,
-                    "timestamp": timestamp,
-                    "references": references
-                }
-            ])
+                assistant_response = NO_SEARCH_RESPONSE
             
-            # Determine chat name (use first user message if new chat)
-            chat_name = existing_chat['title'] if existing_chat else user_message[:50]
-            
-            # Save to database
-            db_manager.store_user_chat(user_id, chat_id, chat_name, chat_history)
+            save_chat_turn(user_id, chat_id, existing_chat, chat_history,
+                           user_message, assistant_response, references, history_summary)
             
             return jsonify({
                 "text": assistant_response,
@@ -227,17 +415,209 @@ def create_app():
                 "chat_id": chat_id
             })
             
+        except ChatConflictError as e:
+            logger.warning(f"Chat turn rejected: {str(e)}")
+            return jsonify({"error": "Chat was updated by another request, please retry"}), 409
+        except OpenAIOverloadedError as e:
+            return overloaded_response(e)
         except Exception as e:
             logger.error(f"Error in chat endpoint: {str(e)}")
             import traceback
             logger.error(traceback.format_exc())
             return jsonify({"error": "Failed to process chat message"}), 500
     
+    @app.route('/api/chat/stream', methods=['POST'])
+    @require_auth(auth_service)
+    def chat_stream():
+        """Streaming variant of /api/chat using Server-Sent Events.
+        
+        Emits a ``references`` event as soon as the search returns, ``token``
+        events as answer deltas arrive, and ``done`` once the turn has been
+        persisted. Failures after the stream has started are reported as an
+        ``error`` event since the status code has already been sent.
+        """
+        user_id = g.user_id
+        
+        try:
+            user_message, chat_id, error = parse_chat_request()
+            if error:
+                return error
+            
+            logger.info(f"Processing streaming chat message for user {user_id}, chat {chat_id}")
+            
+            with stage("chat.load"):
+                existing_chat = chat_store.get_chat_by_id(user_id, chat_id, with_references=False)
+            chat_history = existing_chat['messages'] if existing_chat else []
+            messages, history_summary = build_chat_messages(
+                chat_history, user_message, existing_chat.get('historySummary') if existing_chat else None
+            )
+            
+        except OpenAIOverloadedError as e:
+            return overloaded_response(e)
+        except Exception as e:
+            logger.error(f"Error in chat stream endpoint: {str(e)}")
+            return jsonify({"error": "Failed to process chat message"}), 500
+        
+        def generate():
+            try:
+                turn_key = AnswerCache.turn_key(messages)
+                searches, query, search_content, references = coalesced(
+                    "retrieve", turn_key, lambda: retrieve_for_turn(messages, chat_history, user_message)
+                )
+                
+                if searches:
+                    yield format_sse_event("references", {"references": references, "chat_id": chat_id})
+                    
+                    answer_key = f"answer:{turn_key}"
+                    cached = answer_cache.get(query, references) if answer_cache else None
+                    shared, leader = single_flight.join(answer_key) if single_flight and not cached else (None, True)
+                    if cached:
+                        logger.info(f"Answer cache hit for chat {chat_id}")
+                        assistant_response = cached["answer"]
+                        yield format_sse_event("token", {"text": assistant_response})
+                    elif not leader:
+                        # An identical question is being answered; send its answer when it completes
+                        logger.info(f"Joined in-flight answer for chat {chat_id}")
+                        assistant_response = shared.result()
+                        yield format_sse_event("token", {"text": assistant_response})
+                    else:
+                        answer_messages = build_answer_messages(messages, [call for _, call in searches], search_content)
+                        parts = []
+                        try:
+                            for token in openai_service.stream_answer(answer_messages, g.user_id):
+                                parts.append(token)
+                                yield format_sse_event("token", {"text": token})
+                        except BaseException as e:
+                            if shared:
+                                single_flight.resolve(answer_key, error=e)
+                            raise
+                        assistant_response = "".join(parts)
+                        if answer_cache:
+                            answer_cache.set(query, references, assistant_response)
+                        if shared:
+                            single_flight.resolve(answer_key, assistant_response)
+                else:
+                    references = []
+                    assistant_response = NO_SEARCH_RESPONSE
+                    yield format_sse_event("references", {"references": references, "chat_id": chat_id})
+                    yield format_sse_event("token", {"text": assistant_response})
+                
+                # Persist only once the full answer has been streamed
+                save_chat_turn(user_id, chat_id, existing_chat, chat_history,
+                               user_message, assistant_response, references, history_summary)
+                yield format_sse_event("done", {"chat_id": chat_id})
+                logger.info(f"{request.method} {request.path}: {current_request_usage()}")
+                
+            except ChatConflictError as e:
+                logger.warning(f"Chat turn rejected: {str(e)}")
+                yield format_sse_event("error", {"error": "Chat was updated by another request, please retry"})
+            except OpenAIOverloadedError as e:
+                logger.warning(f"Chat stream shed: {str(e)}")
+                yield format_sse_event("error", {"error": "The assistant is busy, please retry shortly",
+                                                 "retryAfter": e.retry_after})
+            except Exception as e:
+                logger.error(f"Error streaming chat response: {str(e)}")
+                import traceback
+                logger.error(traceback.format_exc())
+                yield format_sse_event("error", {"error": "Failed to process chat message"})
+        
+        return Response(
+            stream_with_context(generate()),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+    
+    # Document ingestion endpoint
+    @app.route('/api/upload/pdf', methods=['POST'])
+    @require_auth(auth_service, role=config.ADMIN_ROLE)
+    def upload_pdf():
+        """Index an uploaded PDF; with ?stream=true, progress is sent as Server-Sent Events"""
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            return jsonify({"error": "A PDF file is required"}), 400
+        if upload.mimetype != 'application/pdf' and not upload.filename.lower().endswith('.pdf'):
+            return jsonify({"error": "Only PDF files are supported"}), 400
+        
+        file_name = request.form.get('fileName') or upload.filename
+        # upload.stream is spooled to disk past a small size; pages are read from it lazily
+        events = ingestion_service.ingest(upload.stream, file_name)
+        
+        if request.args.get('stream', 'false').lower() == 'true':
+            def generate():
+                try:
+                    for progress in events:
+                        yield format_sse_event("done" if progress.get("done") else "progress", progress)
+                except Exception as e:
+                    logger.error(f"Error ingesting {file_name}: {str(e)}")
+                    yield format_sse_event("error", {"error": "Failed to ingest document"})
+            
+            return Response(
+                stream_with_context(generate()),
+                mimetype="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
+        
+        try:
+            result = None
+            for result in events:
+                pass
+            return jsonify(result)
+            
+        except Exception as e:
+            logger.error(f"Error ingesting {file_name}: {str(e)}")
+            return jsonify({"error": "Failed to ingest document"}), 500
+    
+    # Admin endpoints
+    @app.route('/api/admin/cache', methods=['GET'])
+    @require_auth(auth_service, role=config.ADMIN_ROLE)
+    def cache_stats():
+        return jsonify({
+            "answers": answer_cache.stats() if answer_cache else None,
+            "search": search_service.cache_stats(),
+            "embeddings": embedding_service.stats() if embedding_service else None,
+            "singleFlight": single_flight.stats() if single_flight else None,
+            "chatLists": db_manager.chat_lists.stats() if db_manager.chat_lists else None
+        })
+    
+    @app.route('/api/admin/openai', methods=['GET'])
+    @require_auth(auth_service, role=config.ADMIN_ROLE)
+    def openai_stats():
+        """Queue depth, wait times, shed and throttled calls of the OpenAI governor"""
+        return jsonify(openai_service.governor.stats() if openai_service.governor else None)
+    
+    @app.route('/api/admin/cache/answers', methods=['DELETE'])
+    @require_auth(auth_service, role=config.ADMIN_ROLE)
+    def clear_answer_cache():
+        if answer_cache:
+            answer_cache.clear()
+        return jsonify({"status": "cleared"})
+    
+    @app.route('/api/admin/cache/search', methods=['DELETE'])
+    @require_auth(auth_service, role=config.ADMIN_ROLE)
+    def invalidate_search_cache():
+        """Call after the search index has been re-ingested"""
+        search_service.invalidate_cache()
+        return jsonify({"status": "cleared"})
+    
+    if config.METRICS_ENABLED:
+        @app.route('/metrics')
+        def metrics():
+            """Prometheus scrape endpoint"""
+            return Response(registry.render(), content_type=METRICS_CONTENT_TYPE)
+    
     # Health check endpoint
     @app.route('/health')
+    @app.route('/health/live')
     def health_check():
+        """Liveness: the process is up; never touches a dependency"""
         return jsonify({"status": "healthy", "timestamp": datetime.datetime.utcnow().isoformat()})
     
+    @app.route('/health/ready')
+    def readiness_check():
+        """Readiness: warm-up has finished and Cosmos DB, Azure AD and Search answer"""
+        ready, report = health_checks.readiness()
+        return jsonify(report), 200 if ready else 503
+    
     # Root endpoint
     @app.route('/')
     def index():
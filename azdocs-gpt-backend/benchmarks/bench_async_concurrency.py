@@ -0,0 +1,146 @@
+# bench_async_concurrency.py - Compare the blocking and async FastAPI chat pipelines under concurrency
+#
+# Usage: python benchmarks/bench_async_concurrency.py --concurrency 200 --requests 400 --llm-delay 0.5
+#
+# Both pipelines talk to the same local StubAzureServer, so the numbers only
+# reflect how many chats a single worker can keep in flight, not Azure latency.
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("AZURE_OPENAI_DEPLOYMENT", "stub")
+os.environ.setdefault("AZURE_SEARCH_INDEX", "stub-index")
+
+import httpx
+import jwt
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents import SearchClient
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
+from fastapi import FastAPI, Header, HTTPException
+from openai import AsyncAzureOpenAI, AzureOpenAI
+
+import main
+from models import AsyncCosmosDBManager, CosmosDBManager, build_turn_messages
+from stubs import AsyncInMemoryContainer, InMemoryContainer, StubAzureServer
+
+
+def build_blocking_app(endpoint: str) -> FastAPI:
+    """The pre-async pipeline: a sync route on blocking clients, run in the threadpool"""
+    openai_client = AzureOpenAI(api_version="2023-03-15-preview", azure_endpoint=endpoint, api_key="stub")
+    search_client = SearchClient(endpoint=endpoint, index_name="stub-index", credential=AzureKeyCredential("stub"))
+    chat_store = CosmosDBManager.__new__(CosmosDBManager)
+    chat_store.container = InMemoryContainer()
+    app = FastAPI()
+    
+    @app.post("/api/chat")
+    def chat(data: main.ChatRequest, authorization: str = Header(None)):
+        user_id = jwt.decode(authorization.split(" ")[1], main.SECRET_KEY, algorithms=["HS256"])["sub"]
+        if not user_id:
+            raise HTTPException(status_code=401)
+        existing = chat_store.get_chat_by_id(user_id, data.chat_id)
+        chat_history = existing["messages"] if existing else []
+        messages = main.build_chat_messages(chat_history, data.message)
+        completion = openai_client.chat.completions.create(model="stub", messages=messages, tools=main.SEARCH_TOOLS)
+        call = completion.choices[0].message.tool_calls[0]
+        query = json.loads(call.function.arguments)["query"]
+        references, content = [], ""
+        for r in search_client.search(search_text=query, select="title,chunk", top=5):
+            content += f"[{r['title']}]: {r['chunk']}\n----\n"
+            references.append({"title": r["title"], "content": r["chunk"]})
+        answer = openai_client.chat.completions.create(
+            model="stub", messages=main.build_answer_messages(messages, [call], content)
+        )
+        new_messages = build_turn_messages(len(chat_history) + 1, data.message, answer.choices[0].message.content, references)
+        chat_store.append_messages(user_id, data.chat_id, data.message[:50], new_messages, existing)
+        return {"text": answer.choices[0].message.content, "references": references, "chat_id": data.chat_id}
+    
+    return app
+
+
+def build_async_app(endpoint: str) -> FastAPI:
+    """The production main.py app with its lifespan clients swapped for stub-backed ones"""
+    main.clients.openai = AsyncAzureOpenAI(api_version="2023-03-15-preview", azure_endpoint=endpoint, api_key="stub")
+    main.clients.chat = main.clients.openai.chat
+    # Measure the pipeline itself, not the OpenAI concurrency cap (see bench_openai_governor.py)
+    main.governor = None
+    main.clients.search = AsyncSearchClient(endpoint=endpoint, index_name="stub-index", credential=AzureKeyCredential("stub"))
+    main.clients.container = AsyncInMemoryContainer()
+    main.clients.chat_store = AsyncCosmosDBManager(main.clients.container)
+    return main.app
+
+
+async def drive_async_app(endpoint: str, total: int, concurrency: int) -> dict:
+    """drive() the async app, with its clients created and closed on this event loop"""
+    app = build_async_app(endpoint)
+    try:
+        return await drive(app, total, concurrency)
+    finally:
+        await main.clients.openai.close()
+        await main.clients.search.close()
+
+
+async def drive(app: FastAPI, total: int, concurrency: int) -> dict:
+    token = jwt.encode(
+        {"sub": "bench-user", "exp": datetime.datetime.utcnow() + datetime.timedelta(hours=1)},
+        main.SECRET_KEY, algorithm="HS256"
+    )
+    headers = {"Authorization": f"Bearer {token}"}
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+    
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=None) as client:
+        async def one(i: int):
+            nonlocal errors
+            async with semaphore:
+                started = time.perf_counter()
+                response = await client.post("/api/chat", headers=headers,
+                                             json={"message": f"How do I rotate storage key {i}?", "chat_id": f"chat-{i}"})
+                latencies.append(time.perf_counter() - started)
+                if response.status_code != 200:
+                    errors += 1
+        
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        elapsed = time.perf_counter() - started
+    
+    latencies.sort()
+    return {
+        "requests": total,
+        "concurrency": concurrency,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "rps": round(total / elapsed, 2),
+        "p50_ms": round(statistics.median(latencies) * 1000, 1),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 1),
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Compare the blocking and async FastAPI chat pipelines under concurrency")
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--llm-delay", type=float, default=0.5)
+    parser.add_argument("--search-delay", type=float, default=0.1)
+    args = parser.parse_args()
+    
+    server = StubAzureServer(llm_delay=args.llm_delay, search_delay=args.search_delay).start()
+    try:
+        results = {
+            "blocking": asyncio.run(drive(build_blocking_app(server.endpoint), args.requests, args.concurrency)),
+            "async": asyncio.run(drive_async_app(server.endpoint, args.requests, args.concurrency)),
+        }
+    finally:
+        server.stop()
+    
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
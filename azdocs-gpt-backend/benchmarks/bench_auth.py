@@ -0,0 +1,68 @@
+# bench_auth.py - Per-request auth overhead: verifying every bearer token vs. the TokenVerifier claims cache
+#
+# Usage: python benchmarks/bench_auth.py [--users 500] [--calls-per-token 4] [--rounds 5]
+#
+# Each simulated page load makes several authenticated calls (sidebar chat
+# list, chat history, chat turn, ...) with the same token. The uncached path
+# is what get_user_id_from_token did before: a jwt.decode per call.
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import jwt
+
+from services import TokenVerifier
+
+SECRET = "bench-secret-key"
+
+
+def make_tokens(users: int):
+    exp = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+    return [
+        jwt.encode({"sub": f"user-{i}", "email": f"user{i}@example.com", "name": f"User {i}",
+                    "roles": [], "exp": exp}, SECRET, algorithm="HS256")
+        for i in range(users)
+    ]
+
+
+def timed(fn, tokens, calls_per_token: int, rounds: int) -> float:
+    """Mean microseconds per authenticated call"""
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for token in tokens:
+            for _ in range(calls_per_token):
+                fn(token)
+    return (time.perf_counter() - started) * 1e6 / (rounds * len(tokens) * calls_per_token)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-request auth overhead: verifying every bearer token vs. the TokenVerifier claims cache")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--calls-per-token", type=int, default=4)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+    
+    tokens = make_tokens(args.users)
+    verifier = TokenVerifier(SECRET, max_entries=4096)
+    
+    uncached = timed(lambda t: jwt.decode(t, SECRET, algorithms=["HS256"]).get("sub"),
+                     tokens, args.calls_per_token, args.rounds)
+    cached = timed(lambda t: verifier.verify(t).get("sub"), tokens, args.calls_per_token, args.rounds)
+    
+    print(json.dumps({
+        "users": args.users,
+        "calls_per_token": args.calls_per_token,
+        "uncached_us_per_call": round(uncached, 2),
+        "cached_us_per_call": round(cached, 2),
+        "speedup": round(uncached / cached, 1) if cached else None,
+        "cache": verifier.cache.stats()
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
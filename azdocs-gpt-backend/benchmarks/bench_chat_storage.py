@@ -0,0 +1,177 @@
+# bench_chat_storage.py - RU, payload size and latency per turn for the chat storage layouts
+#
+# Usage: python benchmarks/bench_chat_storage.py [--turns 10 50 100 250] [--cosmos-endpoint URL --cosmos-key KEY]
+#
+# Layouts: "whole_document" (schema 1, the chat rewritten on every turn),
+# "inline_references" (schema 2, one item per message with the cited chunks
+# copied into every bot message) and "reference_table" (schema 3, chunks
+# stored once per chat). Each turn cites 5 chunks from a pool of 20, so
+# later turns re-cite earlier chunks. After the last turn the chat is read
+# back the way the chat endpoints load history (read_* fields).
+#
+# By default runs against the in-memory container from stubs.py, which
+# estimates RUs from payload size. Pass the Cosmos DB emulator endpoint/key to
+# use real request charges (a throwaway database is created and deleted).
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from models import CosmosDBManager, build_turn_messages, format_timestamp, message_item_id
+from stubs import InMemoryContainer
+
+REFERENCES = [
+    {"title": f"storage-account-keys-{i}.md", "content": f"Step {i}: rotate keys by regenerating the secondary key first. " * 30}
+    for i in range(20)
+]
+
+
+class ChargeRecorder:
+    """Wraps a real container and sums the x-ms-request-charge of every call"""
+    
+    def __init__(self, container):
+        self._container = container
+        self.request_charge = 0.0
+        self.bytes_written = 0
+    
+    def _record(self):
+        headers = self._container.client_connection.last_response_headers
+        self.request_charge += float(headers.get("x-ms-request-charge", 0))
+    
+    def upsert_item(self, body, **kwargs):
+        self.bytes_written += len(json.dumps(body))
+        result = self._container.upsert_item(body, **kwargs)
+        self._record()
+        return result
+    
+    def execute_item_batch(self, batch_operations, partition_key, **kwargs):
+        self.bytes_written += sum(len(json.dumps(op[1][0])) for op in batch_operations)
+        result = self._container.execute_item_batch(batch_operations=batch_operations, partition_key=partition_key, **kwargs)
+        self._record()
+        return result
+    
+    def read_item(self, *args, **kwargs):
+        result = self._container.read_item(*args, **kwargs)
+        self._record()
+        return result
+    
+    def query_items(self, *args, **kwargs):
+        items = list(self._container.query_items(*args, **kwargs))
+        self._record()
+        return items
+
+
+def legacy_store(container, user_id: str, chat_id: str, messages):
+    """The previous layout: rewrite the whole chat document on every turn"""
+    container.upsert_item({
+        "title": "Benchmark chat",
+        "id": chat_id,
+        "userId": user_id,
+        "messages": [message.to_api() for message in messages],
+        "lastUpdated": datetime.datetime.utcnow().isoformat()
+    })
+
+
+def inline_references_store(container, user_id: str, chat_id: str, new_messages, message_count: int):
+    """Schema 2: append message items that carry a copy of every cited chunk, then the header"""
+    items = []
+    for seq, message in enumerate(new_messages, message_count + 1):
+        item = {"id": message_item_id(chat_id, seq), "userId": user_id, "type": "message", "chatId": chat_id,
+                "seq": seq, "messageId": message.id, "sender": message.sender, "content": message.content,
+                "timestamp": format_timestamp(message.timestamp)}
+        if message.references is not None:
+            item["references"] = [ref.to_api() for ref in message.references]
+        items.append(("upsert", (item,)))
+    header = {"id": chat_id, "userId": user_id, "type": "chat", "schemaVersion": 2, "title": "Benchmark chat",
+              "messageCount": message_count + len(new_messages), "lastUpdated": datetime.datetime.utcnow().isoformat()}
+    container.execute_item_batch(batch_operations=items + [("upsert", (header,))], partition_key=user_id)
+
+
+def run(make_container, turns: int) -> dict:
+    results = {}
+    for layout in ("whole_document", "inline_references", "reference_table"):
+        container = make_container()
+        manager = CosmosDBManager.__new__(CosmosDBManager)
+        manager.container = container
+        user_id, chat_id = f"user-{uuid.uuid4().hex[:8]}", f"chat-{uuid.uuid4().hex[:8]}"
+        history, existing = [], None
+        last_turn = {}
+        
+        for turn in range(turns):
+            if layout == "reference_table":
+                # As the chat endpoints do: the history (without reference text) tells which chunks are stored
+                existing = manager.get_chat_by_id(user_id, chat_id, with_references=False)
+            cited = [REFERENCES[(turn * 3 + i) % len(REFERENCES)] for i in range(5)]
+            new_messages = build_turn_messages(len(history) + 1, f"Question {turn}?", "Answer text. " * 60, cited)
+            charge_before, bytes_before = container.request_charge, container.bytes_written
+            started = time.perf_counter()
+            if layout == "whole_document":
+                history = history + new_messages
+                legacy_store(container, user_id, chat_id, history)
+            elif layout == "inline_references":
+                inline_references_store(container, user_id, chat_id, new_messages, len(history))
+                history = history + new_messages
+            else:
+                manager.append_messages(user_id, chat_id, "Benchmark chat", new_messages, existing)
+                history = history + new_messages
+            last_turn = {
+                "write_ms": round((time.perf_counter() - started) * 1000, 3),
+                "write_ru": round(container.request_charge - charge_before, 2),
+                "write_bytes": container.bytes_written - bytes_before,
+            }
+        
+        charge_before, bytes_before = container.request_charge, getattr(container, "bytes_read", 0)
+        tracemalloc.start()
+        started = time.perf_counter()
+        chat = manager.get_chat_by_id(user_id, chat_id, with_references=False)
+        read_ms = (time.perf_counter() - started) * 1000
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert len(chat["messages"]) == len(history)
+        
+        results[layout] = {
+            "last_turn": last_turn,
+            "total_ru": round(container.request_charge, 2),
+            "total_bytes_written": container.bytes_written,
+            "read_ms": round(read_ms, 3),
+            "read_ru": round(container.request_charge - charge_before, 2),
+            "read_bytes": getattr(container, "bytes_read", 0) - bytes_before or None,
+            "read_peak_kib": round(peak / 1024, 1),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RU, payload size and latency per turn for the chat storage layouts")
+    parser.add_argument("--turns", type=int, nargs="+", default=[10, 50, 100, 250])
+    parser.add_argument("--cosmos-endpoint")
+    parser.add_argument("--cosmos-key")
+    args = parser.parse_args()
+    
+    cleanup = None
+    if args.cosmos_endpoint:
+        from azure.cosmos import CosmosClient, PartitionKey
+        client = CosmosClient(args.cosmos_endpoint, args.cosmos_key)
+        database = client.create_database_if_not_exists(id=f"bench-{uuid.uuid4().hex[:8]}")
+        cleanup = lambda: client.delete_database(database)
+        
+        def make_container():
+            return ChargeRecorder(database.create_container(id=uuid.uuid4().hex[:12], partition_key=PartitionKey(path="/userId")))
+    else:
+        make_container = InMemoryContainer
+    
+    try:
+        print(json.dumps({turns: run(make_container, turns) for turns in args.turns}, indent=2))
+    finally:
+        if cleanup:
+            cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# bench_context_packing.py - Grounding tokens per answer with and without context packing
+#
+# Usage: python benchmarks/bench_context_packing.py [--results 5 10 20] [--budget 2000]
+#
+# Builds synthetic search results the way multi-query retrieval returns them:
+# overlapping chunks of the same documents, near-duplicate chunks that differ
+# only in a trailing word, and reranker scores. Compares the grounding text the
+# apps used to send (every chunk verbatim) with the ContextPacker output.
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from services import ContextPacker, HistoryCompactor, format_search_content
+
+CHUNK_WORDS = 220
+OVERLAP_WORDS = 40
+
+
+def make_document(doc: int, words: int):
+    vocabulary = [f"term{doc}_{i}" for i in range(300)]
+    rng = random.Random(doc)
+    return [rng.choice(vocabulary) for _ in range(words)]
+
+
+def make_results(count: int, seed: int = 7):
+    """Chunks sliced with overlap, so neighbours of one document share text at the seam"""
+    rng = random.Random(seed)
+    documents = {doc: make_document(doc, 2000) for doc in range(max(2, count // 3))}
+    results = []
+    while len(results) < count:
+        doc = rng.choice(list(documents))
+        start = rng.randrange(0, 6) * (CHUNK_WORDS - OVERLAP_WORDS)
+        chunk = " ".join(documents[doc][start:start + CHUNK_WORDS])
+        if rng.random() < 0.25:
+            # Near-duplicate: the same chunk indexed twice with a slightly different tail
+            chunk += " revised"
+        results.append({"title": f"doc-{doc}.md", "content": chunk, "score": round(rng.uniform(1.0, 3.5), 3)})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Grounding tokens per answer with and without context packing")
+    parser.add_argument("--results", type=int, nargs="+", default=[5, 10, 20, 40])
+    parser.add_argument("--budget", type=int, default=2000)
+    parser.add_argument("--threshold", type=float, default=0.85)
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+    
+    packer = ContextPacker(token_budget=args.budget, dedup_threshold=args.threshold)
+    rows = []
+    for count in args.results:
+        references = make_results(count)
+        before = format_search_content(references)
+        
+        started = time.perf_counter()
+        for _ in range(args.iterations):
+            after, packed = packer.pack(references)
+        elapsed_us = (time.perf_counter() - started) / args.iterations * 1e6
+        
+        rows.append({
+            "results": count,
+            "tokens_before": HistoryCompactor.estimate_tokens(before),
+            "tokens_after": HistoryCompactor.estimate_tokens(after),
+            "blocks_after": len(packed),
+            "pack_us": round(elapsed_us, 1),
+        })
+    print(json.dumps(rows, indent=2))
+
+
+if __name__ == "__main__":
+    main()
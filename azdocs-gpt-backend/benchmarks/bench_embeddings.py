@@ -0,0 +1,89 @@
+# bench_embeddings.py - Embedding API calls and latency: per-request calls vs. the batched, cached service
+#
+# Usage: python benchmarks/bench_embeddings.py [--requests 200] [--concurrency 32] [--distinct 50] [--call-delay 0.05]
+#
+# The embeddings endpoint is replaced by a fake that sleeps for a fixed
+# overhead plus a small per-input cost. Requests draw from a pool of
+# distinct texts, as popular questions repeat; the warm run reuses the
+# on-disk cache left by the cold run.
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from embeddings import EmbeddingCache, EmbeddingService
+
+DIM = 1536
+
+
+class FakeEmbeddings:
+    def __init__(self, call_delay: float, per_input_delay: float = 0.0005):
+        self.call_delay = call_delay
+        self.per_input_delay = per_input_delay
+        self.calls = 0
+        self._lock = threading.Lock()
+    
+    def embed(self, texts):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.call_delay + self.per_input_delay * len(texts))
+        return [[float(len(text))] * DIM for text in texts]
+
+
+def run(fn, texts, concurrency: int):
+    latencies = []
+    
+    def one(text):
+        started = time.perf_counter()
+        fn(text)
+        latencies.append((time.perf_counter() - started) * 1000)
+    
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, texts))
+    latencies.sort()
+    return {
+        "wall_s": round(time.perf_counter() - started, 2),
+        "p50_ms": round(latencies[len(latencies) // 2], 1),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1], 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embedding API calls and latency: per-request calls vs. the batched, cached service")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--distinct", type=int, default=50)
+    parser.add_argument("--call-delay", type=float, default=0.05)
+    parser.add_argument("--window-ms", type=float, default=5)
+    args = parser.parse_args()
+    
+    rng = random.Random(3)
+    texts = [f"how do I configure azure feature {rng.randrange(args.distinct)}" for _ in range(args.requests)]
+    cache_dir = tempfile.mkdtemp(prefix="bench-embedding-cache-")
+    try:
+        results = {}
+        
+        fake = FakeEmbeddings(args.call_delay)
+        results["per_request"] = dict(run(lambda text: fake.embed([text]), texts, args.concurrency), api_calls=fake.calls)
+        
+        for label in ("batched_cold_cache", "batched_warm_cache"):
+            fake = FakeEmbeddings(args.call_delay)
+            service = EmbeddingService(fake.embed, "bench", EmbeddingCache(cache_dir), batch_window_ms=args.window_ms)
+            results[label] = dict(run(service.embed_query, texts, args.concurrency), api_calls=fake.calls)
+        
+        print(json.dumps({"requests": args.requests, "distinct_texts": args.distinct, "results": results}, indent=2))
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
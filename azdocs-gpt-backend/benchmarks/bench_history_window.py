@@ -0,0 +1,65 @@
+# bench_history_window.py - Prompt tokens vs. turn count with and without history compaction
+#
+# Usage: python benchmarks/bench_history_window.py [--turns 2 10 50 100 200] [--budget 3000]
+#
+# Builds synthetic chats whose bot messages carry references, then compares
+# the prompt the apps used to replay (every message verbatim) with the
+# HistoryCompactor output. Tokens use the compactor's own estimate.
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from services import HistoryCompactor
+
+
+def make_history(turns: int):
+    history = []
+    for i in range(turns):
+        history.append({"id": str(2 * i + 1), "sender": "user",
+                        "content": f"Question {i}: how do I configure feature {i} of Azure App Service with slots?"})
+        history.append({"id": str(2 * i + 2), "sender": "bot",
+                        "content": f"To configure feature {i}, open the portal and ... " * 25,
+                        "references": [{"title": f"doc-{i}-{r}.md", "content": "chunk text " * 150} for r in range(5)]})
+    return history
+
+
+def prompt_tokens(messages):
+    return sum(HistoryCompactor.estimate_tokens(m["content"]) for m in messages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prompt tokens vs. turn count with and without history compaction")
+    parser.add_argument("--turns", type=int, nargs="+", default=[2, 10, 25, 50, 100, 200])
+    parser.add_argument("--budget", type=int, default=3000)
+    parser.add_argument("--recent", type=int, default=6)
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+    
+    compactor = HistoryCompactor(token_budget=args.budget, recent_messages=args.recent)
+    rows = []
+    for turns in args.turns:
+        history = make_history(turns)
+        before = [HistoryCompactor.to_prompt_message(m) for m in history]
+        
+        started = time.perf_counter()
+        for _ in range(args.iterations):
+            after, _ = compactor.compact(history)
+        elapsed_us = (time.perf_counter() - started) / args.iterations * 1e6
+        
+        rows.append({
+            "turns": turns,
+            "prompt_tokens_before": prompt_tokens(before),
+            "prompt_tokens_after": prompt_tokens(after),
+            "messages_before": len(before),
+            "messages_after": len(after),
+            "compact_us": round(elapsed_us, 1),
+        })
+    print(json.dumps(rows, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+# bench_ingestion.py - PDF ingestion throughput, first upload vs. unchanged re-upload
+#
+# Usage: python benchmarks/bench_ingestion.py [--pages 20 50 200] [--embed-delay 0.05] [--upload-delay 0.1]
+#
+# Generates a text PDF in memory and ingests it through IngestionService into
+# a fake search index whose embed/upload calls sleep for the injected delays,
+# so the numbers show extraction cost, the embed/upload overlap and the
+# effect of page hashing on a re-upload. The PDF is then re-uploaded with its
+# second half removed, which must delete exactly the chunks of those pages.
+# Like the service, the fake index returns 50 results per search unless
+# ``top`` says otherwise, so documents of more than 50 chunks (two per page)
+# show whether every stored key is read back.
+import argparse
+import io
+import json
+import os
+import random
+import re
+import sys
+import time
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ingestion import AzureSearchIndexSink, IngestionService
+
+
+def make_pdf(pages: int, words_per_page: int = 400, seed: int = 5) -> bytes:
+    """Minimal PDF with one Helvetica text stream per page"""
+    rng = random.Random(seed)
+    vocabulary = ["azure", "function", "storage", "queue", "cosmos", "partition", "index", "vector",
+                  "network", "identity", "role", "deployment", "region", "throughput", "latency"]
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>",
+               f"<< /Type /Pages /Kids [{' '.join(f'{3 + 2 * i} 0 R' for i in range(pages))}] /Count {pages} >>"]
+    font = 3 + 2 * pages
+    for i in range(pages):
+        words = [rng.choice(vocabulary) for _ in range(words_per_page)]
+        lines = [" ".join(words[j:j + 12]) for j in range(0, len(words), 12)]
+        body = "BT /F1 10 Tf 20 780 Td 12 TL " + " ".join(f"({line}) '" for line in lines) + " ET"
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {4 + 2 * i} 0 R "
+                       f"/Resources << /Font << /F1 {font} 0 R >> >> >>")
+        objects.append(f"<< /Length {len(body)} >>\nstream\n{body}\nendstream")
+    objects.append("<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    
+    out, offsets = "%PDF-1.4\n", []
+    for number, obj in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{obj}\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n" + "".join(f"{o:010d} 00000 n \n" for o in offsets)
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n"
+    return out.encode("latin-1")
+
+
+class FakeSearchClient:
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.documents = {}
+    
+    def search(self, search_text: str, filter: str, select: str, order_by=None, top: int = 50):
+        match = re.fullmatch(r"parent_id eq '([^']*)'(?: and chunk_id gt '([^']*)')?", filter)
+        parent_id, after = match.group(1), match.group(2) or ""
+        keys = [key for key, doc in self.documents.items() if doc["parent_id"] == parent_id and key > after]
+        if order_by == ["chunk_id"]:
+            keys.sort()
+        return [{"chunk_id": key} for key in keys[:top]]
+    
+    def upload_documents(self, documents):
+        time.sleep(self.delay)
+        self.documents.update((doc["chunk_id"], doc) for doc in documents)
+        return [types.SimpleNamespace(key=doc["chunk_id"], succeeded=True) for doc in documents]
+    
+    def delete_documents(self, documents):
+        for doc in documents:
+            self.documents.pop(doc["chunk_id"], None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PDF ingestion throughput, first upload vs. unchanged re-upload")
+    parser.add_argument("--pages", type=int, nargs="+", default=[20, 50, 200])
+    parser.add_argument("--embed-delay", type=float, default=0.05)
+    parser.add_argument("--upload-delay", type=float, default=0.1)
+    parser.add_argument("--embed-batch", type=int, default=16)
+    parser.add_argument("--upload-batch", type=int, default=100)
+    parser.add_argument("--key-page-size", type=int, default=1000)
+    args = parser.parse_args()
+    
+    def embed(texts):
+        time.sleep(args.embed_delay)
+        return [[0.0] * 8 for _ in texts]
+    
+    rows = []
+    for pages in args.pages:
+        pdf = make_pdf(pages)
+        client = FakeSearchClient(args.upload_delay)
+        service = IngestionService(AzureSearchIndexSink(client, key_page_size=args.key_page_size), embed,
+                                   embed_batch_size=args.embed_batch, upload_batch_size=args.upload_batch)
+        first = list(service.ingest(io.BytesIO(pdf), "bench.pdf"))[-1]
+        again = list(service.ingest(io.BytesIO(pdf), "bench.pdf"))[-1]
+        shrunk = list(service.ingest(io.BytesIO(make_pdf(pages // 2)), "bench.pdf"))[-1]
+        rows.append({
+            "pages": pages,
+            "pdf_kb": round(len(pdf) / 1024, 1),
+            "chunks": first["chunksUploaded"],
+            "first_upload_s": first["seconds"],
+            "first_pages_per_s": first["pagesPerSecond"],
+            "reupload_s": again["seconds"],
+            "reupload_chunks_uploaded": again["chunksUploaded"],
+            "shrunk_chunks_deleted": shrunk["chunksDeleted"],
+            # Chunks of the removed pages still searchable after the shrunk upload; should be 0
+            "stale_chunks_left": sum(1 for key in client.documents if int(re.search(r"_p(\d+)_", key).group(1)) > pages // 2),
+        })
+    print(json.dumps(rows, indent=2))
+
+
+if __name__ == "__main__":
+    main()
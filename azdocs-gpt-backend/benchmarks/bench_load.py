@@ -0,0 +1,256 @@
+# bench_load.py - End-to-end load test of POST /api/chat on the Flask and FastAPI apps, without Azure
+#
+# Usage: python benchmarks/bench_load.py [--app flask|fastapi|both] [--users 32] [--conversations 128] [--turns 3]
+#                                        [--llm-delay 0.3] [--token-rate 200] [--search-delay 0.05]
+#                                        [--output load.json] [--baseline previous.json] [--max-regression 0.15]
+#
+# Azure OpenAI and Azure AI Search are replaced by a local StubAzureServer
+# (tool-call and answer completions with --llm-delay latency plus
+# completion tokens at --token-rate tokens/s) and Cosmos DB by the
+# in-memory container from stubs.py. Each app is served over real HTTP on
+# localhost - Flask by werkzeug's threaded server, FastAPI by uvicorn - and
+# --users virtual users each hold one conversation of --turns sequential
+# turns at a time, so later turns carry a growing history.
+#
+# The JSON report has p50/p95/p99 latency, RPS and errors per app, plus the
+# per-stage breakdown from the telemetry histograms (bucket upper bounds).
+# With --baseline, it exits non-zero when RPS dropped or p95 grew by more
+# than --max-regression compared with the baseline report. Compare runs on
+# the same machine; the servers are single-process development servers.
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import httpx
+import jwt
+
+from stubs import AsyncInMemoryContainer, InMemoryContainer, StubAzureServer
+
+
+def configure_environment(endpoint: str):
+    """Point both apps' settings at the stubs; must run before app.py or main.py is imported"""
+    settings = {
+        "AZURE_OPENAI_ENDPOINT": endpoint,
+        "AZURE_OPENAI_KEY": "stub",
+        "AZURE_OPENAI_DEPLOYMENT": "stub",
+        "AZURE_SEARCH_ENDPOINT": endpoint,
+        "AZURE_SEARCH_KEY": "stub",
+        "AZURE_SEARCH_INDEX": "stub-index",
+        "COSMOS_ENDPOINT": endpoint + "/",
+        "COSMOS_KEY": "c3R1Yg==",
+        "WARMUP_ON_START": "false",
+        "METRICS_ENABLED": "true",
+    }
+    for name, value in settings.items():
+        os.environ[name] = value
+        os.environ[f"APPSETTING_{name}"] = value
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return round(values[min(len(values) - 1, max(0, int(len(values) * fraction + 0.5) - 1))] * 1000, 1) if values else None
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def serve_flask():
+    """Build the Flask app on an in-memory chat store and serve it on a background thread"""
+    from werkzeug.serving import make_server
+    import app as flask_module
+    from models import CosmosDBManager
+    
+    class InMemoryCosmosDBManager(CosmosDBManager):
+        def __init__(self, config, chat_lists=None):
+            self.throughput = config.COSMOS_THROUGHPUT
+            self.container = InMemoryContainer()
+            self.chat_lists = chat_lists
+        
+        def ping(self):
+            pass
+    
+    flask_module.CosmosDBManager = InMemoryCosmosDBManager
+    server = make_server("127.0.0.1", 0, flask_module.create_app(), threaded=True)
+    threading.Thread(target=server.serve_forever, name="flask-server", daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", flask_module.get_config().SECRET_KEY, server.shutdown
+
+
+def serve_fastapi(endpoint: str):
+    """Point main.py's clients at the stubs and serve main.app with uvicorn on a background thread"""
+    import uvicorn
+    from azure.core.credentials import AzureKeyCredential
+    from azure.search.documents.aio import SearchClient
+    from openai import AsyncAzureOpenAI
+    import main
+    from models import AsyncCosmosDBManager
+    
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, lifespan="off", log_level="warning"))
+    
+    def run():
+        # The clients bind to the server's event loop, so create them on it
+        async def serve():
+            main.clients.openai = AsyncAzureOpenAI(api_version="2023-03-15-preview", azure_endpoint=endpoint, api_key="stub")
+            main.clients.chat = (main.clients.openai.with_options(max_retries=0) if main.governor else main.clients.openai).chat
+            main.clients.search = SearchClient(endpoint=endpoint, index_name="stub-index", credential=AzureKeyCredential("stub"))
+            main.clients.container = AsyncInMemoryContainer()
+            main.clients.chat_store = AsyncCosmosDBManager(main.clients.container, main.chat_lists)
+            try:
+                await server.serve()
+            finally:
+                await main.clients.openai.close()
+                await main.clients.search.close()
+        asyncio.run(serve())
+    
+    thread = threading.Thread(target=run, name="fastapi-server", daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    
+    def stop():
+        server.should_exit = True
+        thread.join(timeout=10)
+    return f"http://127.0.0.1:{port}", main.SECRET_KEY, stop
+
+
+async def drive(base_url: str, secret_key: str, users: int, conversations: int, turns: int, label: str) -> dict:
+    token = jwt.encode(
+        {"sub": "load-user", "exp": datetime.datetime.utcnow() + datetime.timedelta(hours=1)}, secret_key, algorithm="HS256"
+    )
+    headers = {"Authorization": f"Bearer {token}"}
+    latencies = []
+    statuses = {}
+    pending = iter(range(conversations))
+    limits = httpx.Limits(max_connections=users, max_keepalive_connections=users)
+    
+    async with httpx.AsyncClient(base_url=base_url, headers=headers, limits=limits, timeout=120) as client:
+        async def user():
+            for conversation in pending:
+                chat_id = f"{label}-chat-{conversation}"
+                for turn in range(turns):
+                    message = f"Conversation {conversation} turn {turn}: how do I rotate a storage account key?"
+                    started = time.perf_counter()
+                    try:
+                        response = await client.post("/api/chat", json={"message": message, "chat_id": chat_id})
+                        status = str(response.status_code)
+                    except httpx.HTTPError as e:
+                        status = type(e).__name__
+                    latencies.append(time.perf_counter() - started)
+                    statuses[status] = statuses.get(status, 0) + 1
+        
+        started = time.perf_counter()
+        await asyncio.gather(*(user() for _ in range(users)))
+        elapsed = time.perf_counter() - started
+    
+    total = len(latencies)
+    return {
+        "requests": total,
+        "errors": total - statuses.get("200", 0),
+        "statuses": statuses,
+        "elapsed_s": round(elapsed, 3),
+        "rps": round(total / elapsed, 2),
+        "p50_ms": percentile(latencies, 0.5),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99),
+    }
+
+
+def stage_breakdown() -> dict:
+    """Stage histograms recorded while the app served the run, then reset for the next app"""
+    from telemetry import STAGE_SECONDS
+    stages = {}
+    for (name, outcome), summary in sorted(STAGE_SECONDS.summary().items()):
+        stages[name if outcome == "ok" else f"{name} ({outcome})"] = {
+            "count": summary["count"],
+            "mean_ms": round(summary["mean"] * 1000, 1),
+            **{f"{q}_le_ms": None if bound is None else round(bound * 1000, 1)
+               for q, bound in summary.items() if q.startswith("p")}
+        }
+    STAGE_SECONDS.clear()
+    return stages
+
+
+def compare(results: dict, baseline: dict, max_regression: float) -> list:
+    regressions = []
+    for app_name, result in results.items():
+        before = baseline.get("results", {}).get(app_name)
+        if not before:
+            continue
+        if result["rps"] < before["rps"] * (1 - max_regression):
+            regressions.append(f"{app_name}: rps {before['rps']} -> {result['rps']}")
+        if result["p95_ms"] > before["p95_ms"] * (1 + max_regression):
+            regressions.append(f"{app_name}: p95 {before['p95_ms']} ms -> {result['p95_ms']} ms")
+        if result["errors"] > before["errors"]:
+            regressions.append(f"{app_name}: errors {before['errors']} -> {result['errors']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end load test of POST /api/chat on the Flask and FastAPI apps, without Azure")
+    parser.add_argument("--app", choices=("flask", "fastapi", "both"), default="both")
+    parser.add_argument("--users", type=int, default=32)
+    parser.add_argument("--conversations", type=int, default=128)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--llm-delay", type=float, default=0.3)
+    parser.add_argument("--token-rate", type=float, default=200)
+    parser.add_argument("--search-delay", type=float, default=0.05)
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    parser.add_argument("--baseline", help="JSON report of an earlier run to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.15)
+    args = parser.parse_args()
+    
+    stub = StubAzureServer(llm_delay=args.llm_delay, search_delay=args.search_delay, token_rate=args.token_rate).start()
+    configure_environment(stub.endpoint)
+    logging.disable(logging.INFO)
+    
+    results, stages = {}, {}
+    apps = ("flask", "fastapi") if args.app == "both" else (args.app,)
+    # Keep stdout for the report; the apps print and log per request
+    with contextlib.redirect_stdout(sys.stderr):
+        try:
+            for app_name in apps:
+                base_url, secret_key, stop = serve_flask() if app_name == "flask" else serve_fastapi(stub.endpoint)
+                try:
+                    stage_breakdown()
+                    results[app_name] = asyncio.run(
+                        drive(base_url, secret_key, args.users, args.conversations, args.turns, app_name)
+                    )
+                    stages[app_name] = stage_breakdown()
+                finally:
+                    stop()
+        finally:
+            stub.stop()
+    
+    report = {
+        "workload": {key: getattr(args, key) for key in
+                     ("users", "conversations", "turns", "llm_delay", "token_rate", "search_delay")},
+        "results": results,
+        "stages": stages,
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["regressions"] = compare(results, json.load(f), args.max_regression)
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    if report.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# bench_local_search.py - Build time, load time and query throughput of the local search index
+#
+# Usage: python benchmarks/bench_local_search.py [--chunks 100000] [--words 80] [--threads 1 4] [--queries 500]
+#
+# Generates a synthetic corpus with a Zipf-like vocabulary (so posting lists
+# have realistic skew), builds the index into a temporary directory, then
+# times a cold LocalSearchIndex.load and hybrid queries from 1..N threads.
+import argparse
+import itertools
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from local_search import LocalSearchIndex
+
+VOCABULARY = 50000
+
+
+def make_corpus(chunks: int, words: int, seed: int = 11):
+    rng = random.Random(seed)
+    vocabulary = [f"w{i}" for i in range(VOCABULARY)]
+    cum_weights = list(itertools.accumulate(1.0 / (rank + 1) for rank in range(VOCABULARY)))
+    for i in range(chunks):
+        yield {"title": f"doc-{i // 20}.md", "chunk": " ".join(rng.choices(vocabulary, cum_weights=cum_weights, k=words))}
+
+
+def make_queries(count: int, seed: int = 13):
+    rng = random.Random(seed)
+    return [" ".join(f"w{rng.randrange(10, 5000)}" for _ in range(rng.randint(2, 6))) for _ in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build time, load time and query throughput of the local search index")
+    parser.add_argument("--chunks", type=int, default=100000)
+    parser.add_argument("--words", type=int, default=80)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--top", type=int, default=5)
+    args = parser.parse_args()
+    
+    path = tempfile.mkdtemp(prefix="bench-local-index-")
+    try:
+        started = time.perf_counter()
+        meta = LocalSearchIndex.build(make_corpus(args.chunks, args.words), path, dim=args.dim)
+        build_s = time.perf_counter() - started
+        
+        started = time.perf_counter()
+        index = LocalSearchIndex.load(path)
+        load_ms = (time.perf_counter() - started) * 1000
+        
+        queries = make_queries(args.queries)
+        index.search(queries[0], args.top)  # fault the mapped pages in once
+        
+        throughput = {}
+        for threads in args.threads:
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                list(executor.map(lambda q: index.search(q, args.top), queries))
+            elapsed = time.perf_counter() - started
+            throughput[threads] = {
+                "qps": round(len(queries) / elapsed, 1),
+                "mean_latency_ms": round(elapsed * 1000 * threads / len(queries), 2)
+            }
+        
+        size_mb = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)) / 2 ** 20
+        print(json.dumps({
+            "chunks": meta["docCount"],
+            "terms": meta["termCount"],
+            "index_mb": round(size_mb, 1),
+            "build_s": round(build_s, 1),
+            "load_ms": round(load_ms, 2),
+            "throughput_by_threads": throughput
+        }, indent=2))
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
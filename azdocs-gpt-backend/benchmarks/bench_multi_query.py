@@ -0,0 +1,127 @@
+# bench_multi_query.py - Latency of multi-query retrieval: sequential searches vs. concurrent fan-out with RRF
+#
+# Usage: python benchmarks/bench_multi_query.py [--queries 1 2 3 4] [--search-delay 0.15] [--rounds 5]
+#
+# Search clients are replaced by in-process fakes that sleep for the injected
+# delay, so the numbers isolate the retrieval fan-out from Azure latency.
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from services import AzureSearchService, reciprocal_rank_fusion
+
+TOP = 5
+
+
+def fake_results(query: str, top: int):
+    # Neighbouring queries share half their chunks so fusion has duplicates to merge
+    base = sum(ord(c) for c in query) % 7
+    return [{"title": f"doc-{base + i}.md", "chunk": f"chunk {base + i} " * 40} for i in range(top)]
+
+
+class FakeSearchClient:
+    def __init__(self, delay: float):
+        self.delay = delay
+    
+    def search(self, search_text: str, top: int, **kwargs):
+        time.sleep(self.delay)
+        return fake_results(search_text, top)
+
+
+class FakeAsyncSearchClient:
+    def __init__(self, delay: float):
+        self.delay = delay
+    
+    async def search(self, search_text: str, top: int, **kwargs):
+        await asyncio.sleep(self.delay)
+        
+        async def results():
+            for result in fake_results(search_text, top):
+                yield result
+        return results()
+
+
+def make_service(delay: float) -> AzureSearchService:
+    service = AzureSearchService.__new__(AzureSearchService)
+    service.client = FakeSearchClient(delay)
+    service.semantic_config = "bench"
+    service.results_count = TOP
+    service.select = "title,chunk"
+    service.rrf_k = 60
+    service.max_parallel_queries = 4
+    service.executor = ThreadPoolExecutor(max_workers=4)
+    service.cache = None
+    service.packer = None
+    service.embedding_service = None
+    return service
+
+
+def mean_ms(fn, rounds: int) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return round((time.perf_counter() - started) * 1000 / rounds, 1)
+
+
+async def async_mean_ms(fn, rounds: int) -> float:
+    started = time.perf_counter()
+    for _ in range(rounds):
+        await fn()
+    return round((time.perf_counter() - started) * 1000 / rounds, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency of multi-query retrieval: sequential searches vs. concurrent fan-out with RRF")
+    parser.add_argument("--queries", type=int, nargs="+", default=[1, 2, 3, 4])
+    parser.add_argument("--search-delay", type=float, default=0.15)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--skip-async", action="store_true", help="Skip the FastAPI (main.py) pipeline")
+    args = parser.parse_args()
+    
+    service = make_service(args.search_delay)
+    results = {}
+    for n in args.queries:
+        queries = [f"azure storage topic {i}" for i in range(n)]
+        
+        def sequential():
+            lists = [service.search(q)[1] for q in queries]
+            return reciprocal_rank_fusion(lists, TOP)
+        
+        results[n] = {
+            "flask_sequential_ms": mean_ms(sequential, args.rounds),
+            "flask_concurrent_ms": mean_ms(lambda: service.search_many(queries), args.rounds),
+        }
+    
+    if not args.skip_async:
+        import main as fastapi_main
+        fastapi_main.clients.search = FakeAsyncSearchClient(args.search_delay)
+        
+        async def run_async():
+            for n in args.queries:
+                queries = [f"azure storage topic {i}" for i in range(n)]
+                
+                async def sequential():
+                    fastapi_main.search_cache.clear()
+                    lists = [(await fastapi_main.search_azure(q))[1] for q in queries]
+                    return reciprocal_rank_fusion(lists, TOP)
+                
+                async def concurrent():
+                    fastapi_main.search_cache.clear()
+                    return await fastapi_main.retrieve(queries)
+                
+                results[n]["fastapi_sequential_ms"] = await async_mean_ms(sequential, args.rounds)
+                results[n]["fastapi_concurrent_ms"] = await async_mean_ms(concurrent, args.rounds)
+        
+        asyncio.run(run_async())
+    
+    print(json.dumps({"search_delay_s": args.search_delay, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+# bench_openai_governor.py - 429s, failures and per-user latency with and without the OpenAI rate governor
+#
+# Usage: python benchmarks/bench_openai_governor.py [--requests 150] [--tpm 600000] [--rpm 6000] [--llm-delay 0.2]
+#
+# Every request is an answer completion sent at once against a local
+# StubAzureServer that enforces a TPM/RPM quota and answers 429 with
+# retry-after when it is spent. One "heavy" user sends most of the burst, a
+# few "light" users the rest (after the heavy user's requests), which shows
+# whether light users are stuck behind the heavy one.
+#
+# "sdk_retries" is the SDK on its own (its default retries honour
+# retry-after); "governed" adds OpenAIGovernor with the SDK retries off.
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from openai import AzureOpenAI
+
+from governor import OpenAIGovernor, estimate_tokens
+from stubs import StubAzureServer
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return round(values[max(0, int(len(values) * fraction) - 1)], 2) if values else None
+
+
+def run(server: StubAzureServer, requests: int, light_share: float, governor=None):
+    client = AzureOpenAI(api_version="2023-03-15-preview", azure_endpoint=server.endpoint, api_key="stub")
+    chat = client.with_options(max_retries=0).chat if governor else client.chat
+    light = int(requests * light_share)
+    users = ["heavy"] * (requests - light) + [f"light-{i % 5}" for i in range(light)]
+    latencies = {"heavy": [], "light": []}
+    failures = []
+    lock = threading.Lock()
+    throttled_before = server.throttled
+    
+    def one(user):
+        messages = [{"role": "system", "content": "prompt"}, {"role": "user", "content": f"question from {user}"}]
+        create = lambda: chat.completions.create(model="stub", messages=messages)
+        started = time.perf_counter()
+        try:
+            if governor:
+                governor.call(create, estimate_tokens(messages, 500), user)
+            else:
+                create()
+        except Exception as e:
+            with lock:
+                failures.append(type(e).__name__)
+            return
+        with lock:
+            latencies["heavy" if user == "heavy" else "light"].append(time.perf_counter() - started)
+    
+    started = time.perf_counter()
+    threads = [threading.Thread(target=one, args=(user,)) for user in users]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.001)  # keep submission order (heavy first) roughly intact
+    for thread in threads:
+        thread.join()
+    result = {
+        "wall_s": round(time.perf_counter() - started, 2),
+        "succeeded": len(latencies["heavy"]) + len(latencies["light"]),
+        "failed": len(failures),
+        "http_429s": server.throttled - throttled_before,
+        "heavy_p50_s": percentile(latencies["heavy"], 0.5),
+        "light_p50_s": percentile(latencies["light"], 0.5),
+        "light_p95_s": percentile(latencies["light"], 0.95),
+    }
+    if governor:
+        result["governor"] = governor.stats()
+    client.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="429s, failures and per-user latency with and without the OpenAI rate governor")
+    parser.add_argument("--requests", type=int, default=150)
+    parser.add_argument("--light-share", type=float, default=0.2)
+    parser.add_argument("--tpm", type=int, default=600000)
+    parser.add_argument("--rpm", type=int, default=6000)
+    parser.add_argument("--llm-delay", type=float, default=0.2)
+    parser.add_argument("--concurrency", type=int, default=16)
+    args = parser.parse_args()
+    
+    results = {}
+    for label in ("sdk_retries", "governed"):
+        # A fresh server per run so each starts with the full quota
+        server = StubAzureServer(llm_delay=args.llm_delay, tokens_per_minute=args.tpm, requests_per_minute=args.rpm).start()
+        governor = OpenAIGovernor(args.tpm, args.rpm, max_concurrency=args.concurrency, max_queue=args.requests,
+                                  max_wait_seconds=120, max_retries=4) if label == "governed" else None
+        try:
+            results[label] = run(server, args.requests, args.light_share, governor)
+        finally:
+            server.stop()
+    print(json.dumps({"requests": args.requests, "tpm": args.tpm, "rpm": args.rpm, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
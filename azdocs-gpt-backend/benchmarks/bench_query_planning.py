@@ -0,0 +1,74 @@
+# bench_query_planning.py - Compare end-to-end latency and token usage of the query-planning strategies
+#
+# Usage: python benchmarks/bench_query_planning.py [--fixtures benchmarks/fixtures/query_planning_turns.json]
+#
+# Replays recorded turns: LLM calls and searches are charged their recorded
+# latency and token usage, while local planning is timed for real. A turn
+# planned locally skips the query-generation completion; turns the planner
+# hands back to the model cost the same as before.
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from services import QueryPlanner
+
+DEFAULT_FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "query_planning_turns.json")
+
+
+def replay(turns, strategy: str) -> dict:
+    planner = QueryPlanner(strategy)
+    totals = {"latency_ms": 0.0, "prompt_tokens": 0, "completion_tokens": 0, "llm_calls": 0, "planned_locally": 0}
+    queries = []
+    
+    for turn in turns:
+        recorded = turn["recorded"]
+        started = time.perf_counter()
+        planned = planner.plan_locally(turn["history"], turn["message"])
+        totals["latency_ms"] += (time.perf_counter() - started) * 1000
+        
+        if planned:
+            totals["planned_locally"] += 1
+            query = planned[0]
+        else:
+            generation = recorded["query_generation"]
+            totals["latency_ms"] += generation["latency_ms"]
+            totals["prompt_tokens"] += generation["prompt_tokens"]
+            totals["completion_tokens"] += generation["completion_tokens"]
+            totals["llm_calls"] += 1
+            query = generation["query"]
+        queries.append({"message": turn["message"], "query": query})
+        
+        # The recorded search/answer cost applies whenever a search query exists
+        if query and "answer" in recorded:
+            totals["latency_ms"] += recorded["search"]["latency_ms"] + recorded["answer"]["latency_ms"]
+            totals["prompt_tokens"] += recorded["answer"]["prompt_tokens"]
+            totals["completion_tokens"] += recorded["answer"]["completion_tokens"]
+            totals["llm_calls"] += 1
+    
+    totals["latency_ms"] = round(totals["latency_ms"], 2)
+    totals["mean_latency_ms"] = round(totals["latency_ms"] / len(turns), 2)
+    return {"totals": totals, "queries": queries}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare end-to-end latency and token usage of the query-planning strategies")
+    parser.add_argument("--fixtures", default=DEFAULT_FIXTURES)
+    parser.add_argument("--show-queries", action="store_true")
+    args = parser.parse_args()
+    
+    with open(args.fixtures) as f:
+        turns = json.load(f)["turns"]
+    
+    results = {}
+    for strategy in ("llm", "local", "auto"):
+        result = replay(turns, strategy)
+        results[strategy] = result if args.show_queries else result["totals"]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
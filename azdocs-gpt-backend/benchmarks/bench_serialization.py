@@ -0,0 +1,123 @@
+# bench_serialization.py - Encode time and bytes on the wire of chat responses, per encoder and compression
+#
+# Usage: python benchmarks/bench_serialization.py [--turns 10 100 500] [--repeat 20]
+#
+# Builds a chat of --turns turns (each answer cites 5 chunks of ~1 KB) and
+# times producing the GET /api/chats/<id> response body each way the apps
+# can: "flask_default" is jsonify with Flask's stock provider (stdlib json,
+# sorted keys), "fastapi_default" is FastAPI's jsonable_encoder plus
+# JSONResponse, and "flask_fast"/"fastapi_fast" are FastJSONProvider and
+# FastJSONResponse over serialization (orjson when installed). "decode"
+# times parsing the body back with each codec. "wire" compares the raw body
+# with gzip at the default level 1 and at level 6, and brotli when installed.
+# Times are medians over --repeat runs.
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+from models import ChatMessage, Reference, build_chat_header, chat_to_api, now_ms
+from serialization import HAS_BROTLI, Compressor, JSONCodec
+import serialization
+from utils import FastJSONProvider
+
+
+WORDS = ("account", "storage", "key", "rotate", "regenerate", "secondary", "primary", "client", "connection", "string",
+         "vault", "secret", "policy", "access", "role", "assignment", "identity", "managed", "endpoint", "network",
+         "firewall", "private", "link", "blob", "container", "queue", "table", "share", "replication", "region",
+         "the", "a", "to", "and", "of", "in", "for", "with", "after", "before", "then", "your", "each", "when")
+
+
+def prose(rng: random.Random, words: int) -> str:
+    """Documentation-like text: no long repeats, so compression ratios resemble real chunks"""
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def build_chat(turns: int) -> dict:
+    rng = random.Random(turns)
+    chunks = [Reference(f"docs/storage/account-keys-{i}.md", prose(rng, 170)) for i in range(40)]
+    messages = []
+    for turn in range(turns):
+        timestamp = now_ms()
+        messages.append(ChatMessage(2 * turn + 1, "user", prose(rng, 12), timestamp))
+        messages.append(ChatMessage(2 * turn + 2, "bot", prose(rng, 140), timestamp,
+                                    references=tuple(chunks[(turn * 3 + i) % len(chunks)] for i in range(5))))
+    header = build_chat_header("bench-user", "bench-chat", "Key rotation", len(messages))
+    header["_etag"] = '"00000000-0000-0000-0000-000000000000"'
+    return dict(header, messages=messages)
+
+
+def median_ms(repeat: int, fn):
+    timings, result = [], None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - started)
+    return round(statistics.median(timings) * 1000, 3), result
+
+
+class FastJSONResponse(JSONResponse):
+    """Same as main.FastJSONResponse, without importing main.py's clients"""
+    
+    def render(self, content) -> bytes:
+        return serialization.dumps(content)
+
+
+def run(turns: int, repeat: int) -> dict:
+    chat = build_chat(turns)
+    flask_app = Flask("bench")
+    stock, fast = DefaultJSONProvider(flask_app), FastJSONProvider(flask_app)
+    
+    to_api_ms, payload = median_ms(repeat, lambda: chat_to_api(chat))
+    encoders = {
+        "flask_default": lambda: stock.response(chat_to_api(chat)).get_data(),
+        "flask_fast": lambda: fast.response(chat_to_api(chat)).get_data(),
+        "fastapi_default": lambda: JSONResponse(jsonable_encoder(chat_to_api(chat))).body,
+        "fastapi_fast": lambda: FastJSONResponse(chat_to_api(chat)).body,
+    }
+    encode = {}
+    body = b""
+    for name, encoder in encoders.items():
+        ms, body = median_ms(repeat, encoder)
+        encode[name] = {"ms": ms, "bytes": len(body)}
+    
+    decode = {}
+    for name in ("json", "orjson"):
+        codec = JSONCodec(name)
+        if codec.name == name:
+            decode[name] = {"ms": median_ms(repeat, lambda: codec.loads(body))[0]}
+    
+    wire = {"identity": {"bytes": len(body)}}
+    variants = [("gzip-1", "gzip", Compressor(gzip_level=1)), ("gzip-6", "gzip", Compressor(gzip_level=6))]
+    if HAS_BROTLI:
+        variants.append(("br-4", "br", Compressor(brotli_quality=4)))
+    for name, encoding, compressor in variants:
+        ms, compressed = median_ms(repeat, lambda: compressor.compress(body, encoding))
+        wire[name] = {"bytes": len(compressed), "ms": ms, "ratio": round(len(body) / len(compressed), 1)}
+    
+    return {"messages": len(payload["messages"]), "to_api_ms": to_api_ms, "encode": encode, "decode": decode, "wire": wire}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Encode time and bytes on the wire of chat responses, per encoder and compression")
+    parser.add_argument("--turns", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    
+    report = {"encoder": JSONCodec().name, "brotli": HAS_BROTLI}
+    report.update({str(turns): run(turns, args.repeat) for turns in args.turns})
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
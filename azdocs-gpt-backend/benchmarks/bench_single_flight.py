@@ -0,0 +1,87 @@
+# bench_single_flight.py - Upstream calls for a burst of identical questions, with and without coalescing
+#
+# Usage: python benchmarks/bench_single_flight.py [--requests 200] [--concurrency 64] [--distinct 5] [--call-delay 0.5]
+#
+# Each request runs the chat pipeline's two stages (retrieve, then answer)
+# against a fake upstream that sleeps for --call-delay per call. Requests
+# draw from a few distinct questions, as when a popular doc question trends;
+# "upstream_calls" is what would have been sent to OpenAI and Search.
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from cache import SingleFlight
+from services import AnswerCache
+
+
+class FakeUpstream:
+    def __init__(self, call_delay: float):
+        self.call_delay = call_delay
+        self.calls = 0
+        self._lock = threading.Lock()
+    
+    def call(self, result):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.call_delay)
+        return result
+
+
+def run(questions, concurrency: int, upstream: FakeUpstream, single_flight=None):
+    latencies = []
+    
+    def stage(name, key, fn):
+        return single_flight.do(f"{name}:{key}", fn) if single_flight else fn()
+    
+    def one(question):
+        started = time.perf_counter()
+        messages = [{"role": "system", "content": "prompt"}, {"role": "user", "content": question}]
+        key = AnswerCache.turn_key(messages)
+        references = stage("retrieve", key, lambda: upstream.call([question]))
+        stage("answer", key, lambda: upstream.call(f"answer to {references[0]}"))
+        latencies.append((time.perf_counter() - started) * 1000)
+    
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, questions))
+    latencies.sort()
+    return {
+        "wall_s": round(time.perf_counter() - started, 2),
+        "p50_ms": round(latencies[len(latencies) // 2], 1),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1], 1),
+        "upstream_calls": upstream.calls,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Upstream calls for a burst of identical questions, with and without coalescing")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--distinct", type=int, default=5)
+    parser.add_argument("--call-delay", type=float, default=0.5)
+    args = parser.parse_args()
+    
+    rng = random.Random(7)
+    # Case and punctuation differ between users; the turn key normalizes them away
+    variants = ["How do I {}?", "how do i {}", "How do I {} ?!"]
+    questions = [
+        rng.choice(variants).format(f"rotate storage account key {rng.randrange(args.distinct)}")
+        for _ in range(args.requests)
+    ]
+    
+    results = {"independent": run(questions, args.concurrency, FakeUpstream(args.call_delay))}
+    single_flight = SingleFlight()
+    results["coalesced"] = run(questions, args.concurrency, FakeUpstream(args.call_delay), single_flight)
+    results["coalesced"]["single_flight"] = single_flight.stats()
+    print(json.dumps({"requests": args.requests, "distinct_questions": args.distinct, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+# bench_startup.py - Worker start time with eager vs lazy dependency setup, and the slowest imports
+#
+# Usage: python benchmarks/bench_startup.py [--app app|main] [--dependency-delay 2.0] [--runs 3]
+#
+# Each run is a fresh interpreter that imports the backend (app.py runs
+# create_app() at import; for main.py the lifespan is entered too) with
+# Cosmos DB, OpenAI and AI Search pointed at a local server that answers
+# every request after --dependency-delay seconds with a 503, i.e. a slow,
+# struggling dependency.
+#
+# "eager" sets COSMOS_AUTO_PROVISION, which restores the old behaviour of
+# creating the database and container before serving; "lazy" is the default
+# (clients connect on first use, warm-up runs in the background). The
+# "slowest_imports" list comes from python -X importtime on the lazy run.
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+CHILD = r"""
+import asyncio, json, sys, time
+started = time.perf_counter()
+result = {}
+try:
+    module = __import__(sys.argv[1])
+    result["import_s"] = round(time.perf_counter() - started, 3)
+    if sys.argv[1] == "main":
+        async def enter_lifespan():
+            async with module.lifespan(module.app):
+                result["serving_s"] = round(time.perf_counter() - started, 3)
+        asyncio.run(enter_lifespan())
+    else:
+        result["serving_s"] = result["import_s"]
+    result["ok"] = True
+except Exception as e:
+    result.update(ok=False, failed_after_s=round(time.perf_counter() - started, 3), error=type(e).__name__)
+print("RESULT " + json.dumps(result))
+"""
+
+
+class SlowDependency(BaseHTTPRequestHandler):
+    delay = 2.0
+    
+    def _reply(self):
+        time.sleep(self.delay)
+        body = b'{"code": "ServiceUnavailable", "message": "stub"}'
+        self.send_response(503)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    do_GET = do_POST = do_PUT = _reply
+    
+    def log_message(self, *args):
+        pass
+
+
+def stub_settings(endpoint: str, eager: bool) -> dict:
+    """Every setting the apps need to start, with all services pointed at the slow stub"""
+    return {
+        "COSMOS_ENDPOINT": endpoint,
+        "COSMOS_KEY": "c3R1Yg==",
+        "COSMOS_AUTO_PROVISION": str(eager).lower(),
+        "AZURE_OPENAI_ENDPOINT": endpoint,
+        "AZURE_OPENAI_KEY": "stub",
+        "AZURE_OPENAI_DEPLOYMENT": "stub-chat",
+        "AZURE_SEARCH_ENDPOINT": endpoint,
+        "AZURE_SEARCH_KEY": "stub",
+        "AZURE_SEARCH_INDEX": "stub-index",
+        "AZURE_AD_TENANT_ID": "00000000-0000-0000-0000-000000000000",
+        "AZURE_AD_CLIENT_ID": "00000000-0000-0000-0000-000000000000",
+        "AZURE_AD_CLIENT_SECRET": "stub",
+        "AZURE_AD_SCOPE": "User.Read",
+        "REDIRECT_URI": "http://localhost:5000/getAToken",
+        "FLASK_SECRET_KEY": "stub",
+    }
+
+
+def run_child(app: str, endpoint: str, eager: bool, importtime: bool = False):
+    env = dict(os.environ)
+    # app.py reads APPSETTING_-prefixed names, main.py unprefixed ones
+    for name, value in stub_settings(endpoint, eager).items():
+        env[name] = value
+        env[f"APPSETTING_{name}"] = value
+    env["WARMUP_ON_START"] = env["APPSETTING_WARMUP_ON_START"] = "false"
+    args = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", CHILD, app]
+    completed = subprocess.run(args, cwd=BACKEND_DIR, env=env, capture_output=True, text=True, timeout=600)
+    lines = [line for line in completed.stdout.splitlines() if line.startswith("RESULT ")]
+    result = json.loads(lines[-1][len("RESULT "):]) if lines else {"ok": False, "error": completed.stderr[-300:]}
+    return result, completed.stderr
+
+
+def slowest_imports(stderr: str, count: int = 10):
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Nested imports are indented under their importer; keep the top-level ones
+        if not name[1:].startswith(" "):
+            imports.append((int(cumulative), name.strip()))
+    return [{"module": name, "ms": round(us / 1000, 1)} for us, name in sorted(imports, reverse=True)[:count]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Worker start time with eager vs lazy dependency setup, and the slowest imports")
+    parser.add_argument("--app", choices=("app", "main"), default="app")
+    parser.add_argument("--dependency-delay", type=float, default=2.0)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+    
+    SlowDependency.delay = args.dependency_delay
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowDependency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = f"http://127.0.0.1:{server.server_address[1]}/"
+    
+    results = {}
+    try:
+        for label, eager in (("eager", True), ("lazy", False)):
+            results[label] = [run_child(args.app, endpoint, eager)[0] for _ in range(args.runs)]
+        _, stderr = run_child(args.app, endpoint, False, importtime=True)
+        results["slowest_imports"] = slowest_imports(stderr)
+    finally:
+        server.shutdown()
+    print(json.dumps({"app": args.app, "dependency_delay_s": args.dependency_delay, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,509 @@
+# stubs.py - Local stand-ins for Azure OpenAI, Azure AI Search and Cosmos DB used by the benchmarks
+import asyncio
+import json
+import math
+import re
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+
+class StubAzureServer:
+    """Minimal HTTP/1.1 server emulating the Azure OpenAI and Azure AI Search REST APIs.
+    
+    Chat completion requests that offer tools get a ``search`` tool call back,
+    other completions get a canned answer (streamed when ``stream`` is set).
+    Search requests return ``results_count`` fixed documents. Each route sleeps
+    for its configured delay so the benchmarks can model upstream latency;
+    with ``token_rate`` set, completions also take as long as generating
+    their completion tokens at that many tokens per second (streamed chunks
+    are paced accordingly).
+    
+    With ``tokens_per_minute``/``requests_per_minute`` set, completions are
+    charged against a deployment quota the way Azure OpenAI enforces it (over
+    10-second windows, charging the tokens reported in ``usage``) and
+    answered with 429 and ``retry-after-ms``/``retry-after`` once it is spent.
+    """
+    
+    def __init__(self, llm_delay: float = 0.5, search_delay: float = 0.1, results_count: int = 5,
+                 host: str = "127.0.0.1", port: int = 0, tokens_per_minute: int = 0, requests_per_minute: int = 0,
+                 token_rate: float = 0):
+        self.llm_delay = llm_delay
+        self.token_rate = token_rate
+        self.search_delay = search_delay
+        self.results_count = results_count
+        self.host = host
+        self.port = port
+        self.requests_served = 0
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self.throttled = 0
+        self.completions = 0
+        self._quota = {"tokens": tokens_per_minute / 6, "requests": requests_per_minute / 6, "updated": time.monotonic()}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server = None
+        self._thread: Optional[threading.Thread] = None
+    
+    @property
+    def endpoint(self) -> str:
+        return f"http://{self.host}:{self.port}"
+    
+    def start(self) -> "StubAzureServer":
+        """Start serving on a background event loop thread"""
+        ready = threading.Event()
+        
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._handle, self.host, self.port, backlog=2048)
+            )
+            self.port = self._server.sockets[0].getsockname()[1]
+            ready.set()
+            self._loop.run_forever()
+        
+        self._thread = threading.Thread(target=run, name="stub-azure-server", daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+    
+    def stop(self):
+        if self._loop is None:
+            return
+        
+        async def shutdown():
+            # Close open keep-alive connections while the loop still runs
+            self._server.close()
+            handlers = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in handlers:
+                task.cancel()
+            await asyncio.gather(*handlers, return_exceptions=True)
+        
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result(timeout=5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+    
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                lines = head.decode("latin-1").split("\r\n")
+                method, target, _ = lines[0].split(" ", 2)
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        key, value = line.split(":", 1)
+                        headers[key.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                body = await reader.readexactly(length) if length else b""
+                
+                self.requests_served += 1
+                await self._dispatch(method, target, body, writer)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+    
+    async def _dispatch(self, method: str, target: str, body: bytes, writer: asyncio.StreamWriter):
+        path = target.split("?", 1)[0]
+        payload = json.loads(body) if body else {}
+        
+        if path.endswith("/chat/completions"):
+            retry_after = self._charge_quota(self.completion_tokens(payload))
+            if retry_after:
+                self.throttled += 1
+                self._write_json(writer, 429, {"error": {
+                    "code": "429",
+                    "message": "Requests to the ChatCompletions_Create Operation have exceeded the token rate limit."
+                }}, {"retry-after-ms": int(retry_after * 1000), "retry-after": math.ceil(retry_after)})
+                return
+            self.completions += 1
+            await asyncio.sleep(self.llm_delay)
+            if payload.get("stream"):
+                await self._write_stream(writer, self.answer_chunks(), self.generation_seconds(120))
+            else:
+                completion = self.tool_call_completion(payload["messages"]) if payload.get("tools") else self.answer_completion()
+                await asyncio.sleep(self.generation_seconds(completion["usage"]["completion_tokens"]))
+                self._write_json(writer, 200, completion)
+        elif "docs/$count" in path:
+            body = str(self.results_count).encode()
+            writer.write(f"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: {len(body)}\r\n"
+                         f"Connection: keep-alive\r\n\r\n".encode() + body)
+        elif "docs/search" in path:
+            await asyncio.sleep(self.search_delay)
+            self._write_json(writer, 200, self.search_results(payload.get("search", "")))
+        else:
+            self._write_json(writer, 404, {"error": {"code": "NotFound", "message": path}})
+    
+    @staticmethod
+    def completion_tokens(payload: Dict) -> int:
+        """Tokens the stub reports (and charges) for a completion request"""
+        return 270 if payload.get("tools") else 1320
+    
+    def _charge_quota(self, tokens: int) -> float:
+        """Charge one request; returns 0 if admitted, else the seconds until it would be"""
+        if not self.tokens_per_minute and not self.requests_per_minute:
+            return 0.0
+        now = time.monotonic()
+        quota = self._quota
+        elapsed = now - quota["updated"]
+        quota["updated"] = now
+        waits = []
+        for key, limit, amount in (("tokens", self.tokens_per_minute, tokens), ("requests", self.requests_per_minute, 1)):
+            if not limit:
+                continue
+            quota[key] = min(limit / 6, quota[key] + elapsed * limit / 60)
+            if quota[key] < min(amount, limit / 6):
+                waits.append((min(amount, limit / 6) - quota[key]) / (limit / 60))
+        if waits:
+            return max(waits)
+        if self.tokens_per_minute:
+            quota["tokens"] -= tokens
+        if self.requests_per_minute:
+            quota["requests"] -= 1
+        return 0.0
+    
+    @staticmethod
+    def _write_json(writer: asyncio.StreamWriter, status: int, data: Dict, headers: Optional[Dict] = None):
+        body = json.dumps(data).encode()
+        extra = "".join(f"{key}: {value}\r\n" for key, value in (headers or {}).items())
+        writer.write(
+            f"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+            f"{extra}Connection: keep-alive\r\n\r\n".encode() + body
+        )
+    
+    def generation_seconds(self, completion_tokens: int) -> float:
+        return completion_tokens / self.token_rate if self.token_rate else 0.0
+    
+    @staticmethod
+    async def _write_stream(writer: asyncio.StreamWriter, chunks: List[Dict], duration: float = 0.0):
+        events = [f"data: {json.dumps(chunk)}\n\n".encode() for chunk in chunks] + [b"data: [DONE]\n\n"]
+        writer.write(
+            f"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nContent-Length: {sum(map(len, events))}\r\n"
+            f"Connection: keep-alive\r\n\r\n".encode()
+        )
+        for event in events:
+            writer.write(event)
+            if duration:
+                await writer.drain()
+                await asyncio.sleep(duration / len(events))
+    
+    @staticmethod
+    def tool_call_completion(messages: List[Dict]) -> Dict:
+        question = messages[-1].get("content", "") if messages else ""
+        return {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": 0,
+            "model": "stub",
+            "choices": [{
+                "index": 0,
+                "finish_reason": "tool_calls",
+                "message": {
+                    "role": "assistant",
+                    "content": None,
+                    "tool_calls": [{
+                        "id": "call_stub",
+                        "type": "function",
+                        "function": {"name": "search", "arguments": json.dumps({"query": question[:200]})}
+                    }]
+                }
+            }],
+            "usage": {"prompt_tokens": 250, "completion_tokens": 20, "total_tokens": 270}
+        }
+    
+    @staticmethod
+    def answer_completion() -> Dict:
+        return {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": 0,
+            "model": "stub",
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": "Stub answer grounded in [stub-doc-0.md]."}
+            }],
+            "usage": {"prompt_tokens": 1200, "completion_tokens": 120, "total_tokens": 1320}
+        }
+    
+    @staticmethod
+    def answer_chunks() -> List[Dict]:
+        words = "Stub answer grounded in [stub-doc-0.md].".split(" ")
+        return [{
+            "id": "chatcmpl-stub",
+            "object": "chat.completion.chunk",
+            "created": 0,
+            "model": "stub",
+            "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]
+        } for word in words]
+    
+    def search_results(self, query: str) -> Dict:
+        return {
+            "value": [{
+                "@search.score": 1.0 / (i + 1),
+                "@search.rerankerScore": 3.0 - i * 0.1,
+                "title": f"stub-doc-{i}.md",
+                "chunk": f"Documentation chunk {i} about {query}. " * 20
+            } for i in range(self.results_count)]
+        }
+
+
+def estimate_request_charge(operation: str, size_bytes: int) -> float:
+    """Rough Cosmos DB RU model: writes ~5.7 RU/KB, point reads 1 RU/KB, queries 2.3 RU + 1 RU/KB returned"""
+    kb = max(1.0, size_bytes / 1024)
+    if operation == "write":
+        return round(5.7 * kb, 2)
+    if operation == "read":
+        return round(1.0 * kb, 2)
+    return round(2.3 + size_bytes / 1024, 2)
+
+
+class _Page(list):
+    pass
+
+
+class _QueryResult:
+    """Iterable query result supporting ``by_page`` with offset continuation tokens"""
+    
+    def __init__(self, items: List[Dict], page_size: Optional[int]):
+        self.items = items
+        self.page_size = page_size or len(items) or 1
+    
+    def __iter__(self):
+        return iter(self.items)
+    
+    def by_page(self, continuation_token: Optional[str] = None):
+        return _Pager(self.items, self.page_size, int(continuation_token or 0))
+
+
+class _Pager:
+    def __init__(self, items: List[Dict], page_size: int, offset: int):
+        self.items = items
+        self.page_size = page_size
+        self.offset = offset
+        self.continuation_token: Optional[str] = None
+    
+    def __iter__(self):
+        return self
+    
+    def __next__(self) -> _Page:
+        if self.offset >= len(self.items) and self.offset > 0:
+            raise StopIteration
+        page = _Page(self.items[self.offset:self.offset + self.page_size])
+        self.offset += self.page_size
+        self.continuation_token = str(self.offset) if self.offset < len(self.items) else None
+        return page
+
+
+class InMemoryContainer:
+    """In-memory stand-in for a Cosmos DB container.
+    
+    It understands the query shapes issued by models.py (partition-scoped
+    filters on userId/id/chatId/type/seq plus ORDER BY) rather than Cosmos SQL
+    in general, and keeps running totals of bytes written and estimated RUs.
+    """
+    
+    def __init__(self):
+        self.items: Dict[tuple, Dict] = {}
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.request_charge = 0.0
+        self.operations = 0
+        self._lock = threading.Lock()
+    
+    def _charge(self, operation: str, size: int) -> float:
+        charge = estimate_request_charge(operation, size)
+        self.operations += 1
+        self.request_charge += charge
+        if operation == "write":
+            self.bytes_written += size
+        else:
+            self.bytes_read += size
+        return charge
+    
+    @staticmethod
+    def _respond(kwargs: Dict, charge: float, result):
+        """Invoke the caller's response_hook the way the SDK does, with the request charge header"""
+        hook = kwargs.get("response_hook")
+        if hook:
+            hook({"x-ms-request-charge": str(charge)}, result)
+        return result
+    
+    def _put(self, body: Dict) -> Dict:
+        encoded = json.dumps(body)
+        stored = json.loads(encoded)
+        stored["_etag"] = f'"{uuid.uuid4()}"'
+        stored["_ts"] = int(time.time())
+        self.items[(body["userId"], body["id"])] = stored
+        self._charge("write", len(encoded))
+        return dict(stored)
+    
+    def upsert_item(self, body: Dict, **kwargs) -> Dict:
+        with self._lock:
+            return self._put(body)
+    
+    def create_item(self, body: Dict, **kwargs) -> Dict:
+        from azure.cosmos.exceptions import CosmosResourceExistsError
+        with self._lock:
+            if (body["userId"], body["id"]) in self.items:
+                raise CosmosResourceExistsError(status_code=409, message="Conflict")
+            return self._put(body)
+    
+    def read_item(self, item: str, partition_key: str, **kwargs) -> Dict:
+        from azure.cosmos.exceptions import CosmosResourceNotFoundError
+        with self._lock:
+            stored = self.items.get((partition_key, item))
+            if stored is None:
+                self._charge("read", 0)
+                raise CosmosResourceNotFoundError(status_code=404, message="Not found")
+            charge = self._charge("read", len(json.dumps(stored)))
+            return self._respond(kwargs, charge, json.loads(json.dumps(stored)))
+    
+    def delete_item(self, item: str, partition_key: str, **kwargs):
+        with self._lock:
+            self.items.pop((partition_key, item), None)
+            self._charge("write", 0)
+    
+    def execute_item_batch(self, batch_operations: List[tuple], partition_key: str, **kwargs) -> List[Dict]:
+        """All-or-nothing like a transactional batch: preconditions are checked before any write"""
+        from azure.cosmos.exceptions import CosmosAccessConditionFailedError, CosmosResourceExistsError
+        results = []
+        with self._lock:
+            for operation in batch_operations:
+                name, args = operation[0], operation[1]
+                options = operation[2] if len(operation) > 2 else {}
+                body = args[-1] if name in ("upsert", "create", "replace") else None
+                current = self.items.get((partition_key, body["id"] if body else args[0]))
+                if name == "create" and current is not None:
+                    raise CosmosResourceExistsError(status_code=409, message="Conflict")
+                etag = options.get("if_match_etag")
+                if etag and (current is None or current["_etag"] != etag):
+                    raise CosmosAccessConditionFailedError(status_code=412, message="Precondition failed")
+            
+            charge = 0.0
+            for operation in batch_operations:
+                name, args = operation[0], operation[1]
+                if name in ("upsert", "create", "replace"):
+                    before = self.request_charge
+                    stored = self._put(args[-1])
+                    charge += self.request_charge - before
+                    results.append({"statusCode": 200, "eTag": stored["_etag"], "resourceBody": stored})
+                elif name == "delete":
+                    self.items.pop((partition_key, args[0]), None)
+                    results.append({"statusCode": 204})
+        return self._respond(kwargs, charge, results)
+    
+    def query_items(self, query: str, parameters: Optional[List[Dict]] = None, partition_key: Optional[str] = None,
+                    max_item_count: Optional[int] = None, **kwargs) -> _QueryResult:
+        params = {p["name"]: p["value"] for p in parameters or []}
+        with self._lock:
+            candidates = [item for (pk, _), item in self.items.items() if partition_key is None or pk == partition_key]
+            results = [json.loads(json.dumps(item)) for item in candidates if self._matches(item, query, params)]
+            if "ORDER BY c.seq" in query:
+                results.sort(key=lambda item: item.get("seq", 0))
+            elif "ORDER BY c.lastUpdated DESC" in query:
+                results.sort(key=lambda item: item.get("lastUpdated", ""), reverse=True)
+            results = [self._project(item, query) for item in results]
+            charge = self._charge("query", sum(len(json.dumps(item)) for item in results))
+        return self._respond(kwargs, charge, _QueryResult(results, max_item_count))
+    
+    @staticmethod
+    def _matches(item: Dict, query: str, params: Dict) -> bool:
+        if "@userId" in params and item.get("userId") != params["@userId"]:
+            return False
+        types = re.findall(r"c\.type = '(\w+)'", query)
+        if types and item.get("type", "chat") not in types:
+            return False
+        if "c.id = @chatId" in query and item.get("id") != params["@chatId"]:
+            return False
+        if "c.chatId = @chatId" in query and item.get("chatId") != params["@chatId"]:
+            return False
+        if "c.seq <= @messageCount" in query and item.get("seq", 0) > params["@messageCount"]:
+            return False
+        if "IS_DEFINED(c.messages)" in query and "messages" not in item:
+            return False
+        if "NOT IS_DEFINED(c.v)" in query and "v" in item:
+            return False
+        if "ARRAY_CONTAINS(@refIds, c.refId)" in query and item.get("refId") not in params["@refIds"]:
+            return False
+        return True
+    
+    @staticmethod
+    def _project(item: Dict, query: str) -> Dict:
+        select = query.split(" FROM ", 1)[0][len("SELECT "):].strip()
+        if select == "*":
+            return item
+        projected = {}
+        for field in select.split(","):
+            field = field.strip()
+            if field.startswith("ARRAY_LENGTH(c.") and " AS " in field:
+                source, alias = field[len("ARRAY_LENGTH(c."):].split(") AS ")
+                if isinstance(item.get(source), list):
+                    projected[alias] = len(item[source])
+            elif field.startswith("c."):
+                name = field[2:]
+                if name in item:
+                    projected[name] = item[name]
+        return projected
+
+
+class _AsyncPager:
+    def __init__(self, pager: _Pager):
+        self._pager = pager
+    
+    @property
+    def continuation_token(self) -> Optional[str]:
+        return self._pager.continuation_token
+    
+    def __aiter__(self):
+        return self
+    
+    async def __anext__(self):
+        try:
+            page = next(self._pager)
+        except StopIteration:
+            raise StopAsyncIteration
+        return _async_iter(page)
+
+
+async def _async_iter(items):
+    for item in items:
+        yield item
+
+
+class _AsyncQueryResult:
+    def __init__(self, result: _QueryResult):
+        self._result = result
+    
+    def __aiter__(self):
+        return _async_iter(self._result.items).__aiter__()
+    
+    def by_page(self, continuation_token: Optional[str] = None) -> _AsyncPager:
+        return _AsyncPager(self._result.by_page(continuation_token))
+
+
+class AsyncInMemoryContainer(InMemoryContainer):
+    """Async flavour of ``InMemoryContainer`` mirroring ``azure.cosmos.aio`` signatures"""
+    
+    async def upsert_item(self, body: Dict, **kwargs) -> Dict:
+        return InMemoryContainer.upsert_item(self, body, **kwargs)
+    
+    async def create_item(self, body: Dict, **kwargs) -> Dict:
+        return InMemoryContainer.create_item(self, body, **kwargs)
+    
+    async def read_item(self, item: str, partition_key: str, **kwargs) -> Dict:
+        return InMemoryContainer.read_item(self, item, partition_key, **kwargs)
+    
+    async def delete_item(self, item: str, partition_key: str, **kwargs):
+        return InMemoryContainer.delete_item(self, item, partition_key, **kwargs)
+    
+    async def execute_item_batch(self, batch_operations: List[tuple], partition_key: str, **kwargs) -> List[Dict]:
+        return InMemoryContainer.execute_item_batch(self, batch_operations, partition_key, **kwargs)
+    
+    def query_items(self, query: str, parameters: Optional[List[Dict]] = None, **kwargs) -> _AsyncQueryResult:
+        return _AsyncQueryResult(InMemoryContainer.query_items(self, query, parameters, **kwargs))
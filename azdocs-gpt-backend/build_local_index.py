@@ -0,0 +1,52 @@
+# build_local_index.py - Build the on-box search index used when RETRIEVAL_BACKEND=local
+#
+# Usage: python build_local_index.py SOURCE.jsonl [--out local_index] [--dim 256] [--vectors vectors.npy]
+#
+# SOURCE is JSON Lines with one {"title", "chunk"} object per chunk (plus
+# optional "chunk_id"/"parent_id"), e.g. an export of the Azure AI Search index. Without --vectors the index embeds
+# chunks (and, at query time, queries) with the built-in hashing embedder.
+import argparse
+import json
+import logging
+import sys
+import time
+
+import numpy as np
+
+from local_search import LocalSearchIndex
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s %(levelname)s %(name)s %(message)s',
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+logger = logging.getLogger(__name__)
+
+def read_documents(path: str):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                document = json.loads(line)
+                yield {
+                    "chunk_id": document.get("chunk_id"),
+                    "parent_id": document.get("parent_id"),
+                    "title": document["title"],
+                    "chunk": document["chunk"]
+                }
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a local BM25 + vector search index")
+    parser.add_argument("source", help="JSON Lines file of {\"title\", \"chunk\"} documents")
+    parser.add_argument("--out", default="local_index", help="Index directory (LOCAL_INDEX_PATH)")
+    parser.add_argument("--dim", type=int, default=256, help="Hashing embedder dimensions")
+    parser.add_argument("--vectors", default=None, help="Optional .npy of precomputed chunk embeddings, one row per line")
+    args = parser.parse_args()
+    
+    started = time.perf_counter()
+    vectors = np.load(args.vectors) if args.vectors else None
+    meta = LocalSearchIndex.build(read_documents(args.source), args.out, dim=args.dim, vectors=vectors)
+    logger.info(f"Indexed {meta['docCount']} chunks ({meta['termCount']} terms) into {args.out} "
+                f"in {time.perf_counter() - started:.1f}s")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+# cache.py - Cache backends shared by the services
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+import asyncio
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+class LRUCache:
+    """Thread-safe in-process cache with per-entry TTL and LRU eviction.
+    
+    When ``max_bytes`` is set, ``size_of`` estimates each value's footprint and
+    least recently used entries are evicted until the total fits the budget.
+    """
+    
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 3600,
+                 max_bytes: Optional[int] = None, size_of: Optional[Callable[[Any], int]] = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.size_of = size_of
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    def get(self, key: str) -> Optional[Any]:
+        """Return the cached value, or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            
+            expires_at, value, size = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self._bytes -= size
+                self.expirations += 1
+                self.misses += 1
+                return None
+            
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+    
+    def set(self, key: str, value: Any, ttl_seconds: Optional[float] = None):
+        """Store a value, evicting the least recently used entries when full"""
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        size = self.size_of(value) if self.max_bytes and self.size_of else 0
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[2]
+            if self.max_bytes and size > self.max_bytes:
+                # Never let a single oversized value flush the whole cache
+                return
+            
+            self._entries[key] = (time.monotonic() + ttl, value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or (self.max_bytes and self._bytes > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted[2]
+                self.evictions += 1
+    
+    def delete(self, key: str):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[2]
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+    
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "backend": "memory",
+                "entries": len(self._entries),
+                "maxEntries": self.max_entries,
+                "bytes": self._bytes,
+                "maxBytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
+
+class ChatListCache:
+    """Per-user cache of chat list pages (the first page for each page size).
+    
+    The chat managers ``invalidate`` a user's entry whenever one of their
+    chats is written. A listing that started before a write can finish after
+    it, so callers take a ``snapshot`` before querying and ``set`` drops
+    results older than the user's last invalidation. Writes made by other
+    instances are not seen, which is what ``ttl_seconds`` bounds.
+    """
+    
+    def __init__(self, max_users: int = 10000, ttl_seconds: float = 30):
+        self._users = LRUCache(max_entries=max_users, ttl_seconds=ttl_seconds)
+        self._stamp = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+    
+    @classmethod
+    def from_config(cls, config) -> Optional['ChatListCache']:
+        """Build the cache unless CHAT_LIST_CACHE_TTL_SECONDS is 0"""
+        if config.CHAT_LIST_CACHE_TTL_SECONDS <= 0:
+            return None
+        return cls(config.CHAT_LIST_CACHE_MAX_USERS, config.CHAT_LIST_CACHE_TTL_SECONDS)
+    
+    def get(self, user_id: str, page_size: Optional[int]) -> Optional[Any]:
+        entry = self._users.get(user_id)
+        page = entry["pages"].get(page_size) if entry else None
+        with self._lock:
+            if page is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return page
+    
+    def snapshot(self) -> int:
+        with self._lock:
+            return self._stamp
+    
+    def set(self, user_id: str, page_size: Optional[int], page: Any, stamp: int):
+        """Store a page read after ``snapshot`` returned ``stamp``, unless the user's chats changed since"""
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                self._users.set(user_id, {"stamp": stamp, "pages": {page_size: page}})
+            elif entry["stamp"] <= stamp:
+                entry["pages"][page_size] = page
+    
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._stamp += 1
+            self.invalidations += 1
+            self._users.set(user_id, {"stamp": self._stamp, "pages": {}})
+    
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "backend": "memory",
+                "users": self._users.stats()["entries"],
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations
+            }
+
+class CosmosCache:
+    """Cache shared between workers, stored in a Cosmos DB container partitioned by /id.
+    
+    Expiry is delegated to the container's TTL (the container must have
+    ``default_ttl`` enabled); eviction beyond that is left to Cosmos.
+    """
+    
+    def __init__(self, container, ttl_seconds: float = 3600):
+        self.container = container
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+    
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+    
+    def get(self, key: str) -> Optional[Any]:
+        try:
+            item = self.container.read_item(item=key, partition_key=key)
+        except CosmosResourceNotFoundError:
+            self._count(False)
+            return None
+        except Exception as e:
+            # A cache outage must never fail the request
+            logger.warning(f"Cache read failed for key {key}: {str(e)}")
+            self._count(False)
+            return None
+        
+        self._count(True)
+        return item.get("value")
+    
+    def set(self, key: str, value: Any, ttl_seconds: Optional[float] = None):
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        try:
+            self.container.upsert_item({"id": key, "value": value, "ttl": int(ttl)})
+        except Exception as e:
+            logger.warning(f"Cache write failed for key {key}: {str(e)}")
+    
+    def delete(self, key: str):
+        try:
+            self.container.delete_item(item=key, partition_key=key)
+        except CosmosResourceNotFoundError:
+            pass
+    
+    def clear(self):
+        for item in self.container.query_items("SELECT c.id FROM c", enable_cross_partition_query=True):
+            self.delete(item["id"])
+    
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "backend": "cosmos",
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+def _waiter_error(error: BaseException) -> Exception:
+    """Exception handed to waiters; a leader that was closed or cancelled must not close or cancel them"""
+    if isinstance(error, Exception) and not isinstance(error, asyncio.CancelledError):
+        return error
+    return RuntimeError(f"Shared call was abandoned ({type(error).__name__})")
+
+class SingleFlight:
+    """Collapses concurrent calls for the same key into one execution.
+    
+    The first caller for a key (the leader) runs the work; callers arriving
+    while it is in flight wait for its result or exception instead of
+    repeating it. Nothing is kept once the call finishes - pair it with a
+    cache for reuse over time. Results are shared between callers, so treat
+    them as read-only.
+    """
+    
+    def __init__(self):
+        self._calls: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.executions = 0
+        self.coalesced = 0
+    
+    def join(self, key: str) -> Tuple[Future, bool]:
+        """Return the key's pending result and whether the caller is the leader that must ``resolve`` it"""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = self._calls[key] = Future()
+            self.executions += 1
+            return future, True
+    
+    def resolve(self, key: str, result: Any = None, error: Optional[BaseException] = None):
+        with self._lock:
+            future = self._calls.pop(key, None)
+        if future is None or future.done():
+            return
+        if error is not None:
+            future.set_exception(_waiter_error(error))
+        else:
+            future.set_result(result)
+    
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        future, leader = self.join(key)
+        if not leader:
+            return future.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            self.resolve(key, error=e)
+            raise
+        self.resolve(key, result)
+        return result
+    
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"inFlight": len(self._calls), "executions": self.executions, "coalesced": self.coalesced}
+
+class AsyncSingleFlight:
+    """Event-loop counterpart of SingleFlight for the FastAPI app"""
+    
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Future] = {}
+        self.executions = 0
+        self.coalesced = 0
+    
+    def join(self, key: str) -> Tuple[asyncio.Future, bool]:
+        future = self._calls.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return future, False
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+        self.executions += 1
+        return future, True
+    
+    def resolve(self, key: str, result: Any = None, error: Optional[BaseException] = None):
+        future = self._calls.pop(key, None)
+        if future is None or future.done():
+            return
+        if error is not None:
+            future.set_exception(_waiter_error(error))
+            # Nobody may be waiting; don't log "exception was never retrieved"
+            future.exception()
+        else:
+            future.set_result(result)
+    
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        future, leader = self.join(key)
+        if not leader:
+            # shield: a cancelled waiter must not cancel the shared result for everyone else
+            return await asyncio.shield(future)
+        try:
+            result = await fn()
+        except BaseException as e:
+            self.resolve(key, error=e)
+            raise
+        self.resolve(key, result)
+        return result
+    
+    def stats(self) -> Dict:
+        return {"inFlight": len(self._calls), "executions": self.executions, "coalesced": self.coalesced}
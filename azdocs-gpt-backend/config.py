@@ -20,6 +20,34 @@ class Config:
     AZURE_OPENAI_DEPLOYMENT = os.environ.get('APPSETTING_AZURE_OPENAI_DEPLOYMENT')
     AZURE_OPENAI_KEY = os.environ.get('APPSETTING_AZURE_OPENAI_KEY')
     AZURE_OPENAI_API_VERSION = "2023-03-15-preview"
+    AZURE_OPENAI_EMBEDDING_DEPLOYMENT = os.environ.get('APPSETTING_AZURE_OPENAI_EMBEDDING_DEPLOYMENT')
+    
+    # Query Planning Configuration ('llm', 'local' or 'auto')
+    QUERY_PLANNING_STRATEGY = os.environ.get('APPSETTING_QUERY_PLANNING_STRATEGY', 'llm')
+    QUERY_LOCAL_MAX_WORDS = int(os.environ.get('APPSETTING_QUERY_LOCAL_MAX_WORDS', 24))
+    
+    # Conversation History Configuration
+    HISTORY_TOKEN_BUDGET = int(os.environ.get('APPSETTING_HISTORY_TOKEN_BUDGET', 3000))
+    HISTORY_RECENT_MESSAGES = int(os.environ.get('APPSETTING_HISTORY_RECENT_MESSAGES', 6))
+    HISTORY_TRUNCATE_CHARS = int(os.environ.get('APPSETTING_HISTORY_TRUNCATE_CHARS', 400))
+    HISTORY_SUMMARIZE = os.environ.get('APPSETTING_HISTORY_SUMMARIZE', 'false').lower() == 'true'
+    
+    # HTTP Transport Configuration (shared connection pools, per-dependency timeouts in seconds)
+    HTTP_POOL_SIZE = int(os.environ.get('APPSETTING_HTTP_POOL_SIZE', 50))
+    HTTP_KEEPALIVE_SECONDS = float(os.environ.get('APPSETTING_HTTP_KEEPALIVE_SECONDS', 30))
+    HTTP2_ENABLED = os.environ.get('APPSETTING_HTTP2_ENABLED', 'true')
+    OPENAI_CONNECT_TIMEOUT = float(os.environ.get('APPSETTING_OPENAI_CONNECT_TIMEOUT', 5))
+    OPENAI_READ_TIMEOUT = float(os.environ.get('APPSETTING_OPENAI_READ_TIMEOUT', 60))
+    OPENAI_MAX_RETRIES = int(os.environ.get('APPSETTING_OPENAI_MAX_RETRIES', 2))
+    SEARCH_CONNECT_TIMEOUT = float(os.environ.get('APPSETTING_SEARCH_CONNECT_TIMEOUT', 5))
+    SEARCH_READ_TIMEOUT = float(os.environ.get('APPSETTING_SEARCH_READ_TIMEOUT', 15))
+    SEARCH_MAX_RETRIES = int(os.environ.get('APPSETTING_SEARCH_MAX_RETRIES', 3))
+    COSMOS_CONNECT_TIMEOUT = float(os.environ.get('APPSETTING_COSMOS_CONNECT_TIMEOUT', 5))
+    COSMOS_READ_TIMEOUT = float(os.environ.get('APPSETTING_COSMOS_READ_TIMEOUT', 10))
+    COSMOS_MAX_RETRIES = int(os.environ.get('APPSETTING_COSMOS_MAX_RETRIES', 3))
+    AUTH_CONNECT_TIMEOUT = float(os.environ.get('APPSETTING_AUTH_CONNECT_TIMEOUT', 5))
+    AUTH_READ_TIMEOUT = float(os.environ.get('APPSETTING_AUTH_READ_TIMEOUT', 10))
+    AUTH_MAX_RETRIES = int(os.environ.get('APPSETTING_AUTH_MAX_RETRIES', 2))
     
     # Azure Search Configuration
     AZURE_SEARCH_ENDPOINT = os.environ.get('APPSETTING_AZURE_SEARCH_ENDPOINT')
@@ -27,18 +55,100 @@ class Config:
     AZURE_SEARCH_INDEX = os.environ.get('APPSETTING_AZURE_SEARCH_INDEX')
     AZURE_SEARCH_SEMANTIC_CONFIG = "azdocs-test3-semantic-configuration"
     
+    # Search Result Cache Configuration
+    SEARCH_CACHE_ENABLED = os.environ.get('APPSETTING_SEARCH_CACHE_ENABLED', 'true').lower() == 'true'
+    SEARCH_CACHE_TTL_SECONDS = int(os.environ.get('APPSETTING_SEARCH_CACHE_TTL_SECONDS', 900))
+    SEARCH_CACHE_MAX_ENTRIES = int(os.environ.get('APPSETTING_SEARCH_CACHE_MAX_ENTRIES', 2048))
+    SEARCH_CACHE_MAX_BYTES = int(os.environ.get('APPSETTING_SEARCH_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+    
+    # Retrieval Backend ('azure' for Azure AI Search, 'local' for an on-box index built with build_local_index.py)
+    RETRIEVAL_BACKEND = os.environ.get('APPSETTING_RETRIEVAL_BACKEND', 'azure').lower()
+    LOCAL_INDEX_PATH = os.environ.get('APPSETTING_LOCAL_INDEX_PATH', 'local_index')
+    LOCAL_SEARCH_CANDIDATES = int(os.environ.get('APPSETTING_LOCAL_SEARCH_CANDIDATES', 50))
+    
+    # Document Ingestion Configuration (POST /api/upload/pdf)
+    INGEST_MAX_UPLOAD_MB = int(os.environ.get('APPSETTING_INGEST_MAX_UPLOAD_MB', 100))
+    INGEST_CHUNK_SIZE = int(os.environ.get('APPSETTING_INGEST_CHUNK_SIZE', 2000))
+    INGEST_CHUNK_OVERLAP = int(os.environ.get('APPSETTING_INGEST_CHUNK_OVERLAP', 200))
+    INGEST_EMBED_BATCH_SIZE = int(os.environ.get('APPSETTING_INGEST_EMBED_BATCH_SIZE', 16))
+    INGEST_UPLOAD_BATCH_SIZE = int(os.environ.get('APPSETTING_INGEST_UPLOAD_BATCH_SIZE', 100))
+    
+    # Embedding Configuration (needs AZURE_OPENAI_EMBEDDING_DEPLOYMENT)
+    # SEARCH_QUERY_VECTORS: 'server' lets the index vectorize queries, 'client' sends cached VectorizedQuery vectors
+    SEARCH_QUERY_VECTORS = os.environ.get('APPSETTING_SEARCH_QUERY_VECTORS', 'server').lower()
+    EMBEDDING_CACHE_PATH = os.environ.get('APPSETTING_EMBEDDING_CACHE_PATH', 'embedding_cache')
+    EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get('APPSETTING_EMBEDDING_CACHE_MAX_ENTRIES', 1000000))
+    EMBEDDING_BATCH_WINDOW_MS = float(os.environ.get('APPSETTING_EMBEDDING_BATCH_WINDOW_MS', 5))
+    EMBEDDING_MAX_BATCH = int(os.environ.get('APPSETTING_EMBEDDING_MAX_BATCH', 16))
+    
     # Cosmos DB Configuration
     COSMOS_ENDPOINT = os.environ.get('APPSETTING_COSMOS_ENDPOINT')
     COSMOS_KEY = os.environ.get('APPSETTING_COSMOS_KEY')
     COSMOS_DATABASE_NAME = os.environ.get('APPSETTING_COSMOS_DATABASE_NAME', 'ChatApp')
     COSMOS_CONTAINER_NAME = os.environ.get('APPSETTING_COSMOS_CONTAINER_NAME', 'UserChats')
+    COSMOS_CACHE_CONTAINER_NAME = os.environ.get('APPSETTING_COSMOS_CACHE_CONTAINER_NAME', 'AnswerCache')
+    # The database and containers are created by provision.py; set to create them at startup instead (local dev)
+    COSMOS_AUTO_PROVISION = os.environ.get('APPSETTING_COSMOS_AUTO_PROVISION', 'false').lower() == 'true'
+    
+    # Startup and Health Configuration (/health/live, /health/ready)
+    # WARMUP_ON_START connects to the dependencies in the background right after startup
+    WARMUP_ON_START = os.environ.get('APPSETTING_WARMUP_ON_START', 'true').lower() == 'true'
+    HEALTH_CHECK_TTL_SECONDS = float(os.environ.get('APPSETTING_HEALTH_CHECK_TTL_SECONDS', 10))
+    
+    # Chat Persistence Configuration ('sync' or 'write_behind')
+    CHAT_WRITE_MODE = os.environ.get('APPSETTING_CHAT_WRITE_MODE', 'sync')
+    WRITE_BEHIND_WORKERS = int(os.environ.get('APPSETTING_WRITE_BEHIND_WORKERS', 2))
+    WRITE_BEHIND_QUEUE_SIZE = int(os.environ.get('APPSETTING_WRITE_BEHIND_QUEUE_SIZE', 1000))
+    WRITE_BEHIND_MAX_RETRIES = int(os.environ.get('APPSETTING_WRITE_BEHIND_MAX_RETRIES', 5))
+    # Per-user chat list (GET /api/chats) kept in memory and dropped on every chat write; 0 disables it.
+    # Writes through other instances are only seen once the TTL expires
+    CHAT_LIST_CACHE_TTL_SECONDS = float(os.environ.get('APPSETTING_CHAT_LIST_CACHE_TTL_SECONDS', 30))
+    CHAT_LIST_CACHE_MAX_USERS = int(os.environ.get('APPSETTING_CHAT_LIST_CACHE_MAX_USERS', 10000))
+    
+    # Azure OpenAI Rate Governor (limits of the chat deployment; 0 = no TPM/RPM pacing)
+    OPENAI_GOVERNOR_ENABLED = os.environ.get('APPSETTING_OPENAI_GOVERNOR_ENABLED', 'true').lower() == 'true'
+    OPENAI_TPM_LIMIT = int(os.environ.get('APPSETTING_OPENAI_TPM_LIMIT', 0))
+    OPENAI_RPM_LIMIT = int(os.environ.get('APPSETTING_OPENAI_RPM_LIMIT', 0))
+    OPENAI_MAX_CONCURRENCY = int(os.environ.get('APPSETTING_OPENAI_MAX_CONCURRENCY', 16))
+    OPENAI_MAX_QUEUE = int(os.environ.get('APPSETTING_OPENAI_MAX_QUEUE', 200))
+    OPENAI_MAX_QUEUE_SECONDS = float(os.environ.get('APPSETTING_OPENAI_MAX_QUEUE_SECONDS', 30))
+    OPENAI_COMPLETION_TOKEN_ESTIMATE = int(os.environ.get('APPSETTING_OPENAI_COMPLETION_TOKEN_ESTIMATE', 500))
+    
+    # Telemetry (/metrics, stage timings; spans need the opentelemetry packages)
+    METRICS_ENABLED = os.environ.get('APPSETTING_METRICS_ENABLED', 'true').lower() == 'true'
+    OTEL_ENABLED = os.environ.get('APPSETTING_OTEL_ENABLED', 'false').lower() == 'true'
+    
+    # Response Serialization ('auto' uses orjson when installed, 'orjson' or 'json')
+    JSON_ENCODER = os.environ.get('APPSETTING_JSON_ENCODER', 'auto')
+    # gzip (brotli when the package is installed) for responses of at least COMPRESSION_MIN_BYTES;
+    # level 1 already shrinks chat JSON ~5x, higher levels cost several times the CPU for a few percent
+    COMPRESSION_ENABLED = os.environ.get('APPSETTING_COMPRESSION_ENABLED', 'true').lower() == 'true'
+    COMPRESSION_MIN_BYTES = int(os.environ.get('APPSETTING_COMPRESSION_MIN_BYTES', 1024))
+    COMPRESSION_LEVEL = int(os.environ.get('APPSETTING_COMPRESSION_LEVEL', 1))
+    
+    # Answer Cache Configuration ('memory', 'cosmos' or 'none')
+    ANSWER_CACHE_BACKEND = os.environ.get('APPSETTING_ANSWER_CACHE_BACKEND', 'memory')
+    ANSWER_CACHE_TTL_SECONDS = int(os.environ.get('APPSETTING_ANSWER_CACHE_TTL_SECONDS', 3600))
+    ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get('APPSETTING_ANSWER_CACHE_MAX_ENTRIES', 1024))
+    # Identical questions in flight at the same time share one retrieval and answer
+    SINGLE_FLIGHT_ENABLED = os.environ.get('APPSETTING_SINGLE_FLIGHT_ENABLED', 'true').lower() == 'true'
     
     # Application Configuration
     REDIRECT_PATH = "/getAToken"
     CORS_ORIGINS = ["http://localhost:3000"]
     JWT_EXPIRATION_HOURS = 1
     SEARCH_RESULTS_COUNT = 5
+    SEARCH_MAX_PARALLEL_QUERIES = int(os.environ.get('APPSETTING_SEARCH_MAX_PARALLEL_QUERIES', 4))
+    SEARCH_RRF_K = int(os.environ.get('APPSETTING_SEARCH_RRF_K', 60))
+    
+    # Context Packing Configuration (search results sent to the model)
+    CONTEXT_PACKING_ENABLED = os.environ.get('APPSETTING_CONTEXT_PACKING_ENABLED', 'true').lower() == 'true'
+    CONTEXT_TOKEN_BUDGET = int(os.environ.get('APPSETTING_CONTEXT_TOKEN_BUDGET', 2000))
+    CONTEXT_DEDUP_THRESHOLD = float(os.environ.get('APPSETTING_CONTEXT_DEDUP_THRESHOLD', 0.85))
     COSMOS_THROUGHPUT = 400
+    ADMIN_ROLE = os.environ.get('APPSETTING_ADMIN_ROLE', 'Admin')
+    AUTH_CLAIMS_CACHE_MAX_ENTRIES = int(os.environ.get('APPSETTING_AUTH_CLAIMS_CACHE_MAX_ENTRIES', 4096))
+    AUTH_CLAIMS_CACHE_TTL_SECONDS = int(os.environ.get('APPSETTING_AUTH_CLAIMS_CACHE_TTL_SECONDS', 300))
 
 class DevelopmentConfig(Config):
     """Development configuration"""
@@ -0,0 +1,297 @@
+# embeddings.py - Batched, cached text embeddings for ingestion and query vectors
+from concurrent.futures import Future
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+import numpy as np
+import asyncio
+import fcntl
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+KEY_BYTES = 16
+
+def embedding_key(model: str, text: str) -> bytes:
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).digest()[:KEY_BYTES]
+
+class EmbeddingCache:
+    """Content-addressed embedding store on disk, shared by every worker process.
+    
+    ``vectors.f32`` holds float32 rows and is read through a memory map;
+    ``keys.bin`` holds one 16-byte digest of (model, text) per row. Both files
+    are append-only: writers take an exclusive ``flock``, append the vector
+    before its key, and readers pick up rows added by other processes on a
+    miss. A key on disk therefore always has its vector behind it.
+    """
+    
+    def __init__(self, path: str, max_entries: int = 1_000_000):
+        self.path = path
+        self.max_entries = max_entries
+        os.makedirs(path, exist_ok=True)
+        self._keys_path = os.path.join(path, "keys.bin")
+        self._vectors_path = os.path.join(path, "vectors.f32")
+        self._meta_path = os.path.join(path, "meta.json")
+        self._rows: Dict[bytes, int] = {}
+        self._keys_read = 0
+        self._vectors: Optional[np.memmap] = None
+        self.dim: Optional[int] = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                self.dim = json.load(f)["dim"]
+        self._refresh()
+    
+    def _refresh(self):
+        """Index keys appended since the last refresh (by this or another process)"""
+        if self.dim is None or not os.path.exists(self._keys_path):
+            return
+        vector_rows = os.path.getsize(self._vectors_path) // (4 * self.dim)
+        with open(self._keys_path, "rb") as f:
+            f.seek(self._keys_read * KEY_BYTES)
+            data = f.read()
+        for offset in range(0, len(data) - len(data) % KEY_BYTES, KEY_BYTES):
+            row = self._keys_read
+            if row >= vector_rows:
+                break
+            self._rows.setdefault(data[offset:offset + KEY_BYTES], row)
+            self._keys_read += 1
+        if self._vectors is None or len(self._vectors) < self._keys_read:
+            self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(vector_rows, self.dim)) \
+                if vector_rows else None
+    
+    def get_many(self, keys: List[bytes]) -> List[Optional[np.ndarray]]:
+        with self._lock:
+            if any(key not in self._rows for key in keys):
+                self._refresh()
+            found = [self._rows.get(key) for key in keys]
+            vectors = [None if row is None else np.array(self._vectors[row]) for row in found]
+            hits = sum(vector is not None for vector in vectors)
+            self.hits += hits
+            self.misses += len(keys) - hits
+            return vectors
+    
+    def put_many(self, items: List[Tuple[bytes, np.ndarray]]):
+        if not items:
+            return
+        with self._lock:
+            if self.dim is None:
+                self.dim = len(items[0][1])
+                with open(self._meta_path, "w") as f:
+                    json.dump({"dim": self.dim}, f)
+            with open(self._keys_path, "ab") as keys_file, open(self._vectors_path, "ab") as vectors_file:
+                fcntl.flock(keys_file, fcntl.LOCK_EX)
+                try:
+                    self._refresh()
+                    new = [(key, vector) for key, vector in items if key not in self._rows]
+                    room = self.max_entries - self._keys_read
+                    if room < len(new):
+                        logger.warning(f"Embedding cache {self.path} is full; not storing {len(new) - max(room, 0)} vectors")
+                        new = new[:max(room, 0)]
+                    if not new:
+                        return
+                    vectors_file.write(np.asarray([vector for _, vector in new], dtype=np.float32).tobytes())
+                    vectors_file.flush()
+                    keys_file.write(b"".join(key for key, _ in new))
+                    keys_file.flush()
+                    self._refresh()
+                finally:
+                    fcntl.flock(keys_file, fcntl.LOCK_UN)
+    
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"entries": self._keys_read, "dim": self.dim, "hits": self.hits, "misses": self.misses}
+
+class EmbeddingService:
+    """Embeds texts through a cache, coalescing concurrent callers into shared API calls.
+    
+    ``embed`` looks every text up in the cache first. Misses go to a single
+    batcher thread that waits up to ``batch_window_ms`` for other callers and
+    sends at most ``max_batch`` inputs per call to ``embed_batch`` (one
+    embeddings request). A text already waiting or in flight is not queued
+    again; its callers share the pending result. Vectors are returned as
+    lists of floats in input order.
+    """
+    
+    def __init__(self, embed_batch: Callable[[List[str]], List[List[float]]], model: str,
+                 cache: Optional[EmbeddingCache] = None, batch_window_ms: float = 5, max_batch: int = 16):
+        self.embed_batch = embed_batch
+        self.model = model
+        self.cache = cache
+        self.batch_window = batch_window_ms / 1000
+        self.max_batch = max_batch
+        self.calls = 0
+        self.texts_embedded = 0
+        self._pending: "queue.Queue[Tuple[str, bytes, Future]]" = queue.Queue()
+        self._in_flight: Dict[bytes, Future] = {}
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._thread.start()
+    
+    @classmethod
+    def from_config(cls, config, openai_service) -> Optional['EmbeddingService']:
+        if not config.AZURE_OPENAI_EMBEDDING_DEPLOYMENT:
+            return None
+        cache = EmbeddingCache(config.EMBEDDING_CACHE_PATH, config.EMBEDDING_CACHE_MAX_ENTRIES) \
+            if config.EMBEDDING_CACHE_PATH else None
+        return cls(
+            openai_service.embed,
+            config.AZURE_OPENAI_EMBEDDING_DEPLOYMENT,
+            cache,
+            batch_window_ms=config.EMBEDDING_BATCH_WINDOW_MS,
+            max_batch=config.EMBEDDING_MAX_BATCH
+        )
+    
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        keys = [embedding_key(self.model, text) for text in texts]
+        vectors = self.cache.get_many(keys) if self.cache else [None] * len(texts)
+        futures = {}
+        with self._lock:
+            for text, key, vector in zip(texts, keys, vectors):
+                if vector is not None or key in futures:
+                    continue
+                future = self._in_flight.get(key)
+                if future is None:
+                    future = self._in_flight[key] = Future()
+                    self._pending.put((text, key, future))
+                futures[key] = future
+        return [
+            vector.tolist() if vector is not None else futures[key].result()
+            for key, vector in zip(keys, vectors)
+        ]
+    
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed([text])[0]
+    
+    def _run(self):
+        while True:
+            batch = [self._pending.get()]
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._pending.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            self._embed(batch)
+    
+    def _embed(self, batch: List[Tuple[str, bytes, Future]]):
+        try:
+            vectors = self.embed_batch([text for text, _, _ in batch])
+        except Exception as e:
+            self._settle(batch, error=e)
+            return
+        
+        self.calls += 1
+        self.texts_embedded += len(batch)
+        if self.cache:
+            try:
+                self.cache.put_many([(key, np.asarray(vector, dtype=np.float32)) for (_, key, _), vector in zip(batch, vectors)])
+            except Exception as e:
+                logger.warning(f"Embedding cache write failed: {str(e)}")
+        self._settle(batch, vectors)
+    
+    def _settle(self, batch: List[Tuple[str, bytes, Future]], vectors: Optional[List] = None,
+                error: Optional[Exception] = None):
+        with self._lock:
+            for _, key, _ in batch:
+                self._in_flight.pop(key, None)
+        for i, (_, _, future) in enumerate(batch):
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(list(vectors[i]))
+    
+    def stats(self) -> Dict:
+        return {
+            "calls": self.calls,
+            "textsEmbedded": self.texts_embedded,
+            "cache": self.cache.stats() if self.cache else None
+        }
+
+def _fail_waiters(batch: Dict[bytes, Tuple[str, List[asyncio.Future]]], error: Exception):
+    for _, futures in batch.values():
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+
+class AsyncEmbeddingService:
+    """Event-loop counterpart of EmbeddingService for the FastAPI app.
+    
+    Callers within ``batch_window_ms`` of each other share one awaited
+    ``embed_batch`` call; the on-disk cache is the same format, so both apps
+    (and every worker) can point at one cache directory. Batches are sent
+    from tasks of their own, so a cancelled caller never strands the others
+    waiting on the same batch.
+    """
+    
+    def __init__(self, embed_batch: Callable[[List[str]], Awaitable[List[List[float]]]], model: str,
+                 cache: Optional[EmbeddingCache] = None, batch_window_ms: float = 5, max_batch: int = 16):
+        self.embed_batch = embed_batch
+        self.model = model
+        self.cache = cache
+        self.batch_window = batch_window_ms / 1000
+        self.max_batch = max_batch
+        self._waiting: Dict[bytes, Tuple[str, List[asyncio.Future]]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flushes: Set[asyncio.Task] = set()
+    
+    async def embed(self, texts: List[str]) -> List[List[float]]:
+        keys = [embedding_key(self.model, text) for text in texts]
+        vectors = self.cache.get_many(keys) if self.cache else [None] * len(texts)
+        loop = asyncio.get_running_loop()
+        futures = {}
+        for text, key, vector in zip(texts, keys, vectors):
+            if vector is None and key not in futures:
+                futures[key] = loop.create_future()
+                self._waiting.setdefault(key, (text, []))[1].append(futures[key])
+        if futures:
+            if len(self._waiting) >= self.max_batch:
+                flush = asyncio.create_task(self._flush())
+                self._flushes.add(flush)
+                flush.add_done_callback(self._flushes.discard)
+            elif self._flush_task is None:
+                self._flush_task = asyncio.create_task(self._flush_after_window())
+        return [
+            vector.tolist() if vector is not None else await futures[key]
+            for key, vector in zip(keys, vectors)
+        ]
+    
+    async def embed_query(self, text: str) -> List[float]:
+        return (await self.embed([text]))[0]
+    
+    async def _flush_after_window(self):
+        await asyncio.sleep(self.batch_window)
+        self._flush_task = None
+        await self._flush()
+    
+    async def _flush(self):
+        while self._waiting:
+            keys = list(self._waiting)[:self.max_batch]
+            batch = {key: self._waiting.pop(key) for key in keys}
+            try:
+                vectors = await self.embed_batch([batch[key][0] for key in keys])
+            except Exception as e:
+                _fail_waiters(batch, e)
+                continue
+            except BaseException:
+                # The flush itself was cancelled (shutdown): nothing else would settle these waiters
+                error = RuntimeError("Embedding batch was cancelled")
+                _fail_waiters(batch, error)
+                _fail_waiters(self._waiting, error)
+                self._waiting.clear()
+                raise
+            if self.cache:
+                try:
+                    self.cache.put_many([(key, np.asarray(vector, dtype=np.float32)) for key, vector in zip(keys, vectors)])
+                except Exception as e:
+                    logger.warning(f"Embedding cache write failed: {str(e)}")
+            for key, vector in zip(keys, vectors):
+                for future in batch[key][1]:
+                    if not future.done():
+                        future.set_result(list(vector))
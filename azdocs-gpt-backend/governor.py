@@ -0,0 +1,378 @@
+# governor.py - Client-side rate limiting and concurrency control for Azure OpenAI calls
+from collections import OrderedDict, deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+import asyncio
+import random
+import threading
+import time
+import openai
+import logging
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+class OpenAIOverloadedError(Exception):
+    """Raised when a call is shed instead of queued; ``retry_after`` is a hint in seconds for the client"""
+    
+    def __init__(self, message: str, retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def estimate_tokens(messages: List[Dict], completion_tokens: int) -> int:
+    """Prompt tokens (~4 characters each plus per-message overhead) and the expected completion"""
+    return sum(len(m.get("content") or "") // 4 + 4 for m in messages) + completion_tokens
+
+def usage_tokens(result) -> Optional[int]:
+    usage = getattr(result, "usage", None)
+    return getattr(usage, "total_tokens", None) if usage else None
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """Delay requested by the service, from the retry-after-ms or retry-after header of the error response"""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    for header, scale in (("retry-after-ms", 0.001), ("x-ms-retry-after-ms", 0.001), ("retry-after", 1.0)):
+        value = headers.get(header)
+        if value:
+            try:
+                return float(value) * scale
+            except ValueError:
+                continue  # retry-after may also be an HTTP date; fall back to backoff
+    return None
+
+class TokenBucket:
+    """Refills at ``per_minute / 60`` per second up to ``window_seconds`` worth of quota.
+    
+    Azure evaluates TPM/RPM quota over short windows rather than the whole
+    minute, so the burst allowance is kept to one window. A limit of 0
+    disables the bucket.
+    """
+    
+    def __init__(self, per_minute: float, window_seconds: float = 10):
+        self.rate = per_minute / 60
+        self.capacity = per_minute * window_seconds / 60
+        self.level = self.capacity
+        self.updated = time.monotonic()
+    
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def wait_time(self, amount: float, now: float) -> float:
+        if not self.rate:
+            return 0.0
+        self._refill(now)
+        # A request larger than the burst allowance is let through once the bucket is full
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+    
+    def take(self, amount: float, now: float):
+        if self.rate:
+            self._refill(now)
+            self.level -= min(amount, self.capacity)
+    
+    def give_back(self, amount: float):
+        """Return unused quota (or, when negative, charge for quota used beyond the estimate)"""
+        if self.rate:
+            self.level = min(self.capacity, self.level + amount)
+
+class _Ticket:
+    __slots__ = ("user", "estimate", "tokens", "enqueued", "granted")
+    
+    def __init__(self, user: str, estimate: int):
+        self.user = user
+        self.estimate = estimate
+        self.tokens = estimate
+        self.enqueued = time.monotonic()
+        self.granted = False
+
+class RateGovernor:
+    """Admission control shared by the blocking and async governors.
+    
+    Every call reserves its estimated tokens and one request against the
+    deployment's TPM/RPM buckets and takes one of ``max_concurrency`` slots.
+    Calls that cannot start wait in per-user queues served round-robin, so a
+    user with many requests in flight cannot starve everybody else. The queue
+    sheds load (``OpenAIOverloadedError``) once ``max_queue`` calls are waiting
+    or a call has waited ``max_wait_seconds``. A 429 pauses every caller for
+    the service's retry-after; throttled and transient failures are retried
+    with jittered exponential backoff. Estimates are corrected towards the
+    usage the service reports.
+    """
+    
+    def __init__(self, tokens_per_minute: int = 0, requests_per_minute: int = 0, max_concurrency: int = 16,
+                 max_queue: int = 200, max_wait_seconds: float = 30, max_retries: int = 2,
+                 backoff_seconds: float = 1.0):
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.requests = TokenBucket(requests_per_minute)
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait_seconds = max_wait_seconds
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self._queues: "OrderedDict[str, Deque[_Ticket]]" = OrderedDict()
+        self._queued = 0
+        self._active = 0
+        self._paused_until = 0.0
+        self._correction = 1.0
+        self._waits: Deque[float] = deque(maxlen=1000)
+        self._lock = threading.Lock()
+        self.granted = 0
+        self.shed = 0
+        self.throttled = 0
+        self.retries = 0
+    
+    @classmethod
+    def from_config(cls, config) -> Optional['RateGovernor']:
+        if not config.OPENAI_GOVERNOR_ENABLED:
+            return None
+        return cls(
+            tokens_per_minute=config.OPENAI_TPM_LIMIT,
+            requests_per_minute=config.OPENAI_RPM_LIMIT,
+            max_concurrency=config.OPENAI_MAX_CONCURRENCY,
+            max_queue=config.OPENAI_MAX_QUEUE,
+            max_wait_seconds=config.OPENAI_MAX_QUEUE_SECONDS,
+            max_retries=config.OPENAI_MAX_RETRIES
+        )
+    
+    def _enqueue(self, tokens: int, user_id: Optional[str]) -> _Ticket:
+        with self._lock:
+            if self._queued >= self.max_queue:
+                self.shed += 1
+                raise OpenAIOverloadedError(f"OpenAI request queue is full ({self._queued} waiting)", self._retry_hint())
+            ticket = _Ticket(user_id or "", tokens)
+            self._queues.setdefault(ticket.user, deque()).append(ticket)
+            self._queued += 1
+            return ticket
+    
+    def _dispatch_locked(self) -> Tuple[bool, Optional[float]]:
+        """Grant waiting tickets while capacity allows.
+        
+        Returns whether anything was granted and the seconds until the next
+        grant may become possible (None when only a release can free capacity).
+        """
+        granted = False
+        while self._queued:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return granted, self._paused_until - now
+            if self._active >= self.max_concurrency:
+                return granted, None
+            user, queue = next(iter(self._queues.items()))
+            ticket = queue[0]
+            # Corrected when admitted, so calls queued before a correction still benefit from it
+            ticket.tokens = max(1, int(ticket.estimate * self._correction))
+            wait = max(self.tokens.wait_time(ticket.tokens, now), self.requests.wait_time(1, now))
+            if wait > 0:
+                return granted, wait
+            
+            queue.popleft()
+            if queue:
+                self._queues.move_to_end(user)
+            else:
+                del self._queues[user]
+            self._queued -= 1
+            self._active += 1
+            self.tokens.take(ticket.tokens, now)
+            self.requests.take(1, now)
+            ticket.granted = True
+            self.granted += 1
+            self._waits.append(now - ticket.enqueued)
+            granted = True
+        return granted, None
+    
+    def _abandon_locked(self, ticket: _Ticket):
+        if ticket.granted:
+            self._release_locked(ticket, 0)
+            return
+        queue = self._queues.get(ticket.user)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            self._queued -= 1
+            if not queue:
+                del self._queues[ticket.user]
+    
+    def _timed_out_locked(self, ticket: _Ticket) -> OpenAIOverloadedError:
+        self._abandon_locked(ticket)
+        self.shed += 1
+        return OpenAIOverloadedError(f"Waited {self.max_wait_seconds}s for OpenAI capacity", self._retry_hint())
+    
+    def _release_locked(self, ticket: _Ticket, used_tokens: Optional[int]):
+        self._active -= 1
+        if used_tokens is not None:
+            self.tokens.give_back(ticket.tokens - used_tokens)
+            if used_tokens and ticket.estimate:
+                # Estimates are rough (no tokenizer); move them towards what the service reports
+                ratio = used_tokens / ticket.estimate
+                self._correction = min(4.0, max(0.5, 0.9 * self._correction + 0.1 * ratio))
+    
+    def _retry_hint(self) -> float:
+        return round(max(1.0, self._paused_until - time.monotonic()), 1)
+    
+    def _retry_delay(self, error: Exception, attempt: int) -> Optional[float]:
+        """Seconds to wait before retrying a failed call, or None if it should not be retried"""
+        status = getattr(error, "status_code", None)
+        if attempt >= self.max_retries:
+            return None
+        if status not in RETRYABLE_STATUS_CODES and not isinstance(error, openai.APIConnectionError):
+            return None
+        
+        backoff = self.backoff_seconds * 2 ** attempt
+        retry_after = retry_after_seconds(error)
+        # Jitter keeps callers that were throttled together from retrying together
+        delay = (retry_after if retry_after is not None else backoff) + random.uniform(0, backoff / 2)
+        with self._lock:
+            self.retries += 1
+            if status == 429:
+                self.throttled += 1
+                # Quota is per deployment, so hold every caller back rather than just this one
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        logger.warning(f"OpenAI call failed ({status or type(error).__name__}), retry {attempt + 1} in {delay:.1f}s")
+        return delay
+    
+    def stats(self) -> Dict:
+        with self._lock:
+            waits = sorted(self._waits)
+            now = time.monotonic()
+            return {
+                "queueDepth": self._queued,
+                "queuedUsers": len(self._queues),
+                "active": self._active,
+                "granted": self.granted,
+                "shed": self.shed,
+                "throttled": self.throttled,
+                "retries": self.retries,
+                "waitMsP50": round(waits[len(waits) // 2] * 1000, 1) if waits else 0.0,
+                "waitMsP95": round(waits[max(0, int(len(waits) * 0.95) - 1)] * 1000, 1) if waits else 0.0,
+                "pausedSeconds": round(max(0.0, self._paused_until - now), 1),
+                "estimateCorrection": round(self._correction, 2)
+            }
+
+class OpenAIGovernor(RateGovernor):
+    """Blocking governor for the Flask app's worker threads"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._condition = threading.Condition(self._lock)
+    
+    def acquire(self, tokens: int, user_id: Optional[str] = None) -> _Ticket:
+        ticket = self._enqueue(tokens, user_id)
+        deadline = ticket.enqueued + self.max_wait_seconds
+        with self._condition:
+            while True:
+                granted, delay = self._dispatch_locked()
+                if granted:
+                    self._condition.notify_all()
+                if ticket.granted:
+                    return ticket
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise self._timed_out_locked(ticket)
+                self._condition.wait(min(remaining, delay) if delay is not None else remaining)
+    
+    def release(self, ticket: _Ticket, used_tokens: Optional[int] = None):
+        with self._condition:
+            self._release_locked(ticket, used_tokens)
+            self._condition.notify_all()
+    
+    def _start(self, fn: Callable[[], Any], tokens: int, user_id: Optional[str]) -> Tuple[Any, _Ticket]:
+        attempt = 0
+        while True:
+            ticket = self.acquire(tokens, user_id)
+            try:
+                return fn(), ticket
+            except Exception as e:
+                self.release(ticket, 0)
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    raise
+            attempt += 1
+            time.sleep(delay)
+    
+    def call(self, fn: Callable[[], Any], tokens: int, user_id: Optional[str] = None) -> Any:
+        """Run ``fn`` (one API call) once admitted, retrying throttled and transient failures"""
+        result, ticket = self._start(fn, tokens, user_id)
+        self.release(ticket, usage_tokens(result))
+        return result
+    
+    def stream(self, fn: Callable[[], Iterator], tokens: int, user_id: Optional[str] = None) -> Iterator:
+        """Like ``call`` for a streaming response; the slot is held until the stream is consumed or closed"""
+        stream, ticket = self._start(fn, tokens, user_id)
+        try:
+            yield from stream
+        finally:
+            self.release(ticket)
+
+class AsyncOpenAIGovernor(RateGovernor):
+    """Event-loop counterpart of OpenAIGovernor for the FastAPI app"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._changed: Optional[asyncio.Event] = None
+    
+    def _notify(self):
+        if self._changed is not None:
+            self._changed.set()
+            self._changed = None
+    
+    async def acquire(self, tokens: int, user_id: Optional[str] = None) -> _Ticket:
+        ticket = self._enqueue(tokens, user_id)
+        deadline = ticket.enqueued + self.max_wait_seconds
+        try:
+            while True:
+                with self._lock:
+                    granted, delay = self._dispatch_locked()
+                if granted:
+                    self._notify()
+                if ticket.granted:
+                    return ticket
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    with self._lock:
+                        raise self._timed_out_locked(ticket)
+                if self._changed is None:
+                    self._changed = asyncio.Event()
+                try:
+                    await asyncio.wait_for(self._changed.wait(), min(remaining, delay) if delay is not None else remaining)
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            with self._lock:
+                self._abandon_locked(ticket)
+            self._notify()
+            raise
+    
+    def release(self, ticket: _Ticket, used_tokens: Optional[int] = None):
+        with self._lock:
+            self._release_locked(ticket, used_tokens)
+        self._notify()
+    
+    async def _start(self, fn: Callable[[], Awaitable[Any]], tokens: int, user_id: Optional[str]) -> Tuple[Any, _Ticket]:
+        attempt = 0
+        while True:
+            ticket = await self.acquire(tokens, user_id)
+            try:
+                return await fn(), ticket
+            except asyncio.CancelledError:
+                self.release(ticket, 0)
+                raise
+            except Exception as e:
+                self.release(ticket, 0)
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    raise
+            attempt += 1
+            await asyncio.sleep(delay)
+    
+    async def call(self, fn: Callable[[], Awaitable[Any]], tokens: int, user_id: Optional[str] = None) -> Any:
+        result, ticket = await self._start(fn, tokens, user_id)
+        self.release(ticket, usage_tokens(result))
+        return result
+    
+    async def stream(self, fn: Callable[[], Awaitable[AsyncIterator]], tokens: int,
+                     user_id: Optional[str] = None) -> AsyncIterator:
+        stream, ticket = await self._start(fn, tokens, user_id)
+        try:
+            async for chunk in stream:
+                yield chunk
+        finally:
+            self.release(ticket)
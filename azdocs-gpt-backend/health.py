@@ -0,0 +1,131 @@
+# health.py - Dependency warm-up and readiness checks behind /health/ready
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+import asyncio
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+def _run_result(started: float, error: Optional[BaseException]) -> Dict:
+    result = {"ok": error is None, "ms": round((time.perf_counter() - started) * 1000, 1)}
+    if error is not None:
+        result["error"] = f"{type(error).__name__}: {str(error)[:200]}"
+    return result
+
+class HealthChecks:
+    """Named dependency checks, run by a warm-up and by the readiness probe.
+    
+    Clients are created lazily, so the first run of the checks is what opens
+    the connections (and runs MSAL authority discovery). ``warm_up`` does it
+    in a background thread right after startup; until it finishes the
+    instance reports "starting" instead of running the checks on the probe's
+    thread. Afterwards results are reused for ``ttl_seconds`` so frequent
+    probes don't turn into a stream of Cosmos reads.
+    """
+    
+    def __init__(self, ttl_seconds: float = 10):
+        self.ttl_seconds = ttl_seconds
+        self._checks: Dict[str, Callable[[], None]] = {}
+        self._results: Dict[str, Dict] = {}
+        self._checked_at = 0.0
+        self._warming = False
+        self._lock = threading.Lock()
+    
+    def add(self, name: str, check: Callable[[], None]):
+        """Register a check; it passes unless it raises"""
+        self._checks[name] = check
+    
+    def _run_checks(self) -> Dict[str, Dict]:
+        results = {}
+        for name, check in self._checks.items():
+            started = time.perf_counter()
+            try:
+                check()
+                results[name] = _run_result(started, None)
+            except Exception as e:
+                logger.warning(f"Health check {name} failed: {str(e)}")
+                results[name] = _run_result(started, e)
+        return results
+    
+    def _store(self, results: Dict[str, Dict]):
+        with self._lock:
+            self._results = results
+            self._checked_at = time.monotonic()
+    
+    def warm_up(self, background: bool = True):
+        """Run every check once, creating and connecting the lazy clients"""
+        def run():
+            started = time.perf_counter()
+            results = self._run_checks()
+            self._store(results)
+            with self._lock:
+                self._warming = False
+            failed = [name for name, result in results.items() if not result["ok"]]
+            logger.info(f"Warm-up finished in {(time.perf_counter() - started) * 1000:.0f} ms"
+                        + (f", failing: {', '.join(failed)}" if failed else ""))
+        
+        with self._lock:
+            self._warming = True
+        if background:
+            threading.Thread(target=run, name="warm-up", daemon=True).start()
+        else:
+            run()
+    
+    def readiness(self) -> Tuple[bool, Dict]:
+        """Return (ready, report), re-running the checks once the last results are older than the TTL"""
+        with self._lock:
+            if self._warming:
+                return False, {"status": "starting", "checks": {}}
+            fresh = self._results and time.monotonic() - self._checked_at < self.ttl_seconds
+            results = self._results
+        if not fresh:
+            results = self._run_checks()
+            self._store(results)
+        ready = all(result["ok"] for result in results.values())
+        return ready, {"status": "ready" if ready else "unavailable", "checks": results}
+
+class AsyncHealthChecks:
+    """Event-loop counterpart of HealthChecks for the FastAPI app"""
+    
+    def __init__(self, ttl_seconds: float = 10):
+        self.ttl_seconds = ttl_seconds
+        self._checks: Dict[str, Callable[[], Awaitable[None]]] = {}
+        self._results: Dict[str, Dict] = {}
+        self._checked_at = 0.0
+        self._warm_up_task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+    
+    def add(self, name: str, check: Callable[[], Awaitable[None]]):
+        self._checks[name] = check
+    
+    async def _run_checks(self) -> Dict[str, Dict]:
+        async def run(name, check):
+            started = time.perf_counter()
+            try:
+                await check()
+                return name, _run_result(started, None)
+            except Exception as e:
+                logger.warning(f"Health check {name} failed: {str(e)}")
+                return name, _run_result(started, e)
+        
+        results = dict(await asyncio.gather(*(run(name, check) for name, check in self._checks.items())))
+        self._results = results
+        self._checked_at = time.monotonic()
+        return results
+    
+    def warm_up(self) -> asyncio.Task:
+        """Start running every check once in the background; cancel the task on shutdown"""
+        self._warm_up_task = asyncio.create_task(self._run_checks())
+        return self._warm_up_task
+    
+    async def readiness(self) -> Tuple[bool, Dict]:
+        if self._warm_up_task is not None and not self._warm_up_task.done():
+            return False, {"status": "starting", "checks": {}}
+        # One probe re-runs expired checks; concurrent probes wait for its results
+        async with self._lock:
+            results = self._results
+            if not results or time.monotonic() - self._checked_at >= self.ttl_seconds:
+                results = await self._run_checks()
+        ready = all(result["ok"] for result in results.values())
+        return ready, {"status": "ready" if ready else "unavailable", "checks": results}
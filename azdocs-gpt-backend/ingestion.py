@@ -0,0 +1,360 @@
+# ingestion.py - PDF ingestion into the search index
+from pypdf import PdfReader
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+import asyncio
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+def extract_pages(stream: BinaryIO) -> Iterator[Tuple[int, str]]:
+    """Yield (page number, text) one page at a time.
+    
+    pypdf reads the cross-reference table up front and then seeks to each page
+    object on demand, so a spooled upload is never read into memory whole.
+    """
+    reader = PdfReader(stream)
+    for number, page in enumerate(reader.pages, start=1):
+        yield number, re.sub(r"\s+", " ", page.extract_text() or "").strip()
+
+def chunk_text(text: str, chunk_size: int = 2000, overlap: int = 200) -> List[str]:
+    """Split text into windows of about ``chunk_size`` characters that share ``overlap`` characters.
+    
+    Window edges are moved back to the nearest space so words are not cut in half.
+    """
+    if len(text) <= chunk_size:
+        return [text] if text else []
+    
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + chunk_size)
+        if end < len(text):
+            space = text.rfind(" ", start + chunk_size // 2, end)
+            end = space if space != -1 else end
+        chunks.append(text[start:end].strip())
+        if end >= len(text):
+            break
+        next_start = max(start + 1, end - overlap)
+        space = text.find(" ", next_start, end)
+        start = space + 1 if space != -1 else next_start
+    return chunks
+
+def document_id(file_name: str) -> str:
+    """Stable index-safe parent id for an uploaded file, so re-uploads replace rather than duplicate it"""
+    return "doc_" + hashlib.sha256(file_name.strip().lower().encode("utf-8")).hexdigest()[:32]
+
+def chunk_key(parent_id: str, page: int, page_hash: str, index: int) -> str:
+    return f"{parent_id}_p{page}_{page_hash}_{index}"
+
+class IngestionStats:
+    """Progress counters for one upload"""
+    
+    def __init__(self, document_id: str, file_name: str):
+        self.document_id = document_id
+        self.file_name = file_name
+        self.pages = 0
+        self.pages_unchanged = 0
+        self.chunks_uploaded = 0
+        self.chunks_deleted = 0
+        self.started = time.perf_counter()
+    
+    def to_dict(self) -> Dict:
+        elapsed = max(time.perf_counter() - self.started, 1e-6)
+        return {
+            "documentId": self.document_id,
+            "fileName": self.file_name,
+            "pages": self.pages,
+            "pagesUnchanged": self.pages_unchanged,
+            "chunksUploaded": self.chunks_uploaded,
+            "chunksDeleted": self.chunks_deleted,
+            "seconds": round(elapsed, 2),
+            "pagesPerSecond": round(self.pages / elapsed, 2),
+            "chunksPerSecond": round(self.chunks_uploaded / elapsed, 2)
+        }
+
+class ChunkPlanner:
+    """Turns extracted pages into index documents, skipping pages already in the index.
+    
+    Chunk keys embed a hash of the page text, so a page whose text is
+    unchanged maps to the keys already stored and is skipped; a changed page
+    gets new keys, and the keys it used to have are reported by ``stale_keys``.
+    """
+    
+    def __init__(self, parent_id: str, title: str, existing_keys: Set[str], stats: IngestionStats,
+                 chunk_size: int = 2000, overlap: int = 200):
+        self.parent_id = parent_id
+        self.title = title
+        self.existing_keys = existing_keys
+        self.stats = stats
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+        self.current_keys: Set[str] = set()
+    
+    def documents(self, pages: Iterable[Tuple[int, str]]) -> Iterator[Dict]:
+        for number, text in pages:
+            self.stats.pages += 1
+            page_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+            chunks = chunk_text(text, self.chunk_size, self.overlap)
+            keys = [chunk_key(self.parent_id, number, page_hash, i) for i in range(len(chunks))]
+            self.current_keys.update(keys)
+            if all(key in self.existing_keys for key in keys):
+                self.stats.pages_unchanged += 1
+                continue
+            for key, chunk in zip(keys, chunks):
+                yield {"chunk_id": key, "parent_id": self.parent_id, "title": self.title, "chunk": chunk}
+    
+    @property
+    def stale_keys(self) -> Set[str]:
+        return self.existing_keys - self.current_keys
+
+class AzureSearchIndexSink:
+    """Writes chunks to the Azure AI Search index (the chunk_id/parent_id/title/chunk/text_vector layout)"""
+    
+    needs_vectors = True
+    
+    def __init__(self, client, vector_field: str = "text_vector", key_page_size: int = 1000):
+        self.client = client
+        self.vector_field = vector_field
+        self.key_page_size = key_page_size
+    
+    def _key_page(self, filter: str) -> List[str]:
+        results = self.client.search(search_text="*", filter=filter, select="chunk_id",
+                                     order_by=["chunk_id"], top=self.key_page_size)
+        return [result["chunk_id"] for result in results]
+    
+    def existing_keys(self, parent_id: str) -> Set[str]:
+        """Every chunk key stored for the document.
+        
+        A search returns 50 results unless told otherwise, so keys are read in
+        pages of ``key_page_size``, each starting after the last key of the one before.
+        """
+        keys: Set[str] = set()
+        last = None
+        while True:
+            filter = f"parent_id eq '{parent_id}'" + (f" and chunk_id gt '{last}'" if last else "")
+            page = self._key_page(filter)
+            keys.update(page)
+            if len(page) < self.key_page_size:
+                return keys
+            last = page[-1]
+    
+    def _upload_documents(self, documents: List[Dict]) -> List:
+        return self.client.upload_documents(documents=documents)
+    
+    def _delete_documents(self, documents: List[Dict]):
+        self.client.delete_documents(documents=documents)
+    
+    def upload(self, documents: List[Dict]):
+        results = self._upload_documents(documents)
+        failed = [result.key for result in results if not result.succeeded]
+        if failed:
+            raise RuntimeError(f"Search index rejected {len(failed)} of {len(documents)} chunks, e.g. {failed[0]}")
+    
+    def delete(self, keys: List[str]):
+        if keys:
+            self._delete_documents([{"chunk_id": key} for key in keys])
+    
+    def commit(self):
+        pass
+
+class AsyncAzureSearchIndexSink(AzureSearchIndexSink):
+    """AzureSearchIndexSink over the aio SearchClient, for the FastAPI app.
+    
+    IngestionService runs in worker threads, so each call is scheduled on
+    ``loop`` (the one that owns the client) and waited on from the thread.
+    """
+    
+    def __init__(self, client, loop: asyncio.AbstractEventLoop, vector_field: str = "text_vector",
+                 key_page_size: int = 1000):
+        super().__init__(client, vector_field, key_page_size)
+        self.loop = loop
+    
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+    
+    def _key_page(self, filter: str) -> List[str]:
+        async def page():
+            results = await self.client.search(search_text="*", filter=filter, select="chunk_id",
+                                               order_by=["chunk_id"], top=self.key_page_size)
+            return [result["chunk_id"] async for result in results]
+        return self._run(page())
+    
+    def _upload_documents(self, documents: List[Dict]) -> List:
+        return self._run(self.client.upload_documents(documents=documents))
+    
+    def _delete_documents(self, documents: List[Dict]):
+        self._run(self.client.delete_documents(documents=documents))
+
+class LocalIndexSink:
+    """Writes chunks to the local index's source documents and rebuilds it on commit.
+    
+    The local index is immutable once mapped, so a commit builds a fresh copy
+    next to it, swaps the directories and calls ``on_commit`` (which reloads
+    the search service). Sized for the CI and fallback corpora it serves.
+    """
+    
+    needs_vectors = False
+    
+    def __init__(self, index_path: str, on_commit: Optional[Callable[[], None]] = None):
+        self.index_path = index_path
+        self.on_commit = on_commit
+        self._upserts: Dict[str, Dict] = {}
+        self._deletes: Set[str] = set()
+        self._lock = threading.Lock()
+    
+    def _documents(self) -> Iterator[Dict]:
+        path = os.path.join(self.index_path, "documents.jsonl")
+        if not os.path.exists(path):
+            return
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    
+    def existing_keys(self, parent_id: str) -> Set[str]:
+        return {doc["chunk_id"] for doc in self._documents() if doc.get("parent_id") == parent_id}
+    
+    def upload(self, documents: List[Dict]):
+        with self._lock:
+            for document in documents:
+                self._upserts[document["chunk_id"]] = document
+    
+    def delete(self, keys: List[str]):
+        with self._lock:
+            self._deletes.update(keys)
+    
+    def commit(self):
+        with self._lock:
+            self._rebuild()
+    
+    def _rebuild(self):
+        from local_search import LocalSearchIndex
+        
+        if not self._upserts and not self._deletes:
+            return
+        documents = [
+            doc for doc in self._documents()
+            if doc.get("chunk_id") not in self._deletes and doc.get("chunk_id") not in self._upserts
+        ] + list(self._upserts.values())
+        
+        building = f"{self.index_path}.building"
+        retired = f"{self.index_path}.retired"
+        shutil.rmtree(building, ignore_errors=True)
+        LocalSearchIndex.build(documents, building)
+        # Mapped files of the old index stay readable after the swap until they are reloaded
+        if os.path.exists(self.index_path):
+            os.replace(self.index_path, retired)
+        os.replace(building, self.index_path)
+        shutil.rmtree(retired, ignore_errors=True)
+        self._upserts.clear()
+        self._deletes.clear()
+        if self.on_commit:
+            self.on_commit()
+
+class IngestionService:
+    """Streams an uploaded PDF into the search index.
+    
+    Pages are extracted one at a time and chunked with overlap. New chunks are
+    embedded in batches and uploaded in batches of ``upload_batch_size``; the
+    upload of one batch runs on a worker thread while the next is being
+    extracted and embedded. ``ingest`` yields a progress dict after every batch
+    and a final one with ``"done": True``.
+    """
+    
+    def __init__(self, sink, embed: Optional[Callable[[List[str]], List[List[float]]]] = None,
+                 chunk_size: int = 2000, overlap: int = 200, embed_batch_size: int = 16,
+                 upload_batch_size: int = 100, on_complete: Optional[Callable[[], None]] = None):
+        self.sink = sink
+        self.embed = embed
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+        self.embed_batch_size = embed_batch_size
+        self.upload_batch_size = upload_batch_size
+        self.on_complete = on_complete
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingest-upload")
+    
+    @classmethod
+    def from_config(cls, config, embedding_service, search_service) -> 'IngestionService':
+        if config.RETRIEVAL_BACKEND == 'local':
+            sink = LocalIndexSink(config.LOCAL_INDEX_PATH, on_commit=search_service.reload)
+            embed = None
+        else:
+            sink = AzureSearchIndexSink(search_service.client)
+            embed = embedding_service.embed if embedding_service else None
+        return cls(
+            sink,
+            embed,
+            chunk_size=config.INGEST_CHUNK_SIZE,
+            overlap=config.INGEST_CHUNK_OVERLAP,
+            embed_batch_size=config.INGEST_EMBED_BATCH_SIZE,
+            upload_batch_size=config.INGEST_UPLOAD_BATCH_SIZE,
+            on_complete=search_service.invalidate_cache
+        )
+    
+    def _with_vectors(self, documents: List[Dict]) -> List[Dict]:
+        if not self.sink.needs_vectors:
+            return documents
+        for start in range(0, len(documents), self.embed_batch_size):
+            batch = documents[start:start + self.embed_batch_size]
+            vectors = self.embed([doc["chunk"] for doc in batch])
+            for doc, vector in zip(batch, vectors):
+                doc[self.sink.vector_field] = vector
+        return documents
+    
+    def _upload(self, documents: List[Dict], stats: IngestionStats):
+        self.sink.upload(documents)
+        stats.chunks_uploaded += len(documents)
+    
+    def ingest(self, stream: BinaryIO, file_name: str) -> Iterator[Dict]:
+        if self.sink.needs_vectors and self.embed is None:
+            raise ValueError("The search index needs chunk vectors; configure an embedding deployment")
+        
+        parent_id = document_id(file_name)
+        stats = IngestionStats(parent_id, file_name)
+        planner = ChunkPlanner(parent_id, file_name, self.sink.existing_keys(parent_id), stats,
+                               self.chunk_size, self.overlap)
+        logger.info(f"Ingesting {file_name} as {parent_id} ({len(planner.existing_keys)} chunks already indexed)")
+        
+        in_flight: Optional[Future] = None
+        batch: List[Dict] = []
+        try:
+            for document in planner.documents(extract_pages(stream)):
+                batch.append(document)
+                if len(batch) < self.upload_batch_size:
+                    continue
+                documents = self._with_vectors(batch)
+                batch = []
+                if in_flight:
+                    in_flight.result()
+                in_flight = self.executor.submit(self._upload, documents, stats)
+                yield stats.to_dict()
+            
+            if batch:
+                documents = self._with_vectors(batch)
+                if in_flight:
+                    in_flight.result()
+                in_flight = self.executor.submit(self._upload, documents, stats)
+            if in_flight:
+                in_flight.result()
+            
+            stale = sorted(planner.stale_keys)
+            self.sink.delete(stale)
+            stats.chunks_deleted = len(stale)
+            self.sink.commit()
+        except Exception as e:
+            logger.error(f"Ingestion of {file_name} failed: {str(e)}")
+            raise
+        
+        if self.on_complete and (stats.chunks_uploaded or stats.chunks_deleted):
+            self.on_complete()
+        result = dict(stats.to_dict(), done=True)
+        logger.info(f"Ingested {file_name}: {result}")
+        yield result
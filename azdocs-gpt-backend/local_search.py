@@ -0,0 +1,295 @@
+# local_search.py - On-box hybrid retrieval (BM25 + vectors) over a memory-mapped index
+from services import AzureSearchService
+from telemetry import timed
+from typing import Callable, Dict, Iterable, List, Optional
+from collections import Counter
+import numpy as np
+import hashlib
+import json
+import mmap
+import os
+import re
+import time
+import zlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+INDEX_FORMAT_VERSION = 1
+
+STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from how i if in into is it its of on or so that the their "
+    "then there these this to was what when where which who why will with you your".split()
+)
+
+def tokenize(text: str) -> List[str]:
+    return [token for token in re.findall(r"\w+", text.lower()) if token not in STOPWORDS]
+
+def term_hash(term: str) -> int:
+    """Stable 64-bit term id, so the vocabulary can live in a sorted array instead of a dict"""
+    return int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little")
+
+class HashingEmbedder:
+    """Dependency-free text vectors: signed feature hashing of unigrams and bigrams, L2-normalised.
+    
+    It needs no model and gives the same vector on every machine, which is what
+    CI and load tests need. Indexes built with real embeddings pass them to
+    ``LocalSearchIndex.build`` and embed queries with the same model instead.
+    """
+    
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+        self._features: Dict[str, tuple] = {}
+    
+    def _feature(self, feature: str) -> tuple:
+        cached = self._features.get(feature)
+        if cached is None:
+            digest = zlib.crc32(feature.encode("utf-8"))
+            cached = (digest % self.dim, 1.0 if digest & 0x80000000 else -1.0)
+            if len(self._features) < 1_000_000:
+                self._features[feature] = cached
+        return cached
+    
+    def embed_tokens(self, tokens: List[str]) -> np.ndarray:
+        features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+        vector = np.zeros(self.dim, dtype=np.float32)
+        if not features:
+            return vector
+        buckets, signs = zip(*(self._feature(feature) for feature in features))
+        vector += np.bincount(buckets, weights=signs, minlength=self.dim).astype(np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+    
+    def embed(self, text: str) -> np.ndarray:
+        return self.embed_tokens(tokenize(text))
+
+class LocalSearchIndex:
+    """Read-only hybrid index loaded from a directory of memory-mapped arrays.
+    
+    Layout (written by ``build``):
+    
+    - ``meta.json``: document count, BM25 parameters and embedder settings
+    - ``terms.npy``: sorted 64-bit term hashes; a term's row is its posting list
+    - ``postings_offsets.npy`` / ``postings_docs.npy`` / ``postings_tf.npy``: CSR postings
+    - ``idf.npy`` per term, ``doc_norms.npy`` per document (the BM25 length normalisation)
+    - ``vectors.npy``: L2-normalised document vectors, one row per chunk
+    - ``text.bin`` / ``text_offsets.npy``: UTF-8 titles and chunks, sliced on demand
+    - ``documents.jsonl``: the source documents, used to rebuild the index after an upload
+    
+    ``load`` maps these files rather than deserialising them, so opening a
+    large index is near-instant and the OS page cache is shared by every worker.
+    """
+    
+    def __init__(self, path: str, meta: Dict, arrays: Dict[str, np.ndarray], text: mmap.mmap,
+                 embed: Optional[Callable[[str], np.ndarray]] = None):
+        self.path = path
+        self.meta = meta
+        self.doc_count = meta["docCount"]
+        self.k1 = meta["k1"]
+        self.terms = arrays["terms"]
+        self.postings_offsets = arrays["postings_offsets"]
+        self.postings_docs = arrays["postings_docs"]
+        self.postings_tf = arrays["postings_tf"]
+        self.idf = arrays["idf"]
+        self.doc_norms = arrays["doc_norms"]
+        self.vectors = arrays["vectors"]
+        self.text_offsets = arrays["text_offsets"]
+        self._text = text
+        if embed is None:
+            if meta["embedder"] != "hashing":
+                raise ValueError(f"Index {path} was built with '{meta['embedder']}' vectors; pass a query embedder")
+            embed = HashingEmbedder(meta["dim"]).embed
+        self.embed = embed
+    
+    ARRAYS = ("terms", "postings_offsets", "postings_docs", "postings_tf", "idf", "doc_norms", "vectors", "text_offsets")
+    
+    @classmethod
+    def load(cls, path: str, embed: Optional[Callable[[str], np.ndarray]] = None) -> 'LocalSearchIndex':
+        started = time.perf_counter()
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta.get("version") != INDEX_FORMAT_VERSION:
+            raise ValueError(f"Unsupported local index version {meta.get('version')} at {path}")
+        
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in cls.ARRAYS}
+        with open(os.path.join(path, "text.bin"), "rb") as f:
+            text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(f.name) else b""
+        
+        logger.info(f"Loaded local index {path} ({meta['docCount']} chunks) in {(time.perf_counter() - started) * 1000:.1f}ms")
+        return cls(path, meta, arrays, text, embed)
+    
+    @staticmethod
+    def build(documents: Iterable[Dict], path: str, dim: int = 256, k1: float = 1.2, b: float = 0.75,
+              vectors: Optional[np.ndarray] = None) -> Dict:
+        """Write an index for ``{"title", "chunk"}`` documents (optionally with ``chunk_id``/``parent_id``) to ``path``.
+        
+        ``vectors`` (one row per document) replaces the built-in hashing
+        embedder, e.g. with the embeddings already stored in Azure AI Search.
+        """
+        os.makedirs(path, exist_ok=True)
+        external_vectors = vectors is not None
+        embedder = HashingEmbedder(dim)
+        term_ids: Dict[str, int] = {}
+        posting_terms, posting_docs, posting_tfs = [], [], []
+        doc_lengths, hashed_vectors = [], []
+        text_offsets = [0]
+        
+        with open(os.path.join(path, "text.bin"), "wb") as text_file, \
+                open(os.path.join(path, "documents.jsonl"), "w", encoding="utf-8") as source_file:
+            for doc_id, document in enumerate(documents):
+                # Keep the source documents so ingestion can rebuild the index with chunks added or removed
+                source_file.write(json.dumps({
+                    "chunk_id": document.get("chunk_id") or f"chunk_{doc_id}",
+                    "parent_id": document.get("parent_id"),
+                    "title": document["title"],
+                    "chunk": document["chunk"]
+                }) + "\n")
+                tokens = tokenize(f"{document['title']} {document['chunk']}")
+                counts = Counter(tokens)
+                for term, tf in counts.items():
+                    posting_terms.append(term_ids.setdefault(term, len(term_ids)))
+                    posting_docs.append(doc_id)
+                    posting_tfs.append(tf)
+                doc_lengths.append(len(tokens))
+                if vectors is None:
+                    hashed_vectors.append(embedder.embed_tokens(tokens))
+                
+                for field in (document["title"], document["chunk"]):
+                    encoded = field.encode("utf-8")
+                    text_file.write(encoded)
+                    text_offsets.append(text_offsets[-1] + len(encoded))
+        
+        doc_count = len(doc_lengths)
+        lengths = np.asarray(doc_lengths, dtype=np.float32)
+        avg_length = float(lengths.mean()) if doc_count else 0.0
+        
+        # Vocabulary ordered by term hash so queries can binary-search it in place
+        vocabulary = list(term_ids)
+        hashes = np.fromiter((term_hash(term) for term in vocabulary), dtype=np.uint64, count=len(vocabulary))
+        hash_order = np.argsort(hashes, kind="stable")
+        row_of_term = np.empty(len(vocabulary), dtype=np.int64)
+        row_of_term[hash_order] = np.arange(len(vocabulary))
+        
+        rows = row_of_term[np.asarray(posting_terms, dtype=np.int64)]
+        order = np.argsort(rows, kind="stable")
+        doc_frequency = np.bincount(rows, minlength=len(vocabulary))
+        
+        if vectors is None:
+            vectors = np.vstack(hashed_vectors) if hashed_vectors else np.zeros((0, dim), dtype=np.float32)
+        else:
+            vectors = np.asarray(vectors, dtype=np.float32)
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors = vectors / np.where(norms == 0, 1, norms)
+        if len(vectors) != doc_count:
+            raise ValueError(f"Got {len(vectors)} vectors for {doc_count} documents")
+        
+        arrays = {
+            "terms": hashes[hash_order],
+            "postings_offsets": np.concatenate(([0], np.cumsum(doc_frequency))).astype(np.int64),
+            "postings_docs": np.asarray(posting_docs, dtype=np.int32)[order],
+            "postings_tf": np.asarray(posting_tfs, dtype=np.float32)[order],
+            "idf": np.log(1 + (doc_count - doc_frequency + 0.5) / (doc_frequency + 0.5)).astype(np.float32),
+            "doc_norms": (k1 * (1 - b + b * lengths / (avg_length or 1))).astype(np.float32),
+            "vectors": vectors,
+            "text_offsets": np.asarray(text_offsets, dtype=np.int64)
+        }
+        for name, array in arrays.items():
+            np.save(os.path.join(path, f"{name}.npy"), array)
+        
+        meta = {
+            "version": INDEX_FORMAT_VERSION,
+            "docCount": doc_count,
+            "termCount": len(vocabulary),
+            "avgDocLength": avg_length,
+            "k1": k1,
+            "b": b,
+            "dim": int(vectors.shape[1]) if doc_count else dim,
+            "embedder": "external" if external_vectors else "hashing"
+        }
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+        return meta
+    
+    def document(self, doc_id: int) -> Dict:
+        start, middle, end = self.text_offsets[2 * doc_id:2 * doc_id + 3]
+        return {
+            "title": self._text[start:middle].decode("utf-8"),
+            "content": self._text[middle:end].decode("utf-8")
+        }
+    
+    def bm25(self, query: str) -> Optional[np.ndarray]:
+        """BM25 score of every document, or None when no query term is in the index"""
+        hashes = np.asarray([term_hash(term) for term in set(tokenize(query))], dtype=np.uint64)
+        if not len(hashes) or not len(self.terms):
+            return None
+        rows = np.searchsorted(self.terms, hashes)
+        found = rows < len(self.terms)
+        rows, hashes = rows[found], hashes[found]
+        rows = rows[self.terms[rows] == hashes]
+        if not len(rows):
+            return None
+        
+        scores = np.zeros(self.doc_count, dtype=np.float32)
+        for row in rows:
+            start, end = self.postings_offsets[row], self.postings_offsets[row + 1]
+            docs = self.postings_docs[start:end]
+            tf = self.postings_tf[start:end]
+            # Posting lists hold each document once, so fancy-index accumulation is safe
+            scores[docs] += self.idf[row] * tf * (self.k1 + 1) / (tf + self.doc_norms[docs])
+        return scores
+    
+    @staticmethod
+    def _top(scores: np.ndarray, count: int, positive_only: bool = False) -> np.ndarray:
+        count = min(count, len(scores))
+        if count <= 0:
+            return np.empty(0, dtype=np.int64)
+        candidates = np.argpartition(-scores, count - 1)[:count]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return candidates[scores[candidates] > 0] if positive_only else candidates
+    
+    def search(self, query: str, top: int = 5, candidates: int = 50, rrf_k: int = 60,
+               query_vector: Optional[np.ndarray] = None) -> List[Dict]:
+        """Hybrid search: BM25 and cosine candidate lists fused with reciprocal rank fusion"""
+        if not self.doc_count:
+            return []
+        
+        ranked_lists = []
+        scores = self.bm25(query)
+        if scores is not None:
+            ranked_lists.append(self._top(scores, candidates, positive_only=True))
+        
+        vector = self.embed(query) if query_vector is None else query_vector
+        if np.any(vector):
+            similarities = self.vectors @ np.asarray(vector, dtype=np.float32)
+            ranked_lists.append(self._top(similarities, candidates, positive_only=True))
+        
+        fused: Dict[int, float] = {}
+        for ranked in ranked_lists:
+            for rank, doc_id in enumerate(ranked.tolist(), start=1):
+                fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (rrf_k + rank)
+        best = sorted(fused, key=fused.get, reverse=True)[:top]
+        return [dict(self.document(doc_id), score=round(fused[doc_id], 6)) for doc_id in best]
+
+class LocalSearchService(AzureSearchService):
+    """Drop-in for AzureSearchService that queries a LocalSearchIndex on this machine.
+    
+    Caching, multi-query fusion and context packing are inherited unchanged;
+    only the retrieval call differs. Selected with RETRIEVAL_BACKEND=local.
+    """
+    
+    def __init__(self, config, index: Optional[LocalSearchIndex] = None):
+        self.index = index or LocalSearchIndex.load(config.LOCAL_INDEX_PATH)
+        self.candidates = config.LOCAL_SEARCH_CANDIDATES
+        self._init_retrieval(config)
+    
+    def reload(self):
+        """Map the index again after it has been rebuilt in place (see ingestion.LocalIndexSink)"""
+        self.index = LocalSearchIndex.load(self.index.path)
+        self.invalidate_cache()
+    
+    def _cache_key(self, query: str) -> str:
+        return json.dumps([query, self.results_count, "local", self.index.path])
+    
+    @timed("search.query")
+    def _query(self, query: str, vector: Optional[List[float]] = None) -> List[Dict]:
+        return self.index.search(query, self.results_count, self.candidates, self.rrf_k, query_vector=vector)
@@ -1,16 +1,33 @@
-from fastapi import FastAPI, Request, Depends, HTTPException, Header
-from fastapi.responses import RedirectResponse, JSONResponse
+from fastapi import FastAPI, Request, Response, Depends, HTTPException, Header, UploadFile, File, Form
+from fastapi.responses import RedirectResponse, JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Optional, List, Dict, Any
-from azure.identity import DefaultAzureCredential, get_bearer_token_provider
-from azure.cosmos import CosmosClient, PartitionKey
-from azure.search.documents import SearchClient
-from azure.search.documents.models import VectorizableTextQuery
+from azure.identity.aio import DefaultAzureCredential, get_bearer_token_provider
+from azure.cosmos import PartitionKey
+from azure.cosmos.aio import CosmosClient
+from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import VectorizableTextQuery, VectorizedQuery
 from azure.core.credentials import AzureKeyCredential
-from openai import AzureOpenAI
+from openai import AsyncAzureOpenAI
 from msal import ConfidentialClientApplication
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.sessions import SessionMiddleware
+from contextlib import asynccontextmanager
+from cache import ChatListCache, LRUCache, AsyncSingleFlight
+from services import AnswerCache, QueryPlanner, HistoryCompactor, ContextPacker, TokenVerifier, reciprocal_rank_fusion, format_search_content
+from transport import AsyncTransport, LazyClient, TransportSettings
+from models import AsyncCosmosDBManager, ChatMessage, build_turn_messages, chat_etag, chat_list_etag, chat_to_api, begin_request_usage
+from embeddings import AsyncEmbeddingService, EmbeddingCache
+from health import AsyncHealthChecks
+from governor import AsyncOpenAIGovernor, OpenAIOverloadedError, estimate_tokens
+from telemetry import CONTENT_TYPE as METRICS_CONTENT_TYPE, RequestIdFilter, begin_request, record_http, record_tokens, registry, stage
+from serialization import REVALIDATE, CompressionMiddleware, Compressor
+from ingestion import AsyncAzureSearchIndexSink, IngestionService, LocalIndexSink
+import asyncio
+import logging
+import sys
+import time
 import uvicorn
 import requests
 import os
@@ -19,24 +36,24 @@ import uuid
 import json
 import jwt
 import datetime
+import telemetry
+import serialization
 
 load_dotenv()
 
-app = FastAPI()
+# Every log line carries the request id of the request that logged it
+log_handler = logging.StreamHandler(sys.stdout)
+log_handler.addFilter(RequestIdFilter())
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s',
+    handlers=[log_handler]
+)
+logger = logging.getLogger(__name__)
 
 # Secret key for JWT
 SECRET_KEY = os.getenv("FLASK_SECRET_KEY", "change-this-key-in-prod")
 
-# Middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["http://localhost:3000"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-app.add_middleware(SessionMiddleware, secret_key=SECRET_KEY)
-
 # Azure Config - Updated to use correct environment variable names
 COSMOS_ENDPOINT = os.getenv("COSMOS_ENDPOINT")
 COSMOS_KEY = os.getenv("COSMOS_KEY")
@@ -53,7 +70,60 @@ AZURE_AUTHORITY = f"https://login.microsoftonline.com/{AZURE_TENANT_ID}"
 AZURE_SCOPE = [os.getenv("AZURE_AD_SCOPE")]
 AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
 AZURE_OPENAI_DEPLOYMENT = os.getenv("AZURE_OPENAI_DEPLOYMENT")
+AZURE_OPENAI_EMBEDDING_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT")
+ADMIN_ROLE = os.getenv("ADMIN_ROLE", "Admin")
 REDIRECT_PATH = "/getAToken"
+ANSWER_CACHE_TTL_SECONDS = int(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1024"))
+SEARCH_CACHE_TTL_SECONDS = int(os.getenv("SEARCH_CACHE_TTL_SECONDS", "900"))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "2048"))
+SEARCH_CACHE_MAX_BYTES = int(os.getenv("SEARCH_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+SEMANTIC_CONFIG = "azdocs-test3-semantic-configuration"
+QUERY_PLANNING_STRATEGY = os.getenv("QUERY_PLANNING_STRATEGY", "llm")
+QUERY_LOCAL_MAX_WORDS = int(os.getenv("QUERY_LOCAL_MAX_WORDS", "24"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "3000"))
+HISTORY_RECENT_MESSAGES = int(os.getenv("HISTORY_RECENT_MESSAGES", "6"))
+HISTORY_TRUNCATE_CHARS = int(os.getenv("HISTORY_TRUNCATE_CHARS", "400"))
+AUTH_CLAIMS_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_CLAIMS_CACHE_MAX_ENTRIES", "4096"))
+AUTH_CLAIMS_CACHE_TTL_SECONDS = int(os.getenv("AUTH_CLAIMS_CACHE_TTL_SECONDS", "300"))
+SEARCH_SELECT = "title,chunk"
+SEARCH_MAX_PARALLEL_QUERIES = int(os.getenv("SEARCH_MAX_PARALLEL_QUERIES", "4"))
+SEARCH_RRF_K = int(os.getenv("SEARCH_RRF_K", "60"))
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "azure").lower()
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", "local_index")
+LOCAL_SEARCH_CANDIDATES = int(os.getenv("LOCAL_SEARCH_CANDIDATES", "50"))
+SEARCH_QUERY_VECTORS = os.getenv("SEARCH_QUERY_VECTORS", "server").lower()
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache")
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "1000000"))
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "5"))
+EMBEDDING_MAX_BATCH = int(os.getenv("EMBEDDING_MAX_BATCH", "16"))
+INGEST_CHUNK_SIZE = int(os.getenv("INGEST_CHUNK_SIZE", "2000"))
+INGEST_CHUNK_OVERLAP = int(os.getenv("INGEST_CHUNK_OVERLAP", "200"))
+INGEST_EMBED_BATCH_SIZE = int(os.getenv("INGEST_EMBED_BATCH_SIZE", "16"))
+INGEST_UPLOAD_BATCH_SIZE = int(os.getenv("INGEST_UPLOAD_BATCH_SIZE", "100"))
+CONTEXT_PACKING_ENABLED = os.getenv("CONTEXT_PACKING_ENABLED", "true").lower() == "true"
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2000"))
+CONTEXT_DEDUP_THRESHOLD = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", "0.85"))
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+OPENAI_GOVERNOR_ENABLED = os.getenv("OPENAI_GOVERNOR_ENABLED", "true").lower() == "true"
+OPENAI_TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", "0"))
+OPENAI_RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", "0"))
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "16"))
+OPENAI_MAX_QUEUE = int(os.getenv("OPENAI_MAX_QUEUE", "200"))
+OPENAI_MAX_QUEUE_SECONDS = float(os.getenv("OPENAI_MAX_QUEUE_SECONDS", "30"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+OPENAI_COMPLETION_TOKEN_ESTIMATE = int(os.getenv("OPENAI_COMPLETION_TOKEN_ESTIMATE", "500"))
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+OTEL_ENABLED = os.getenv("OTEL_ENABLED", "false").lower() == "true"
+COSMOS_AUTO_PROVISION = os.getenv("COSMOS_AUTO_PROVISION", "false").lower() == "true"
+WARMUP_ON_START = os.getenv("WARMUP_ON_START", "true").lower() == "true"
+HEALTH_CHECK_TTL_SECONDS = float(os.getenv("HEALTH_CHECK_TTL_SECONDS", "10"))
+JSON_ENCODER = os.getenv("JSON_ENCODER", "auto")
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "true").lower() == "true"
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", "1"))
+CHAT_LIST_CACHE_TTL_SECONDS = float(os.getenv("CHAT_LIST_CACHE_TTL_SECONDS", "30"))
+CHAT_LIST_CACHE_MAX_USERS = int(os.getenv("CHAT_LIST_CACHE_MAX_USERS", "10000"))
 
 # System prompt for the chatbot
 SYSTEM_PROMPT = ("You are an expert assistant that helps developers with their questions about Azure. "
@@ -63,35 +133,235 @@ SYSTEM_PROMPT = ("You are an expert assistant that helps developers with their q
                 "Write your answer in markdown. "
                 "If you see that search results are unrelated to the product the user is talking about, point that out and say you don't have good grounding data to answer.")
 
-# Initialize Azure services
-azure_credential = DefaultAzureCredential()
+SEARCH_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "search",
+            "description": "Search the documentation to find the right data to answer the last question in this conversation.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "query": {
+                        "type": "string",
+                        "description": "The search query to use for the documentation."
+                    }
+                },
+                "required": ["query"],
+                "additionalProperties": False
+            }
+        }
+    }
+]
 
-openai_client = AzureOpenAI(
-    api_version="2023-03-15-preview",
-    azure_endpoint=AZURE_OPENAI_ENDPOINT,
-    azure_ad_token_provider=get_bearer_token_provider(azure_credential, "https://cognitiveservices.azure.com/.default")
-)
+NO_SEARCH_RESPONSE = "I'm not sure how to answer your question without searching for more information."
 
-search_client = SearchClient(
-    endpoint=SEARCH_ENDPOINT,
-    index_name=SEARCH_INDEX,
-    credential=AzureKeyCredential(SEARCH_KEY)
-)
+# Azure clients shared by every request, opened and closed by the app lifespan
+class AzureClients:
+    credential: Optional[DefaultAzureCredential] = None
+    openai: Optional[AsyncAzureOpenAI] = None
+    chat = None  # openai.chat, without SDK retries when the governor owns them
+    search: Optional[SearchClient] = None
+    cosmos: Optional[CosmosClient] = None
+    container = None
+    chat_store: Optional[AsyncCosmosDBManager] = None
+    msal_app: Optional[LazyClient] = None  # ConfidentialClientApplication, built on first use
+    transport: Optional[AsyncTransport] = None
+    local_index = None  # LocalSearchIndex when RETRIEVAL_BACKEND=local
+    embeddings: Optional[AsyncEmbeddingService] = None
+    ingestion: Optional[IngestionService] = None
+
+    async def close(self):
+        for client in (self.openai, self.search, self.cosmos, self.credential):
+            if client is not None:
+                await client.close()
+        if self.transport is not None:
+            await self.transport.aclose()
+
+clients = AzureClients()
+
+# In-process answer cache, keyed by search query and retrieved chunk set
+answer_cache = AnswerCache(LRUCache(max_entries=ANSWER_CACHE_MAX_ENTRIES, ttl_seconds=ANSWER_CACHE_TTL_SECONDS))
+
+# Verified token claims, keyed by token digest, so repeat calls skip the HMAC check
+token_verifier = TokenVerifier(SECRET_KEY, AUTH_CLAIMS_CACHE_MAX_ENTRIES, AUTH_CLAIMS_CACHE_TTL_SECONDS)
+
+query_planner = QueryPlanner(QUERY_PLANNING_STRATEGY, QUERY_LOCAL_MAX_WORDS)
+history_compactor = HistoryCompactor(HISTORY_TOKEN_BUDGET, HISTORY_RECENT_MESSAGES, HISTORY_TRUNCATE_CHARS)
+context_packer = ContextPacker(CONTEXT_TOKEN_BUDGET, CONTEXT_DEDUP_THRESHOLD) if CONTEXT_PACKING_ENABLED else None
+
+# Identical questions in flight at the same time share one retrieval and answer
+single_flight = AsyncSingleFlight() if SINGLE_FLIGHT_ENABLED else None
 
-# Initialize Cosmos DB client
-cosmos_client = CosmosClient(COSMOS_ENDPOINT, COSMOS_KEY)
-database = cosmos_client.create_database_if_not_exists(id=DATABASE_NAME)
-container = database.create_container_if_not_exists(
-    id=CONTAINER_NAME,
-    partition_key=PartitionKey(path="/userId"),
-    offer_throughput=400
+# Each user's chat list, dropped by the chat store whenever one of their chats is written
+chat_lists = ChatListCache(CHAT_LIST_CACHE_MAX_USERS, CHAT_LIST_CACHE_TTL_SECONDS) if CHAT_LIST_CACHE_TTL_SECONDS > 0 else None
+
+# Paces chat completions to the deployment's TPM/RPM quota, queueing fairly per user
+governor = AsyncOpenAIGovernor(
+    OPENAI_TPM_LIMIT, OPENAI_RPM_LIMIT, OPENAI_MAX_CONCURRENCY, OPENAI_MAX_QUEUE, OPENAI_MAX_QUEUE_SECONDS,
+    OPENAI_MAX_RETRIES
+) if OPENAI_GOVERNOR_ENABLED else None
+
+# Per-stage latency histograms, token and RU counters, served on /metrics
+telemetry.configure(METRICS_ENABLED, OTEL_ENABLED)
+serialization.configure(JSON_ENCODER)
+if governor:
+    registry.gauge("azdocs_openai_queue_depth", "OpenAI calls waiting for capacity", lambda: governor.stats()["queueDepth"])
+    registry.gauge("azdocs_openai_active_calls", "OpenAI calls in progress", lambda: governor.stats()["active"])
+if single_flight:
+    registry.gauge("azdocs_single_flight_in_flight", "Chat stages currently running on behalf of waiting requests",
+                   lambda: single_flight.stats()["inFlight"])
+
+# Dependency checks behind /health/ready; the first run (the lifespan's warm-up) connects the clients
+health_checks = AsyncHealthChecks(HEALTH_CHECK_TTL_SECONDS)
+
+async def check_cosmos():
+    await clients.container.read()
+
+async def check_search():
+    if clients.search is not None:
+        await clients.search.get_document_count()
+
+health_checks.add("cosmos", check_cosmos)
+health_checks.add("auth", lambda: get_msal_app())
+health_checks.add("search", check_search)
+
+# Search results keyed on (query, top, semantic config, select fields)
+search_cache = LRUCache(
+    max_entries=SEARCH_CACHE_MAX_ENTRIES,
+    ttl_seconds=SEARCH_CACHE_TTL_SECONDS,
+    max_bytes=SEARCH_CACHE_MAX_BYTES,
+    size_of=lambda result: len(result[0]) + sum(len(r["title"]) + len(r["content"]) for r in result[1])
 )
 
-msal_app = ConfidentialClientApplication(
-    AZURE_CLIENT_ID,
-    authority=AZURE_AUTHORITY,
-    client_credential=AZURE_CLIENT_SECRET
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Initialize Azure services over shared, pooled connections
+    clients.transport = AsyncTransport(TransportSettings.from_env())
+    clients.credential = DefaultAzureCredential()
+    
+    clients.openai = AsyncAzureOpenAI(
+        api_version="2023-03-15-preview",
+        azure_endpoint=AZURE_OPENAI_ENDPOINT,
+        azure_ad_token_provider=get_bearer_token_provider(clients.credential, "https://cognitiveservices.azure.com/.default"),
+        **clients.transport.openai_options()
+    )
+    clients.chat = (clients.openai.with_options(max_retries=0) if governor else clients.openai).chat
+    
+    if AZURE_OPENAI_EMBEDDING_DEPLOYMENT:
+        async def embed_batch(texts: List[str]) -> List[List[float]]:
+            response = await clients.openai.embeddings.create(model=AZURE_OPENAI_EMBEDDING_DEPLOYMENT, input=texts)
+            return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        
+        cache = EmbeddingCache(EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_ENTRIES) if EMBEDDING_CACHE_PATH else None
+        clients.embeddings = AsyncEmbeddingService(
+            embed_batch, AZURE_OPENAI_EMBEDDING_DEPLOYMENT, cache, EMBEDDING_BATCH_WINDOW_MS, EMBEDDING_MAX_BATCH
+        )
+    
+    if RETRIEVAL_BACKEND == "local":
+        from local_search import LocalSearchIndex
+        clients.local_index = LocalSearchIndex.load(LOCAL_INDEX_PATH)
+        
+        def reload_local_index():
+            clients.local_index = LocalSearchIndex.load(LOCAL_INDEX_PATH)
+        
+        sink = LocalIndexSink(LOCAL_INDEX_PATH, on_commit=reload_local_index)
+        embed = None
+    else:
+        clients.search = SearchClient(
+            endpoint=SEARCH_ENDPOINT,
+            index_name=SEARCH_INDEX,
+            credential=AzureKeyCredential(SEARCH_KEY),
+            **clients.transport.azure_options("search")
+        )
+        # Ingestion runs in worker threads; its search and embedding calls are handed back to this loop
+        loop = asyncio.get_running_loop()
+        sink = AsyncAzureSearchIndexSink(clients.search, loop)
+        embed = None
+        if clients.embeddings is not None:
+            def embed(texts: List[str]) -> List[List[float]]:
+                return asyncio.run_coroutine_threadsafe(clients.embeddings.embed(texts), loop).result()
+    
+    # One service (and one sink) for all uploads, so concurrent uploads share its lock and upload worker
+    clients.ingestion = IngestionService(
+        sink,
+        embed,
+        chunk_size=INGEST_CHUNK_SIZE,
+        overlap=INGEST_CHUNK_OVERLAP,
+        embed_batch_size=INGEST_EMBED_BATCH_SIZE,
+        upload_batch_size=INGEST_UPLOAD_BATCH_SIZE,
+        on_complete=search_cache.clear
+    )
+    
+    # Initialize Cosmos DB client; it connects on the first request (or the warm-up)
+    clients.cosmos = CosmosClient(COSMOS_ENDPOINT, COSMOS_KEY, **clients.transport.azure_options("cosmos"))
+    if COSMOS_AUTO_PROVISION:
+        database = await clients.cosmos.create_database_if_not_exists(id=DATABASE_NAME)
+        clients.container = await database.create_container_if_not_exists(
+            id=CONTAINER_NAME,
+            partition_key=PartitionKey(path="/userId"),
+            offer_throughput=400
+        )
+    else:
+        # Created once per environment by provision.py
+        clients.container = clients.cosmos.get_database_client(DATABASE_NAME).get_container_client(CONTAINER_NAME)
+    clients.chat_store = AsyncCosmosDBManager(clients.container, chat_lists)
+    
+    # MSAL is synchronous and performs authority discovery on construction, so defer it to first use
+    msal_options = clients.transport.msal_options()
+    clients.msal_app = LazyClient(lambda: ConfidentialClientApplication(
+        AZURE_CLIENT_ID,
+        authority=AZURE_AUTHORITY,
+        client_credential=AZURE_CLIENT_SECRET,
+        **msal_options
+    ), "MSAL client")
+    
+    warm_up = health_checks.warm_up() if WARMUP_ON_START else None
+    try:
+        yield
+    finally:
+        if warm_up:
+            warm_up.cancel()
+        await clients.close()
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse encoded by serialization.dumps (orjson when installed).
+    
+    Routes with large payloads return it directly, which also skips FastAPI's
+    recursive jsonable_encoder pass over the content.
+    """
+    
+    def render(self, content: Any) -> bytes:
+        return serialization.dumps(content)
+
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
+
+# Middleware
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["http://localhost:3000"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+    expose_headers=["X-Continuation-Token", "ETag"],
 )
+app.add_middleware(SessionMiddleware, secret_key=SECRET_KEY)
+# Inside log_cosmos_usage, so the recorded latency includes compression
+app.add_middleware(CompressionMiddleware, compressor=Compressor(COMPRESSION_ENABLED, COMPRESSION_MIN_BYTES, COMPRESSION_LEVEL))
+
+@app.middleware("http")
+async def log_cosmos_usage(request: Request, call_next):
+    """Tags each request with an id and records its latency and Cosmos DB request charge"""
+    request_id = begin_request(request.headers.get("X-Request-ID"))
+    started = time.perf_counter()
+    usage = begin_request_usage()
+    response = await call_next(request)
+    if usage.calls:
+        logger.info(f"{request.method} {request.url.path}: {usage}")
+    response.headers["X-Request-ID"] = request_id
+    route = request.scope.get("route")
+    record_http(request.method, route.path if route else "unmatched", response.status_code, time.perf_counter() - started)
+    return response
 
 # Models
 class ChatRequest(BaseModel):
@@ -102,83 +372,219 @@ class SaveChatRequest(BaseModel):
     chat_id: str
     messages: List[Dict[str, Any]]
 
-class Message(BaseModel):
-    id: str
-    sender: str
-    content: str
-    timestamp: str
-    references: Optional[List[Dict[str, str]]] = []
-
-class ChatResponse(BaseModel):
-    id: str
-    messages: List[Message]
-    lastUpdated: str
-
 # Helper functions
-def get_user_id_from_token(authorization: str = Header(None)):
+def get_user_id_from_token(authorization: Optional[str]):
     if not authorization or not authorization.startswith('Bearer '):
         return None
     
-    token = authorization.split(' ')[1]
-    print(f"Token: {token}")
-    try:
-        decoded = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-        return decoded.get("sub")
-    except Exception as e:
-        print(f"Token decode error: {e}")
-        return None
+    decoded = token_verifier.verify(authorization.split(' ')[1])
+    return decoded.get("sub") if decoded else None
 
-def search_azure(query: str, n: int = 5):
-    results = search_client.search(
+def require_user_id(authorization: str = Header(None)) -> str:
+    """Dependency for authenticated routes: the caller's user ID, or a 401"""
+    user_id = get_user_id_from_token(authorization)
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    return user_id
+
+def require_admin(authorization: str = Header(None)) -> str:
+    """Dependency for admin routes: the caller's user ID, or a 401/403"""
+    claims = token_verifier.verify(authorization.split(' ')[1]) if authorization and authorization.startswith('Bearer ') else None
+    if not claims or not claims.get("sub"):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    if ADMIN_ROLE not in claims.get("roles", []):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return claims["sub"]
+
+async def search_azure(query: str, n: int = 5):
+    cache_key = json.dumps([query, n, SEMANTIC_CONFIG, SEARCH_SELECT])
+    cached = search_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    if SEARCH_QUERY_VECTORS == "client" and clients.embeddings is not None:
+        # Cached query embedding; repeated queries skip vectorization entirely
+        vector = await clients.embeddings.embed_query(query)
+        vector_query = VectorizedQuery(vector=vector, k_nearest_neighbors=50, fields="text_vector")
+    else:
+        vector_query = VectorizableTextQuery(text=query, k_nearest_neighbors=50, fields="text_vector")
+    
+    results = await clients.search.search(
         search_text=query,
         query_type="semantic",
-        semantic_configuration_name="azdocs-test3-semantic-configuration",
-        select="title,chunk",
+        semantic_configuration_name=SEMANTIC_CONFIG,
+        select=SEARCH_SELECT,
         top=n,
-        vector_queries=[VectorizableTextQuery(text=query, k_nearest_neighbors=50, fields="text_vector")]
+        vector_queries=[vector_query]
     )
     
-    references = []
-    content = ""
+    references = [
+        {"title": r['title'], "content": r['chunk'], "score": r.get('@search.reranker_score')}
+        async for r in results
+    ]
+    content = format_search_content(references)
     
-    for r in results:
-        content += f"[{r['title']}]: {r['chunk']}\n----\n"
-        references.append({
-            "title": r['title'],
-            "content": r['chunk']
-        })
+    search_cache.set(cache_key, (content, references))
+    return content, references
+
+async def search_local(query: str, n: int = 5):
+    """Same contract as search_azure, served from the on-box index (RETRIEVAL_BACKEND=local)."""
+    cache_key = json.dumps([query, n, "local", LOCAL_INDEX_PATH])
+    cached = search_cache.get(cache_key)
+    if cached is not None:
+        return cached
     
+    # NumPy releases the GIL for the scoring, so a worker thread keeps the event loop free
+    references = await run_in_threadpool(clients.local_index.search, query, n, LOCAL_SEARCH_CANDIDATES, SEARCH_RRF_K)
+    content = format_search_content(references)
+    
+    search_cache.set(cache_key, (content, references))
     return content, references
 
-def store_user_chat(user_id: str, chat_id: str, messages: List[Dict]):
-    """Stores or updates a chat document for the user."""
-    item = {
-        "id": chat_id,
-        "userId": user_id,
-        "messages": messages,
-        "lastUpdated": datetime.datetime.utcnow().isoformat()
-    }
-    container.upsert_item(item)
-    return item
-
-def get_user_chats(user_id: str):
-    """Retrieves all chat documents for a given user."""
-    query = "SELECT * FROM c WHERE c.userId = @userId"
-    parameters = [{"name": "@userId", "value": user_id}]
-    items = list(container.query_items(
-        query=query,
-        parameters=parameters,
-        enable_cross_partition_query=True
-    ))
-    return items
+async def retrieve(queries: List[str], n: int = 5):
+    """Runs the queries concurrently, fuses their rankings (RRF) and packs the result into the context budget."""
+    queries = list(dict.fromkeys(queries))[:SEARCH_MAX_PARALLEL_QUERIES]
+    search = search_local if clients.local_index is not None else search_azure
+    if len(queries) == 1:
+        references = (await search(queries[0], n))[1]
+    else:
+        results = await asyncio.gather(*(search(query, n) for query in queries))
+        references = reciprocal_rank_fusion([refs for _, refs in results], n, SEARCH_RRF_K)
+    
+    if context_packer:
+        return context_packer.pack(references)
+    return format_search_content(references), references
+
+async def store_user_chat(user_id: str, chat_id: str, messages: List[Dict]):
+    """Stores or replaces a whole chat for the user from API message dicts."""
+    title = next((m.get("content", "")[:50] for m in messages if m.get("sender") == "user"), "New Chat")
+    chat_messages = [ChatMessage.from_api(message, seq) for seq, message in enumerate(messages, 1)]
+    return await clients.chat_store.store_user_chat(user_id, chat_id, title, chat_messages)
+
+async def get_user_chats(user_id: str):
+    """Retrieves all chats, with their messages, for a given user."""
+    return await clients.chat_store.get_user_chats(user_id)
+
+def build_chat_messages(chat_history: List[ChatMessage], user_message: str) -> List[Dict]:
+    """Builds the OpenAI message list from the system prompt, history and new message."""
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    
+    # Add previous chat history, compacted to the configured token budget
+    with stage("chat.history"):
+        history, _ = history_compactor.compact(chat_history)
+    messages.extend(history)
+    
+    # Add current user message
+    messages.append({"role": "user", "content": user_message})
+    return messages
+
+def build_answer_messages(messages: List[Dict], calls: List, search_content: str) -> List[Dict]:
+    """Appends the search tool calls and the fused results (answered on the first call) to the conversation."""
+    tool_messages = [{"role": "tool", "tool_call_id": calls[0].id, "content": search_content}]
+    tool_messages += [
+        {"role": "tool", "tool_call_id": call.id, "content": "Results merged into the first search."}
+        for call in calls[1:]
+    ]
+    return messages + [
+        {"role": "assistant", "content": "I'll search for information to help answer your question.", "tool_calls": calls}
+    ] + tool_messages
+
+async def save_chat_turn(user_id: str, chat_id: str, existing_chat: Optional[Dict], user_message: str,
+                         assistant_response: str, references: List[Dict]):
+    """Appends the user/bot exchange to the chat, writing only the new messages."""
+    chat_history = existing_chat["messages"] if existing_chat else []
+    new_messages = build_turn_messages(len(chat_history) + 1, user_message, assistant_response, references)
+    chat_name = existing_chat["title"] if existing_chat and existing_chat.get("title") else user_message[:50]
+    with stage("chat.save"):
+        await clients.chat_store.append_messages(user_id, chat_id, chat_name, new_messages, existing_chat)
+
+async def load_chat(user_id: str, chat_id: str) -> Optional[Dict]:
+    """Returns the stored chat, or None if it doesn't exist or can't be read."""
+    try:
+        with stage("chat.load"):
+            return await clients.chat_store.get_chat_by_id(user_id, chat_id, with_references=False)
+    except Exception as e:
+        logger.error(f"Error fetching chat history for chat {chat_id}: {str(e)}")
+        return None
+
+async def complete(messages: List[Dict], user_id: Optional[str] = None, completion_tokens: Optional[int] = None, **options):
+    """Calls chat.completions.create through the rate governor, when enabled."""
+    async def create():
+        return await clients.chat.completions.create(model=AZURE_OPENAI_DEPLOYMENT, messages=messages, **options)
+    
+    tokens = estimate_tokens(messages, completion_tokens or OPENAI_COMPLETION_TOKEN_ESTIMATE)
+    if options.get("stream"):
+        # Streamed responses carry no usage, so they are not counted in the token metrics
+        return governor.stream(create, tokens, user_id) if governor else await create()
+    with stage("openai.completion"):
+        completion = await governor.call(create, tokens, user_id) if governor else await create()
+    record_tokens(getattr(completion, "usage", None))
+    return completion
+
+async def plan_search_calls(messages: List[Dict], chat_history: List[ChatMessage], user_message: str,
+                            user_id: Optional[str] = None) -> List:
+    """Returns the search tool calls for this turn, skipping the LLM when the query can be planned locally."""
+    with stage("chat.plan"):
+        planned = query_planner.plan_locally(chat_history, user_message)
+        if planned:
+            return [planned[1]]
+        
+        completion = await complete(messages, user_id, completion_tokens=100, tools=SEARCH_TOOLS)
+    
+    # Check if the model wants to search
+    if completion.choices[0].finish_reason != "tool_calls":
+        return []
+    return [call for call in completion.choices[0].message.tool_calls if call.function.name == "search"]
+
+async def coalesced(name: str, turn_key: str, fn):
+    """Runs one pipeline stage, sharing it with identical turns already in flight."""
+    with stage(f"chat.{name}"):
+        if single_flight is None:
+            return await fn()
+        return await single_flight.do(f"{name}:{turn_key}", fn)
+
+async def retrieve_for_turn(messages: List[Dict], chat_history: List[ChatMessage], user_message: str,
+                            user_id: Optional[str] = None):
+    """Plans and runs the searches, returning (search_calls, query, search_content, references)."""
+    search_calls = await plan_search_calls(messages, chat_history, user_message, user_id)
+    if not search_calls:
+        return search_calls, None, "", []
+    
+    queries = [json.loads(call.function.arguments)["query"] for call in search_calls]
+    with stage("chat.search"):
+        search_content, references = await retrieve(queries)
+    return search_calls, " | ".join(queries), search_content, references
+
+def format_sse_event(event: str, data: Any) -> str:
+    """Formats a Server-Sent Events message with a JSON payload."""
+    return f"event: {event}\ndata: {serialization.dumps(data).decode('utf-8')}\n\n"
 
 # Routes
 @app.get("/")
-def index():
+async def index():
     return {"message": "Welcome to the AzDocs-GPT API!"}
 
+@app.get("/health")
+@app.get("/health/live")
+async def liveness():
+    """Liveness: the process is up; never touches a dependency."""
+    return {"status": "healthy", "timestamp": datetime.datetime.utcnow().isoformat()}
+
+@app.get("/health/ready")
+async def readiness():
+    """Readiness: warm-up has finished and Cosmos DB, Azure AD and Search answer."""
+    ready, report = await health_checks.readiness()
+    return JSONResponse(report, status_code=200 if ready else 503)
+
+async def get_msal_app() -> ConfidentialClientApplication:
+    """Returns the MSAL client, building it (authority discovery) off the event loop on first use."""
+    if clients.msal_app.created:
+        return clients.msal_app.get()
+    return await run_in_threadpool(clients.msal_app.get)
+
 @app.get("/login")
-def login():
+async def login():
+    msal_app = await get_msal_app()
     auth_url = msal_app.get_authorization_request_url(
         scopes=AZURE_SCOPE,
         redirect_uri=AZURE_REDIRECT_URI
@@ -186,11 +592,14 @@ def login():
     return RedirectResponse(auth_url)
 
 @app.get("/getAToken")
-def get_token(request: Request, code: str = None):
+async def get_token(request: Request, code: str = None):
     if not code:
         raise HTTPException(status_code=400, detail="Authorization failed")
     
-    result = msal_app.acquire_token_by_authorization_code(
+    # MSAL only ships a blocking client, keep it off the event loop
+    msal_app = await get_msal_app()
+    result = await run_in_threadpool(
+        msal_app.acquire_token_by_authorization_code,
         code,
         scopes=AZURE_SCOPE,
         redirect_uri=AZURE_REDIRECT_URI
@@ -198,7 +607,7 @@ def get_token(request: Request, code: str = None):
     
     if "access_token" in result:
         user_info = result.get("id_token_claims")
-        print(f"User authenticated: {user_info}")
+        logger.info(f"User authenticated: {user_info.get('oid')}")
         
         # Create JWT token
         token_payload = {
@@ -210,7 +619,6 @@ def get_token(request: Request, code: str = None):
         }
         
         jwt_token = jwt.encode(token_payload, SECRET_KEY, algorithm="HS256")
-        print(f"JWT Token: {jwt_token}")
         
         return RedirectResponse(f"http://localhost:3000/auth/callback?token={jwt_token}")
     
@@ -220,90 +628,93 @@ def get_token(request: Request, code: str = None):
     )
 
 @app.get("/logout")
-def logout(request: Request):
+async def logout(request: Request):
     request.session.clear()
     return RedirectResponse(f"{AZURE_AUTHORITY}/oauth2/v2.0/logout?post_logout_redirect_uri=http://localhost:5000/")
 
+def not_modified(request: Request, etag: str) -> Optional[Response]:
+    """A 304 response when the request's If-None-Match matches the ETag, else None"""
+    matched = serialization.matching_etag(request.headers.get("if-none-match"), etag)
+    if matched is None:
+        return None
+    return Response(status_code=304, headers={"ETag": matched, "Cache-Control": REVALIDATE})
+
 # Chat history endpoints
 @app.get("/api/chats")
-def get_chats(authorization: str = Header(None)):
-    user_id = get_user_id_from_token(authorization)
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Unauthorized")
+async def get_chats(request: Request, limit: Optional[int] = None, continuation: Optional[str] = None,
+                    full: bool = False, user_id: str = Depends(require_user_id)):
+    # ?full=true returns every chat with its messages
+    if full:
+        chats = await get_user_chats(user_id)
+        return FastJSONResponse([
+            {"id": chat["id"], "title": chat.get("title"), "messages": [m.to_api() for m in chat["messages"]],
+             "lastUpdated": chat["lastUpdated"]}
+            for chat in chats
+        ])
     
-    chats = get_user_chats(user_id)
-    data = []
-    for chat in chats:
-        data.append({
-            "id": chat["id"],
-            "messages": chat["messages"],
-            "lastUpdated": chat["lastUpdated"]
-        })
+    summaries, continuation = await clients.chat_store.get_chat_summaries(
+        user_id, page_size=max(1, min(limit, 200)) if limit else None, continuation=continuation
+    )
+    etag = chat_list_etag(user_id, summaries, continuation)
+    unchanged = not_modified(request, etag)
+    if unchanged:
+        return unchanged
     
-    print(f"User {user_id} chats: {chats}")
-    print(f"Jsonify chats: {json.dumps(chats, indent=2)}")
-    return data
+    headers = {"ETag": etag, "Cache-Control": REVALIDATE}
+    if continuation:
+        headers["X-Continuation-Token"] = continuation
+    return FastJSONResponse(summaries, headers=headers)
 
 @app.post("/api/chats")
-def save_chat(data: SaveChatRequest, authorization: str = Header(None)):
-    user_id = get_user_id_from_token(authorization)
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-    
+async def save_chat(data: SaveChatRequest, user_id: str = Depends(require_user_id)):
     if not data.chat_id:
         raise HTTPException(status_code=400, detail="chat_id is required")
     
-    item = store_user_chat(user_id, data.chat_id, data.messages)
-    return {"status": "success", "chat": item}
+    item = await store_user_chat(user_id, data.chat_id, data.messages)
+    return FastJSONResponse({"status": "success", "chat": chat_to_api(item)})
 
 @app.get("/api/chats/{chat_id}")
-def get_chat(chat_id: str, authorization: str = Header(None)):
-    user_id = get_user_id_from_token(authorization)
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Unauthorized")
+async def get_chat(request: Request, chat_id: str, user_id: str = Depends(require_user_id)):
+    # The header alone answers a revalidation; the messages are only read when it changed
+    header = await clients.chat_store.get_chat_header(user_id, chat_id)
     
-    query = "SELECT * FROM c WHERE c.userId = @userId AND c.id = @chatId"
-    parameters = [
-        {"name": "@userId", "value": user_id},
-        {"name": "@chatId", "value": chat_id}
-    ]
-    
-    items = list(container.query_items(
-        query=query,
-        parameters=parameters,
-        enable_cross_partition_query=True
-    ))
+    if not header:
+        raise HTTPException(status_code=404, detail="Chat not found")
     
-    print(f"Items: {items}")
+    unchanged = not_modified(request, chat_etag(header))
+    if unchanged:
+        return unchanged
     
-    if not items:
+    chat = await clients.chat_store.get_chat_by_id(user_id, chat_id, header=header)
+    logger.debug(f"Loaded chat {chat_id} with {len(chat['messages'])} messages")
+    return FastJSONResponse(chat_to_api(chat), headers={"ETag": chat_etag(chat), "Cache-Control": REVALIDATE})
+
+@app.get("/api/chats/{chat_id}/messages")
+async def get_chat_messages(chat_id: str, limit: int = 50, continuation: Optional[str] = None,
+                            user_id: str = Depends(require_user_id)):
+    """Pages through a chat's messages."""
+    header = await clients.chat_store.get_chat_header(user_id, chat_id)
+    if not header:
         raise HTTPException(status_code=404, detail="Chat not found")
     
-    return items[0]
+    messages, continuation = await clients.chat_store.get_chat_messages(
+        user_id, chat_id, header, page_size=max(1, min(limit, 500)), continuation=continuation
+    )
+    return FastJSONResponse({"messages": [message.to_api() for message in messages], "continuationToken": continuation})
 
 @app.post("/api/chats/new")
-def new_chat(authorization: str = Header(None)):
-    user_id = get_user_id_from_token(authorization)
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-    
+async def new_chat(user_id: str = Depends(require_user_id)):
     # Generate a new chat ID
     chat_id = str(datetime.datetime.utcnow().timestamp())
     
     # Store the new chat with an empty message list
-    store_user_chat(user_id, chat_id, [])
+    await store_user_chat(user_id, chat_id, [])
     
     return RedirectResponse(f"http://localhost:3000/chat/{chat_id}", status_code=302)
 
 @app.post("/api/chat")
-def chat(data: ChatRequest, authorization: str = Header(None)):
+async def chat(data: ChatRequest, user_id: str = Depends(require_user_id)):
     try:
-        print("Chat endpoint called")
-        user_id = get_user_id_from_token(authorization)
-        if not user_id:
-            raise HTTPException(status_code=401, detail="Unauthorized access")
-        
-        print(f"Data received: {data}")
         user_message = data.message
         chat_id = data.chat_id
         
@@ -313,137 +724,219 @@ def chat(data: ChatRequest, authorization: str = Header(None)):
         if not chat_id:
             raise HTTPException(status_code=400, detail="No chat_id provided")
         
-        # Get existing chat history or create new if doesn't exist
-        try:
-            query = "SELECT * FROM c WHERE c.userId = @userId AND c.id = @chatId"
-            parameters = [
-                {"name": "@userId", "value": user_id},
-                {"name": "@chatId", "value": chat_id}
-            ]
-            
-            existing_chats = list(container.query_items(
-                query=query,
-                parameters=parameters,
-                enable_cross_partition_query=True
-            ))
-            
-            if existing_chats:
-                chat_history = existing_chats[0]['messages']
-            else:
-                chat_history = []
-                
-        except Exception as e:
-            print(f"Error fetching chat history: {e}")
-            chat_history = []
+        logger.info(f"Processing chat message for user {user_id}, chat {chat_id}")
         
-        # Generate search query using OpenAI
-        tools = [
-            {
-                "type": "function",
-                "function": {
-                    "name": "search",
-                    "description": "Search the documentation to find the right data to answer the last question in this conversation.",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "query": {
-                                "type": "string",
-                                "description": "The search query to use for the documentation."
-                            }
-                        },
-                        "required": ["query"],
-                        "additionalProperties": False
-                    }
-                }
-            }
-        ]
+        # Get existing chat history or create new if doesn't exist
+        existing_chat = await load_chat(user_id, chat_id)
+        chat_history = existing_chat["messages"] if existing_chat else []
         
         # Build messages array including chat history
-        messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-        
-        # Add previous chat history
-        for msg in chat_history:
-            messages.append({
-                "role": msg.get("role", "user"),
-                "content": msg.get("content", "")
-            })
-        
-        # Add current user message
-        messages.append({"role": "user", "content": user_message})
-        
-        print(f"user_message: {user_message}")
-        print(f"chat_id: {chat_id}")
+        messages = build_chat_messages(chat_history, user_message)
         
-        # Step 1: Generate search query
-        completion = openai_client.chat.completions.create(
-            model=AZURE_OPENAI_DEPLOYMENT, 
-            messages=messages, 
-            tools=tools
+        # Steps 1 and 2: Generate search queries, run them concurrently and fuse the results
+        # (shared with identical questions already in flight)
+        turn_key = AnswerCache.turn_key(messages)
+        search_calls, query, search_content, references = await coalesced(
+            "retrieve", turn_key, lambda: retrieve_for_turn(messages, chat_history, user_message, user_id)
         )
         
-        assistant_response = ""
-        references = []
-        
-        # Check if the model wants to search
-        if completion.choices[0].finish_reason == "tool_calls":
-            for call in completion.choices[0].message.tool_calls:
-                if call.function.name == "search":
-                    query = json.loads(call.function.arguments)["query"]
-                    
-                    # Step 2: Perform search
-                    search_content, references = search_azure(query)
-
-                    # Step 3: Generate answer based on search results
-                    answer_messages = messages + [
-                        {"role": "assistant", "content": "I'll search for information to help answer your question.", "tool_calls": [call]},
-                        {"role": "tool", "tool_call_id": call.id, "content": search_content}
-                    ]
-                    
-                    answer_completion = openai_client.chat.completions.create(
-                        model=AZURE_OPENAI_DEPLOYMENT,
-                        messages=answer_messages
-                    )
-                    
-                    assistant_response = answer_completion.choices[0].message.content
+        if search_calls:
+            async def answer():
+                cached = answer_cache.get(query, references)
+                if cached:
+                    return cached["answer"]
+                
+                # Step 3: Generate one answer grounded on the fused results
+                answer_completion = await complete(build_answer_messages(messages, search_calls, search_content), user_id)
+                
+                assistant_response = answer_completion.choices[0].message.content
+                answer_cache.set(query, references, assistant_response)
+                return assistant_response
+            
+            assistant_response = await coalesced("answer", turn_key, answer)
         else:
             # Fallback if no search was performed
-            assistant_response = "I'm not sure how to answer your question without searching for more information."
-        
-        # Update chat history with new messages - matching Flask logic exactly
-        index = 2
-        chat_history.append({
-            "id": str(index + 1),
-            "sender": "user",
-            "content": user_message,
-            "timestamp": datetime.datetime.utcnow().isoformat()
-        })
+            assistant_response = NO_SEARCH_RESPONSE
         
-        chat_history.append({
-            "id": str(index + 2),
-            "sender": "bot", 
-            "content": assistant_response,
-            "timestamp": datetime.datetime.utcnow().isoformat(),
-            "references": references
-        })
-        
-        # Save updated chat history to Cosmos DB
+        # Save the new turn to Cosmos DB
         try:
-            store_user_chat(user_id, chat_id, chat_history)
+            await save_chat_turn(user_id, chat_id, existing_chat, user_message, assistant_response, references)
         except Exception as e:
-            print(f"Error saving chat history: {e}")
+            logger.error(f"Error saving chat history for chat {chat_id}: {str(e)}")
             # Continue anyway - don't fail the request if save fails
         
-        return {
+        return FastJSONResponse({
             "text": assistant_response,
             "references": references,
             "chat_id": chat_id
-        }
+        })
         
+    except OpenAIOverloadedError as e:
+        logger.warning(f"Chat request shed: {str(e)}")
+        raise HTTPException(status_code=503, detail="The assistant is busy, please retry shortly",
+                            headers={"Retry-After": str(int(e.retry_after + 0.5))})
     except Exception as e:
-        print(f"Error in chat function: {str(e)}")
+        logger.error(f"Error in chat endpoint: {str(e)}")
         import traceback
-        traceback.print_exc()
+        logger.error(traceback.format_exc())
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/chat/stream")
+async def chat_stream(data: ChatRequest, user_id: str = Depends(require_user_id)):
+    """Streaming variant of /api/chat using Server-Sent Events.
+    
+    Emits a ``references`` event as soon as the search returns, ``token`` events
+    as answer deltas arrive, and ``done`` once the turn has been persisted.
+    """
+    user_message = data.message
+    chat_id = data.chat_id
+    
+    if not user_message:
+        raise HTTPException(status_code=400, detail="No message provided")
+    
+    if not chat_id:
+        raise HTTPException(status_code=400, detail="No chat_id provided")
+    
+    existing_chat = await load_chat(user_id, chat_id)
+    chat_history = existing_chat["messages"] if existing_chat else []
+    messages = build_chat_messages(chat_history, user_message)
+    
+    async def generate():
+        try:
+            turn_key = AnswerCache.turn_key(messages)
+            search_calls, query, search_content, references = await coalesced(
+                "retrieve", turn_key, lambda: retrieve_for_turn(messages, chat_history, user_message, user_id)
+            )
+            if search_calls:
+                yield format_sse_event("references", {"references": references, "chat_id": chat_id})
+                
+                answer_key = f"answer:{turn_key}"
+                cached = answer_cache.get(query, references)
+                shared, leader = single_flight.join(answer_key) if single_flight and not cached else (None, True)
+                if cached:
+                    assistant_response = cached["answer"]
+                    yield format_sse_event("token", {"text": assistant_response})
+                elif not leader:
+                    # An identical question is being answered; send its answer when it completes
+                    assistant_response = await asyncio.shield(shared)
+                    yield format_sse_event("token", {"text": assistant_response})
+                else:
+                    parts = []
+                    try:
+                        stream = await complete(
+                            build_answer_messages(messages, search_calls, search_content), user_id, stream=True
+                        )
+                        async for chunk in stream:
+                            # Azure sends a leading chunk with only content filter results
+                            if not chunk.choices or not chunk.choices[0].delta.content:
+                                continue
+                            parts.append(chunk.choices[0].delta.content)
+                            yield format_sse_event("token", {"text": chunk.choices[0].delta.content})
+                    except BaseException as e:
+                        if shared:
+                            single_flight.resolve(answer_key, error=e)
+                        raise
+                    assistant_response = "".join(parts)
+                    answer_cache.set(query, references, assistant_response)
+                    if shared:
+                        single_flight.resolve(answer_key, assistant_response)
+            else:
+                references = []
+                assistant_response = NO_SEARCH_RESPONSE
+                yield format_sse_event("references", {"references": references, "chat_id": chat_id})
+                yield format_sse_event("token", {"text": assistant_response})
+            
+            # Persist only once the full answer has been streamed
+            try:
+                await save_chat_turn(user_id, chat_id, existing_chat, user_message, assistant_response, references)
+            except Exception as e:
+                logger.error(f"Error saving chat history for chat {chat_id}: {str(e)}")
+            
+            yield format_sse_event("done", {"chat_id": chat_id})
+            
+        except OpenAIOverloadedError as e:
+            logger.warning(f"Chat stream shed: {str(e)}")
+            yield format_sse_event("error", {"error": "The assistant is busy, please retry shortly", "retryAfter": e.retry_after})
+        except Exception as e:
+            logger.error(f"Error in chat stream: {str(e)}")
+            import traceback
+            logger.error(traceback.format_exc())
+            yield format_sse_event("error", {"error": str(e)})
+    
+    return StreamingResponse(
+        generate(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def ingest_pdf(stream, file_name: str):
+    """Streams a PDF into the search index, yielding progress after every uploaded batch.
+    
+    Runs the Flask app's IngestionService in worker threads: pages are extracted
+    lazily, unchanged pages (same text hash) are skipped, and each batch is
+    uploaded while the next one is extracted and embedded.
+    """
+    events = clients.ingestion.ingest(stream, file_name)
+    while True:
+        progress = await run_in_threadpool(next, events, None)
+        if progress is None:
+            return
+        yield progress
+
+@app.post("/api/upload/pdf")
+async def upload_pdf(stream: bool = False, file: UploadFile = File(...), fileName: Optional[str] = Form(None),
+                     user_id: str = Depends(require_admin)):
+    """Indexes an uploaded PDF; with ?stream=true, progress is sent as Server-Sent Events."""
+    if file.content_type != "application/pdf" and not (file.filename or "").lower().endswith(".pdf"):
+        raise HTTPException(status_code=400, detail="Only PDF files are supported")
+    
+    file_name = fileName or file.filename
+    events = ingest_pdf(file.file, file_name)
+    
+    if stream:
+        async def generate():
+            try:
+                async for progress in events:
+                    yield format_sse_event("done" if progress.get("done") else "progress", progress)
+            except Exception as e:
+                logger.error(f"Error ingesting {file_name}: {str(e)}")
+                yield format_sse_event("error", {"error": "Failed to ingest document"})
+        
+        return StreamingResponse(
+            generate(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+    
+    try:
+        result = None
+        async for result in events:
+            pass
+        return result
+    except Exception as e:
+        logger.error(f"Error ingesting {file_name}: {str(e)}")
+        raise HTTPException(status_code=500, detail="Failed to ingest document")
+
+@app.get("/api/admin/cache")
+async def cache_stats(user_id: str = Depends(require_admin)):
+    return {
+        "answers": answer_cache.stats(),
+        "search": search_cache.stats(),
+        "singleFlight": single_flight.stats() if single_flight else None,
+        "chatLists": chat_lists.stats() if chat_lists else None
+    }
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus scrape endpoint."""
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    return Response(content=registry.render(), media_type=METRICS_CONTENT_TYPE)
+
+@app.get("/api/admin/openai")
+async def openai_stats(user_id: str = Depends(require_admin)):
+    """Queue depth, wait times, shed and throttled calls of the OpenAI governor."""
+    return governor.stats() if governor else None
+
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=5000, reload=True)
\ No newline at end of file
@@ -0,0 +1,36 @@
+# migrate_chats.py - Migrate stored chats to the current layout (see CHAT_SCHEMA_VERSION in models.py)
+#
+# Usage: python migrate_chats.py [--limit N]
+#
+# Version 1 chat documents are split into a header and per-message items, and
+# version 2 message items are rewritten with their references moved to the
+# chat's reference table. Both older layouts stay readable and version 1 chats
+# are also migrated lazily the first time a turn is appended to them, so
+# running this is optional; it is idempotent and safe to interrupt.
+import argparse
+import logging
+import sys
+
+from config import get_config
+from models import CosmosDBManager
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s %(levelname)s %(name)s %(message)s',
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+logger = logging.getLogger(__name__)
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate stored chats to the current per-message layout")
+    parser.add_argument("--limit", type=int, default=None, help="Stop after migrating this many chats (and message items)")
+    args = parser.parse_args()
+    
+    db_manager = CosmosDBManager(get_config())
+    migrated = db_manager.migrate_legacy_chats(limit=args.limit)
+    logger.info(f"Migrated {migrated} chat documents")
+    upgraded = db_manager.upgrade_message_items(limit=args.limit)
+    logger.info(f"Upgraded {upgraded} message items")
+
+if __name__ == '__main__':
+    main()
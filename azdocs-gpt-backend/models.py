@@ -1,70 +1,860 @@
 # models.py - Data models and database operations
 from azure.cosmos import CosmosClient, PartitionKey
-from typing import List, Dict, Optional
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
+from azure.core.exceptions import HttpResponseError
+from transport import LazyClient, get_transport
+from cache import ChatListCache
+from telemetry import record_cosmos
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, Dict, Optional, Tuple
 import datetime
+import hashlib
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
+# Chat storage layout (schema version 3)
+#
+# Each chat is a small header item ({"type": "chat", id = chat id}) plus one
+# item per message ({"type": "message", "chatId", "seq"}), all in the user's
+# /userId partition. Turns are appended with a transactional batch, so the
+# write cost no longer grows with conversation length.
+#
+# Grounding references are stored once per chat: every distinct chunk is a
+# {"type": "reference", "refId"} item (seq 0, so it sorts ahead of the
+# messages) and bot messages list the ids in "refs" instead of repeating
+# the chunk text each turn. Message timestamps are epoch milliseconds ("ts").
+# Older layouts are still readable: version 2 message items (inline
+# "references", ISO "timestamp", no "v") and version 1 documents (a single
+# item holding the whole "messages" array, migrated the first time a turn
+# is appended). migrate_chats.py rewrites both.
+CHAT_SCHEMA_VERSION = 3
+MAX_BATCH_OPERATIONS = 100
+
+CHAT_HEADERS_QUERY = (
+    "SELECT * FROM c WHERE c.userId = @userId AND (c.type = 'chat' OR NOT IS_DEFINED(c.type)) "
+    "ORDER BY c.lastUpdated DESC"
+)
+# Sidebar listing: project only what the chat list renders. Version 1
+# documents have no messageCount, so their array length is projected instead.
+CHAT_SUMMARIES_QUERY = (
+    "SELECT c.id, c.title, c.lastUpdated, c.messageCount, ARRAY_LENGTH(c.messages) AS legacyMessageCount "
+    "FROM c WHERE c.userId = @userId AND (c.type = 'chat' OR NOT IS_DEFINED(c.type)) "
+    "ORDER BY c.lastUpdated DESC"
+)
+CHAT_MESSAGES_QUERY = (
+    "SELECT * FROM c WHERE c.userId = @userId AND c.type = 'message' AND c.chatId = @chatId "
+    "AND c.seq <= @messageCount ORDER BY c.seq"
+)
+# A whole chat with its reference table in one query
+CHAT_ITEMS_QUERY = (
+    "SELECT * FROM c WHERE c.userId = @userId AND (c.type = 'message' OR c.type = 'reference') "
+    "AND c.chatId = @chatId AND c.seq <= @messageCount ORDER BY c.seq"
+)
+CHAT_REFERENCES_QUERY = (
+    "SELECT * FROM c WHERE c.userId = @userId AND c.type = 'reference' AND c.chatId = @chatId "
+    "AND ARRAY_CONTAINS(@refIds, c.refId)"
+)
+USER_ITEMS_QUERY = (
+    "SELECT * FROM c WHERE c.userId = @userId AND (c.type = 'message' OR c.type = 'reference') ORDER BY c.seq"
+)
+LEGACY_CHATS_QUERY = "SELECT * FROM c WHERE IS_DEFINED(c.messages)"
+LEGACY_MESSAGES_QUERY = "SELECT * FROM c WHERE c.type = 'message' AND NOT IS_DEFINED(c.v)"
+
+class ChatConflictError(Exception):
+    """The chat was changed by another request between reading and writing it"""
+
+class CosmosUsage:
+    """Request charges and latency of the Cosmos DB calls made while serving one request"""
+    
+    def __init__(self):
+        self.calls = 0
+        self.request_charge = 0.0
+        self.duration_ms = 0.0
+    
+    def __str__(self) -> str:
+        return f"{self.calls} Cosmos calls, {self.request_charge:.2f} RU, {self.duration_ms:.1f} ms"
+
+_request_usage: ContextVar[Optional[CosmosUsage]] = ContextVar("cosmos_request_usage", default=None)
+
+def begin_request_usage() -> CosmosUsage:
+    """Start accumulating Cosmos usage for the current request (thread or task)"""
+    usage = CosmosUsage()
+    _request_usage.set(usage)
+    return usage
+
+def current_request_usage() -> Optional[CosmosUsage]:
+    return _request_usage.get()
+
+def _record_charge(headers, *_):
+    """response_hook for Cosmos calls: adds the x-ms-request-charge header to the request's usage"""
+    usage = _request_usage.get()
+    if usage is not None and headers:
+        usage.request_charge += float(headers.get("x-ms-request-charge", 0) or 0)
+
+@contextmanager
+def _track(operation: str):
+    usage = _request_usage.get()
+    charge_before = usage.request_charge if usage else 0.0
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if usage is not None:
+            usage.calls += 1
+            usage.duration_ms += elapsed_ms
+            logger.debug(f"Cosmos {operation}: {usage.request_charge - charge_before:.2f} RU in {elapsed_ms:.1f} ms")
+        record_cosmos(operation, elapsed_ms / 1000, usage.request_charge - charge_before if usage else 0.0)
+
+def utcnow_iso() -> str:
+    return datetime.datetime.utcnow().isoformat()
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MILLISECOND = datetime.timedelta(milliseconds=1)
+
+def now_ms() -> int:
+    return int(time.time() * 1000)
+
+def parse_timestamp(value) -> Optional[int]:
+    """Epoch milliseconds from an ISO 8601 string (naive values are UTC), or None if it isn't one"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    try:
+        parsed = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return (parsed - _EPOCH) // _MILLISECOND
+
+def format_timestamp(ms: Optional[int]) -> Optional[str]:
+    return None if ms is None else (_EPOCH + ms * _MILLISECOND).isoformat(timespec="milliseconds")
+
+def message_item_id(chat_id: str, seq: int) -> str:
+    return f"{chat_id}:msg:{seq:06d}"
+
+def reference_id(title: str, content: str) -> str:
+    """Content-derived, so a chunk cited again in a later turn maps to the stored item"""
+    return hashlib.blake2b(f"{title}\0{content}".encode("utf-8"), digest_size=8).hexdigest()
+
+def reference_item_id(chat_id: str, ref_id: str) -> str:
+    return f"{chat_id}:ref:{ref_id}"
+
+def _strong_etag(*parts) -> str:
+    return '"' + hashlib.blake2b("\0".join(map(str, parts)).encode("utf-8"), digest_size=12).hexdigest() + '"'
+
+def chat_etag(chat: Dict) -> str:
+    """Strong ETag of a chat as GET /api/chats/<id> returns it, computable from the header alone.
+    
+    Every write to a chat replaces its header, so the header's Cosmos _etag
+    identifies the version; headers not written yet (write-behind) fall back
+    to lastUpdated and messageCount.
+    """
+    version = chat.get("_etag") or f"{chat.get('lastUpdated')}:{chat.get('messageCount', len(chat.get('messages', [])))}"
+    return _strong_etag(chat.get("userId"), chat["id"], version)
+
+def chat_list_etag(user_id: str, summaries: List[Dict], continuation: Optional[str] = None) -> str:
+    """Strong ETag of a page of chat summaries (and the token to the next page)"""
+    return _strong_etag(user_id, continuation, *(
+        f"{s['id']}:{s['lastUpdated']}:{s['messageCount']}:{s['title']}" for s in summaries
+    ))
+
+class Reference:
+    """A grounding chunk cited by a bot message"""
+    __slots__ = ("ref_id", "title", "content")
+    
+    def __init__(self, title: str, content: str, ref_id: Optional[str] = None):
+        self.title = title
+        self.content = content
+        self.ref_id = ref_id or reference_id(title, content)
+    
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'Reference':
+        """From an API/search result dict or a stored reference item"""
+        return cls(data.get("title") or "", data.get("content") or "", data.get("refId"))
+    
+    def to_api(self) -> Dict:
+        return {"title": self.title, "content": self.content}
+    
+    def to_item(self, user_id: str, chat_id: str) -> Dict:
+        return {
+            "id": reference_item_id(chat_id, self.ref_id),
+            "userId": user_id,
+            "type": "reference",
+            "chatId": chat_id,
+            "seq": 0,
+            "refId": self.ref_id,
+            "title": self.title,
+            "content": self.content
+        }
+
+class ChatMessage:
+    """One chat message, as read from any schema version or built for a new turn.
+    
+    ``references`` holds the Reference records when they are known, and is
+    None for user messages and for version 3 messages read without their
+    references (see ``with_references``). ``ref_ids`` are the ids a version 3
+    item points at in the chat's reference table, None for anything else.
+    ``message_id`` is only kept when the API id differs from ``str(seq)``.
+    """
+    __slots__ = ("seq", "sender", "content", "timestamp", "message_id", "ref_ids", "references")
+    
+    def __init__(self, seq: int, sender: str, content: str, timestamp: Optional[int] = None,
+                 message_id: Optional[str] = None, ref_ids: Optional[Tuple[str, ...]] = None,
+                 references: Optional[Tuple[Reference, ...]] = None):
+        self.seq = seq
+        self.sender = sender
+        self.content = content
+        self.timestamp = timestamp
+        self.message_id = None if message_id == str(seq) else message_id
+        self.ref_ids = ref_ids
+        self.references = references
+    
+    def __repr__(self) -> str:
+        return f"ChatMessage(seq={self.seq}, sender={self.sender!r}, content={self.content[:40]!r})"
+    
+    @property
+    def id(self) -> str:
+        return self.message_id or str(self.seq)
+    
+    @property
+    def role(self) -> str:
+        return "assistant" if self.sender == "bot" else "user"
+    
+    @classmethod
+    def from_api(cls, data: Dict, seq: int) -> 'ChatMessage':
+        """From an API message dict, a version 1 document's message or a version 2 item"""
+        references = data.get("references")
+        message_id = data.get("messageId", data.get("id"))
+        return cls(
+            seq, data.get("sender"), data.get("content") or "", parse_timestamp(data.get("timestamp")),
+            None if message_id is None else str(message_id), None,
+            None if references is None else tuple(Reference.from_dict(ref) for ref in references)
+        )
+    
+    @classmethod
+    def from_item(cls, item: Dict) -> 'ChatMessage':
+        """From a stored message item of any version"""
+        if item.get("v", 2) < 3:
+            return cls.from_api(item, item["seq"])
+        refs = item.get("refs")
+        return cls(item["seq"], item.get("sender"), item.get("content", ""), item.get("ts"), item.get("messageId"),
+                   None if refs is None else tuple(refs))
+    
+    def at_seq(self, seq: int) -> 'ChatMessage':
+        """This message stored at position ``seq``, keeping its API id"""
+        if seq == self.seq:
+            return self
+        return ChatMessage(seq, self.sender, self.content, self.timestamp, self.id, self.ref_ids, self.references)
+    
+    def reference_ids(self) -> Optional[Tuple[str, ...]]:
+        if self.references is not None:
+            return tuple(ref.ref_id for ref in self.references)
+        return self.ref_ids
+    
+    def to_item(self, user_id: str, chat_id: str) -> Dict:
+        item = {
+            "id": message_item_id(chat_id, self.seq),
+            "userId": user_id,
+            "type": "message",
+            "chatId": chat_id,
+            "seq": self.seq,
+            "v": CHAT_SCHEMA_VERSION,
+            "sender": self.sender,
+            "content": self.content,
+            "ts": self.timestamp
+        }
+        if self.message_id is not None:
+            item["messageId"] = self.message_id
+        ref_ids = self.reference_ids()
+        if ref_ids is not None:
+            item["refs"] = list(ref_ids)
+        return item
+    
+    def to_api(self) -> Dict:
+        message = {
+            "id": self.id,
+            "sender": self.sender,
+            "content": self.content,
+            "timestamp": format_timestamp(self.timestamp)
+        }
+        if self.references is not None:
+            message["references"] = [ref.to_api() for ref in self.references]
+        return message
+
+def is_legacy_chat(doc: Dict) -> bool:
+    """Version 1 chat documents embed the whole conversation"""
+    return doc.get("type") != "chat" and "messages" in doc
+
+def legacy_messages(doc: Dict) -> List[ChatMessage]:
+    return [
+        message if isinstance(message, ChatMessage) else ChatMessage.from_api(message, seq)
+        for seq, message in enumerate(doc.get("messages", []), 1)
+    ]
+
+def build_chat_header(user_id: str, chat_id: str, chat_name: str, message_count: int,
+                      history_summary: Optional[Dict] = None, last_updated: Optional[str] = None) -> Dict:
+    header = {
+        "id": chat_id,
+        "userId": user_id,
+        "type": "chat",
+        "schemaVersion": CHAT_SCHEMA_VERSION,
+        "title": chat_name[:100],  # Limit title length
+        "messageCount": message_count,
+        "lastUpdated": last_updated or utcnow_iso()
+    }
+    if history_summary:
+        header["historySummary"] = history_summary
+    return header
+
+def chat_summary(item: Dict) -> Dict:
+    return {
+        "id": item["id"],
+        "title": item.get("title", "New Chat"),
+        "lastUpdated": item.get("lastUpdated"),
+        "messageCount": item.get("messageCount", item.get("legacyMessageCount", 0))
+    }
+
+def assemble_chat(header: Dict, messages: List[ChatMessage]) -> Dict:
+    chat = dict(header)
+    chat["messages"] = messages
+    return chat
+
+def chat_to_api(chat: Dict) -> Dict:
+    """The chat with its messages as API dicts"""
+    return assemble_chat(chat, [message.to_api() for message in chat.get("messages", [])])
+
+def build_turn_messages(next_id: int, user_message: str, assistant_response: str,
+                        references: List[Dict]) -> List[ChatMessage]:
+    """Build the user/bot message pair for one chat turn"""
+    timestamp = now_ms()
+    return [
+        ChatMessage(next_id, "user", user_message, timestamp),
+        ChatMessage(next_id + 1, "bot", assistant_response, timestamp,
+                    references=tuple(Reference.from_dict(ref) for ref in references))
+    ]
+
+def _chat_list_changed(chat_lists: Optional[ChatListCache], user_id: str):
+    if chat_lists is not None:
+        chat_lists.invalidate(user_id)
+
+def _batches(operations: List[Tuple]) -> List[List[Tuple]]:
+    return [operations[i:i + MAX_BATCH_OPERATIONS] for i in range(0, len(operations), MAX_BATCH_OPERATIONS)]
+
+def _header_operation(header: Dict, previous: Optional[Dict]) -> Tuple:
+    """Write the header conditionally on the ETag of the version that was read.
+    
+    A brand-new chat is created (failing if another request created it first);
+    an existing one is replaced only if nobody updated it in the meantime.
+    """
+    if previous is None:
+        return ("create", (header,))
+    if previous.get("_etag"):
+        return ("replace", (header["id"], header), {"if_match_etag": previous["_etag"]})
+    return ("upsert", (header,))
+
+def _with_etag(header: Dict, results: List[Dict]) -> Dict:
+    if results and results[-1].get("eTag"):
+        header["_etag"] = results[-1]["eTag"]
+    return header
+
+def _raise_if_conflict(e: HttpResponseError, chat_id: str):
+    if e.status_code in (409, 412):
+        raise ChatConflictError(f"Chat {chat_id} was modified concurrently") from e
+
+def _message_operations(user_id: str, chat_id: str, messages: List[ChatMessage], first_seq: int,
+                        known_ref_ids: frozenset = frozenset()) -> List[Tuple]:
+    """Upserts for the messages, preceded by the reference items the chat doesn't hold yet"""
+    messages = [message.at_seq(first_seq + i) for i, message in enumerate(messages)]
+    references = {}
+    for message in messages:
+        for ref in message.references or ():
+            if ref.ref_id not in known_ref_ids:
+                references.setdefault(ref.ref_id, ref)
+    return (
+        [("upsert", (ref.to_item(user_id, chat_id),)) for ref in references.values()]
+        + [("upsert", (message.to_item(user_id, chat_id),)) for message in messages]
+    )
+
+def _known_ref_ids(chat: Optional[Dict]) -> frozenset:
+    """Ids already in the chat's reference table, going by the version 3 messages that were read"""
+    if not chat or is_legacy_chat(chat):
+        return frozenset()
+    return frozenset(ref_id for message in chat.get("messages", ()) for ref_id in message.ref_ids or ())
+
+def _split_items(items) -> Tuple[List[ChatMessage], Dict[str, Reference]]:
+    messages, table = [], {}
+    for item in items:
+        if item.get("type") == "reference":
+            table[item["refId"]] = Reference.from_dict(item)
+        else:
+            messages.append(ChatMessage.from_item(item))
+    return messages, table
+
+def _resolve_references(messages: List[ChatMessage], table: Dict[str, Reference]) -> List[ChatMessage]:
+    for message in messages:
+        if message.references is None and message.ref_ids is not None:
+            message.references = tuple(table[ref_id] for ref_id in message.ref_ids if ref_id in table)
+    return messages
+
+def _unresolved_ref_ids(messages: List[ChatMessage]) -> List[str]:
+    return sorted({ref_id for message in messages if message.references is None for ref_id in message.ref_ids or ()})
+
+def _group_items(items) -> Dict[str, List[Dict]]:
+    grouped: Dict[str, List[Dict]] = {}
+    for item in items:
+        grouped.setdefault(item["chatId"], []).append(item)
+    return grouped
+
+def _assemble_user_chats(headers: List[Dict], items: Dict[str, List[Dict]]) -> List[Dict]:
+    chats = []
+    for header in headers:
+        if is_legacy_chat(header):
+            chats.append(assemble_chat(header, legacy_messages(header)))
+            continue
+        messages, table = _split_items(items.get(header["id"], []))
+        count = header.get("messageCount", 0)
+        chats.append(assemble_chat(header, _resolve_references([m for m in messages if m.seq <= count], table)))
+    return chats
+
 class CosmosDBManager:
     """Manages Cosmos DB operations for chat data"""
     
-    def __init__(self, config):
-        self.client = CosmosClient(config.COSMOS_ENDPOINT, config.COSMOS_KEY)
-        self.database = self.client.create_database_if_not_exists(id=config.COSMOS_DATABASE_NAME)
-        self.container = self.database.create_container_if_not_exists(
-            id=config.COSMOS_CONTAINER_NAME,
+    # First pages of get_chat_summaries, dropped on every write to one of the user's chats
+    chat_lists: Optional[ChatListCache] = None
+    
+    def __init__(self, config, chat_lists: Optional[ChatListCache] = None):
+        # Nothing here touches the network: the client connects on first use and
+        # the database and containers are created once by provision.py
+        self.chat_lists = chat_lists
+        transport_options = get_transport(config).azure_options("cosmos")
+        self.client = LazyClient(
+            lambda: CosmosClient(config.COSMOS_ENDPOINT, config.COSMOS_KEY, **transport_options), "Cosmos DB client"
+        )
+        self.throughput = config.COSMOS_THROUGHPUT
+        self.database_name = config.COSMOS_DATABASE_NAME
+        self.container_name = config.COSMOS_CONTAINER_NAME
+        self.database = LazyClient(lambda: self.client.get_database_client(self.database_name), "Cosmos database proxy")
+        self.container = LazyClient(lambda: self.database.get_container_client(self.container_name), "Cosmos container proxy")
+    
+    def provision(self, cache_container_name: Optional[str] = None):
+        """Create the database, the chat container and (optionally) the cache container if missing"""
+        database = self.client.create_database_if_not_exists(id=self.database_name)
+        database.create_container_if_not_exists(
+            id=self.container_name,
             partition_key=PartitionKey(path="/userId"),
-            offer_throughput=config.COSMOS_THROUGHPUT
+            offer_throughput=self.throughput
         )
+        logger.info(f"Provisioned Cosmos DB container {self.database_name}/{self.container_name}")
+        if cache_container_name:
+            database.create_container_if_not_exists(
+                id=cache_container_name,
+                partition_key=PartitionKey(path="/id"),
+                default_ttl=-1,
+                offer_throughput=self.throughput
+            )
+            logger.info(f"Provisioned Cosmos DB cache container {self.database_name}/{cache_container_name}")
+    
+    def ping(self):
+        """Read the chat container's properties; raises if Cosmos is unreachable or the container is missing"""
+        with _track("ping"):
+            self.container.read(response_hook=_record_charge)
     
-    def store_user_chat(self, user_id: str, chat_id: str, chat_name: str, messages: List[Dict]) -> Dict:
-        """Store or update a chat document for the user"""
+    def get_cache_container(self, container_name: str):
+        """TTL-enabled container partitioned by /id for shared caches (created by provision())"""
+        return LazyClient(lambda: self.database.get_container_client(container_name), f"Cosmos container proxy {container_name}")
+    
+    def _execute_batches(self, user_id: str, operations: List[Tuple]) -> List[Dict]:
+        """Run operations as transactional batches; only the last batch should touch the header"""
+        results = []
+        for batch in _batches(operations):
+            with _track("batch"):
+                results = self.container.execute_item_batch(
+                    batch_operations=batch, partition_key=user_id, response_hook=_record_charge
+                )
+        return results
+    
+    def store_user_chat(self, user_id: str, chat_id: str, chat_name: str, messages: List[ChatMessage],
+                        history_summary: Optional[Dict] = None) -> Dict:
+        """Store or replace a whole chat for the user"""
         try:
-            item = {
-                "title": chat_name[:100],  # Limit title length
-                "id": chat_id,
-                "userId": user_id,
-                "messages": messages,
-                "lastUpdated": datetime.datetime.utcnow().isoformat()
-            }
-            self.container.upsert_item(item)
+            header = build_chat_header(user_id, chat_id, chat_name, len(messages), history_summary)
+            # The header goes last so readers never see a count ahead of the stored messages
+            self._execute_batches(user_id, _message_operations(user_id, chat_id, messages, 1) + [("upsert", (header,))])
+            _chat_list_changed(self.chat_lists, user_id)
             logger.info(f"Chat saved successfully for user {user_id}, chat {chat_id}")
-            return item
+            return assemble_chat(header, messages)
         except Exception as e:
             logger.error(f"Error storing chat for user {user_id}: {str(e)}")
             raise
     
+    def append_messages(self, user_id: str, chat_id: str, chat_name: str, new_messages: List[ChatMessage],
+                        existing_chat: Optional[Dict] = None, history_summary: Optional[Dict] = None) -> Dict:
+        """Append messages to a chat, writing only the new items, new references and the header"""
+        try:
+            known_ref_ids = _known_ref_ids(existing_chat)
+            if existing_chat and is_legacy_chat(existing_chat):
+                existing_chat = self.migrate_chat_document(existing_chat)
+            
+            message_count = existing_chat.get("messageCount", 0) if existing_chat else 0
+            header = build_chat_header(
+                user_id, chat_id, chat_name, message_count + len(new_messages),
+                history_summary or (existing_chat or {}).get("historySummary")
+            )
+            operations = _message_operations(user_id, chat_id, new_messages, message_count + 1, known_ref_ids)
+            results = self._execute_batches(user_id, operations + [_header_operation(header, existing_chat)])
+            _chat_list_changed(self.chat_lists, user_id)
+            logger.info(f"Appended {len(new_messages)} messages for user {user_id}, chat {chat_id}")
+            return _with_etag(header, results)
+        except HttpResponseError as e:
+            _raise_if_conflict(e, chat_id)
+            logger.error(f"Error appending to chat {chat_id} for user {user_id}: {str(e)}")
+            raise
+        except Exception as e:
+            logger.error(f"Error appending to chat {chat_id} for user {user_id}: {str(e)}")
+            raise
+    
+    def get_chat_summaries(self, user_id: str, page_size: Optional[int] = None,
+                           continuation: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        """List a user's chats (id, title, lastUpdated, messageCount), newest first.
+        
+        First pages come from ``chat_lists`` when it is set; they are shared
+        between requests and must not be modified.
+        """
+        chat_lists = self.chat_lists if continuation is None else None
+        cached = chat_lists.get(user_id, page_size) if chat_lists else None
+        if cached is not None:
+            return cached
+        stamp = chat_lists.snapshot() if chat_lists else None
+        
+        try:
+            results = self.container.query_items(
+                query=CHAT_SUMMARIES_QUERY,
+                parameters=[{"name": "@userId", "value": user_id}],
+                partition_key=user_id,
+                max_item_count=page_size
+            )
+            if not page_size:
+                page = [chat_summary(item) for item in results], None
+            else:
+                pager = results.by_page(continuation)
+                page = [chat_summary(item) for item in next(pager, [])], pager.continuation_token
+        except Exception as e:
+            logger.error(f"Error listing chats for user {user_id}: {str(e)}")
+            raise
+        if chat_lists:
+            chat_lists.set(user_id, page_size, page, stamp)
+        return page
+    
     def get_user_chats(self, user_id: str) -> List[Dict]:
-        """Retrieve all chat documents for a given user"""
+        """Retrieve all chats, with their messages, for a given user"""
         try:
-            query = "SELECT * FROM c WHERE c.userId = @userId ORDER BY c.lastUpdated DESC"
             parameters = [{"name": "@userId", "value": user_id}]
-            items = list(self.container.query_items(
-                query=query,
+            headers = list(self.container.query_items(
+                query=CHAT_HEADERS_QUERY,
                 parameters=parameters,
-                enable_cross_partition_query=True
+                partition_key=user_id
             ))
-            logger.info(f"Retrieved {len(items)} chats for user {user_id}")
-            return items
+            items = _group_items(self.container.query_items(
+                query=USER_ITEMS_QUERY,
+                parameters=parameters,
+                partition_key=user_id
+            ))
+            chats = _assemble_user_chats(headers, items)
+            
+            logger.info(f"Retrieved {len(chats)} chats for user {user_id}")
+            return chats
         except Exception as e:
             logger.error(f"Error retrieving chats for user {user_id}: {str(e)}")
             raise
     
-    def get_chat_by_id(self, user_id: str, chat_id: str) -> Optional[Dict]:
-        """Get a specific chat by ID"""
+    def get_chat_header(self, user_id: str, chat_id: str) -> Optional[Dict]:
+        """Point-read a chat's header item (or the whole document for version 1 chats)"""
         try:
-            query = "SELECT * FROM c WHERE c.userId = @userId AND c.id = @chatId"
-            parameters = [
+            with _track("read_item"):
+                item = self.container.read_item(item=chat_id, partition_key=user_id, response_hook=_record_charge)
+        except CosmosResourceNotFoundError:
+            return None
+        return item if item.get("type") == "chat" or is_legacy_chat(item) else None
+    
+    def get_chat_messages(self, user_id: str, chat_id: str, header: Optional[Dict] = None,
+                          page_size: Optional[int] = None, continuation: Optional[str] = None,
+                          with_references: bool = True) -> Tuple[List[ChatMessage], Optional[str]]:
+        """Read a chat's messages in order, one page at a time when page_size is given.
+        
+        ``with_references=False`` skips the reference table (bot messages keep
+        only their ``ref_ids``), which is all building the next prompt needs.
+        """
+        header = header or self.get_chat_header(user_id, chat_id)
+        if not header:
+            return [], None
+        if is_legacy_chat(header):
+            return legacy_messages(header), None
+        
+        whole_chat = with_references and not page_size
+        results = self.container.query_items(
+            query=CHAT_ITEMS_QUERY if whole_chat else CHAT_MESSAGES_QUERY,
+            parameters=[
                 {"name": "@userId", "value": user_id},
-                {"name": "@chatId", "value": chat_id}
-            ]
-            items = list(self.container.query_items(
-                query=query,
-                parameters=parameters,
-                enable_cross_partition_query=True
-            ))
-            return items[0] if items else None
+                {"name": "@chatId", "value": chat_id},
+                {"name": "@messageCount", "value": header.get("messageCount", 0)}
+            ],
+            partition_key=user_id,
+            max_item_count=page_size,
+            response_hook=_record_charge
+        )
+        with _track("query_messages"):
+            if not page_size:
+                messages, table = _split_items(results)
+                return _resolve_references(messages, table) if whole_chat else messages, None
+            
+            pager = results.by_page(continuation)
+            page = [ChatMessage.from_item(item) for item in next(pager, [])]
+        if with_references:
+            self.resolve_references(user_id, chat_id, page)
+        return page, pager.continuation_token
+    
+    def resolve_references(self, user_id: str, chat_id: str, messages: List[ChatMessage]) -> List[ChatMessage]:
+        """Fill in the references of messages read without them, with one query for the ids they point at"""
+        ref_ids = _unresolved_ref_ids(messages)
+        if not ref_ids:
+            return messages
+        results = self.container.query_items(
+            query=CHAT_REFERENCES_QUERY,
+            parameters=[
+                {"name": "@userId", "value": user_id},
+                {"name": "@chatId", "value": chat_id},
+                {"name": "@refIds", "value": ref_ids}
+            ],
+            partition_key=user_id,
+            response_hook=_record_charge
+        )
+        with _track("query_references"):
+            _, table = _split_items(results)
+        return _resolve_references(messages, table)
+    
+    def get_chat_by_id(self, user_id: str, chat_id: str, with_references: bool = True,
+                       header: Optional[Dict] = None) -> Optional[Dict]:
+        """Get a specific chat by ID (the messages ``header`` counts, when already read)"""
+        try:
+            header = header or self.get_chat_header(user_id, chat_id)
+            if not header:
+                return None
+            messages, _ = self.get_chat_messages(user_id, chat_id, header, with_references=with_references)
+            return assemble_chat(header, messages)
         except Exception as e:
             logger.error(f"Error retrieving chat {chat_id} for user {user_id}: {str(e)}")
-            raise
\ No newline at end of file
+            raise
+    
+    def migrate_chat_document(self, doc: Dict) -> Dict:
+        """Split a version 1 chat document into a header and per-message items.
+        
+        Safe to re-run: message items are upserted and the header replaces the
+        legacy document in place only after every message has been written.
+        """
+        user_id, chat_id, messages = doc["userId"], doc["id"], legacy_messages(doc)
+        header = build_chat_header(
+            user_id, chat_id, doc.get("title", "New Chat"), len(messages),
+            doc.get("historySummary"), doc.get("lastUpdated")
+        )
+        results = self._execute_batches(user_id, _message_operations(user_id, chat_id, messages, 1) + [_header_operation(header, doc)])
+        logger.info(f"Migrated chat {chat_id} for user {user_id} ({len(messages)} messages)")
+        return _with_etag(header, results)
+    
+    def migrate_legacy_chats(self, limit: Optional[int] = None) -> int:
+        """Migrate every version 1 chat document in the container"""
+        migrated = 0
+        for doc in self.container.query_items(query=LEGACY_CHATS_QUERY, enable_cross_partition_query=True):
+            if not is_legacy_chat(doc):
+                continue
+            self.migrate_chat_document(doc)
+            migrated += 1
+            if limit and migrated >= limit:
+                break
+        return migrated
+
+    def upgrade_message_items(self, limit: Optional[int] = None) -> int:
+        """Rewrite version 2 message items in the current layout, moving their references to the reference table.
+        
+        Each item is replaced in place, together with its reference items, in
+        one batch; chat headers are untouched, so this is safe to re-run.
+        """
+        upgraded = 0
+        for item in self.container.query_items(query=LEGACY_MESSAGES_QUERY, enable_cross_partition_query=True):
+            message = ChatMessage.from_item(item)
+            self._execute_batches(item["userId"], _message_operations(item["userId"], item["chatId"], [message], message.seq))
+            upgraded += 1
+            if limit and upgraded >= limit:
+                break
+        return upgraded
+
+class AsyncCosmosDBManager:
+    """Async counterpart of CosmosDBManager over an ``azure.cosmos.aio`` container"""
+    
+    def __init__(self, container, chat_lists: Optional[ChatListCache] = None):
+        self.container = container
+        self.chat_lists = chat_lists
+    
+    async def _execute_batches(self, user_id: str, operations: List[Tuple]) -> List[Dict]:
+        results = []
+        for batch in _batches(operations):
+            with _track("batch"):
+                results = await self.container.execute_item_batch(
+                    batch_operations=batch, partition_key=user_id, response_hook=_record_charge
+                )
+        return results
+    
+    async def store_user_chat(self, user_id: str, chat_id: str, chat_name: str, messages: List[ChatMessage],
+                              history_summary: Optional[Dict] = None) -> Dict:
+        """Store or replace a whole chat for the user"""
+        header = build_chat_header(user_id, chat_id, chat_name, len(messages), history_summary)
+        await self._execute_batches(user_id, _message_operations(user_id, chat_id, messages, 1) + [("upsert", (header,))])
+        _chat_list_changed(self.chat_lists, user_id)
+        return assemble_chat(header, messages)
+    
+    async def append_messages(self, user_id: str, chat_id: str, chat_name: str, new_messages: List[ChatMessage],
+                              existing_chat: Optional[Dict] = None, history_summary: Optional[Dict] = None) -> Dict:
+        """Append messages to a chat, writing only the new items, new references and the header"""
+        known_ref_ids = _known_ref_ids(existing_chat)
+        if existing_chat and is_legacy_chat(existing_chat):
+            existing_chat = await self.migrate_chat_document(existing_chat)
+        
+        message_count = existing_chat.get("messageCount", 0) if existing_chat else 0
+        header = build_chat_header(
+            user_id, chat_id, chat_name, message_count + len(new_messages),
+            history_summary or (existing_chat or {}).get("historySummary")
+        )
+        operations = _message_operations(user_id, chat_id, new_messages, message_count + 1, known_ref_ids)
+        try:
+            results = await self._execute_batches(user_id, operations + [_header_operation(header, existing_chat)])
+        except HttpResponseError as e:
+            _raise_if_conflict(e, chat_id)
+            raise
+        _chat_list_changed(self.chat_lists, user_id)
+        return _with_etag(header, results)
+    
+    async def get_chat_summaries(self, user_id: str, page_size: Optional[int] = None,
+                                 continuation: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        """List a user's chats (id, title, lastUpdated, messageCount), newest first; see CosmosDBManager"""
+        chat_lists = self.chat_lists if continuation is None else None
+        cached = chat_lists.get(user_id, page_size) if chat_lists else None
+        if cached is not None:
+            return cached
+        stamp = chat_lists.snapshot() if chat_lists else None
+        
+        results = self.container.query_items(
+            query=CHAT_SUMMARIES_QUERY,
+            parameters=[{"name": "@userId", "value": user_id}],
+            partition_key=user_id,
+            max_item_count=page_size
+        )
+        if not page_size:
+            page = [chat_summary(item) async for item in results], None
+        else:
+            pager = results.by_page(continuation)
+            try:
+                summaries = [chat_summary(item) async for item in await pager.__anext__()]
+            except StopAsyncIteration:
+                summaries = []
+            page = summaries, pager.continuation_token
+        if chat_lists:
+            chat_lists.set(user_id, page_size, page, stamp)
+        return page
+    
+    async def get_user_chats(self, user_id: str) -> List[Dict]:
+        """Retrieve all chats, with their messages, for a given user"""
+        parameters = [{"name": "@userId", "value": user_id}]
+        headers = [item async for item in self.container.query_items(
+            query=CHAT_HEADERS_QUERY,
+            parameters=parameters,
+            partition_key=user_id
+        )]
+        items = _group_items([item async for item in self.container.query_items(
+            query=USER_ITEMS_QUERY,
+            parameters=parameters,
+            partition_key=user_id
+        )])
+        return _assemble_user_chats(headers, items)
+    
+    async def get_chat_header(self, user_id: str, chat_id: str) -> Optional[Dict]:
+        try:
+            with _track("read_item"):
+                item = await self.container.read_item(item=chat_id, partition_key=user_id, response_hook=_record_charge)
+        except CosmosResourceNotFoundError:
+            return None
+        return item if item.get("type") == "chat" or is_legacy_chat(item) else None
+    
+    async def get_chat_messages(self, user_id: str, chat_id: str, header: Optional[Dict] = None,
+                                page_size: Optional[int] = None, continuation: Optional[str] = None,
+                                with_references: bool = True) -> Tuple[List[ChatMessage], Optional[str]]:
+        """Read a chat's messages in order, one page at a time when page_size is given"""
+        header = header or await self.get_chat_header(user_id, chat_id)
+        if not header:
+            return [], None
+        if is_legacy_chat(header):
+            return legacy_messages(header), None
+        
+        whole_chat = with_references and not page_size
+        results = self.container.query_items(
+            query=CHAT_ITEMS_QUERY if whole_chat else CHAT_MESSAGES_QUERY,
+            parameters=[
+                {"name": "@userId", "value": user_id},
+                {"name": "@chatId", "value": chat_id},
+                {"name": "@messageCount", "value": header.get("messageCount", 0)}
+            ],
+            partition_key=user_id,
+            max_item_count=page_size,
+            response_hook=_record_charge
+        )
+        with _track("query_messages"):
+            if not page_size:
+                messages, table = _split_items([item async for item in results])
+                return _resolve_references(messages, table) if whole_chat else messages, None
+            
+            pager = results.by_page(continuation)
+            try:
+                page = [ChatMessage.from_item(item) async for item in await pager.__anext__()]
+            except StopAsyncIteration:
+                page = []
+        if with_references:
+            await self.resolve_references(user_id, chat_id, page)
+        return page, pager.continuation_token
+    
+    async def resolve_references(self, user_id: str, chat_id: str, messages: List[ChatMessage]) -> List[ChatMessage]:
+        ref_ids = _unresolved_ref_ids(messages)
+        if not ref_ids:
+            return messages
+        results = self.container.query_items(
+            query=CHAT_REFERENCES_QUERY,
+            parameters=[
+                {"name": "@userId", "value": user_id},
+                {"name": "@chatId", "value": chat_id},
+                {"name": "@refIds", "value": ref_ids}
+            ],
+            partition_key=user_id,
+            response_hook=_record_charge
+        )
+        with _track("query_references"):
+            _, table = _split_items([item async for item in results])
+        return _resolve_references(messages, table)
+    
+    async def get_chat_by_id(self, user_id: str, chat_id: str, with_references: bool = True,
+                             header: Optional[Dict] = None) -> Optional[Dict]:
+        header = header or await self.get_chat_header(user_id, chat_id)
+        if not header:
+            return None
+        messages, _ = await self.get_chat_messages(user_id, chat_id, header, with_references=with_references)
+        return assemble_chat(header, messages)
+    
+    async def migrate_chat_document(self, doc: Dict) -> Dict:
+        """Split a version 1 chat document into a header and per-message items"""
+        user_id, chat_id, messages = doc["userId"], doc["id"], legacy_messages(doc)
+        header = build_chat_header(
+            user_id, chat_id, doc.get("title", "New Chat"), len(messages),
+            doc.get("historySummary"), doc.get("lastUpdated")
+        )
+        results = await self._execute_batches(user_id, _message_operations(user_id, chat_id, messages, 1) + [_header_operation(header, doc)])
+        return _with_etag(header, results)
@@ -0,0 +1,242 @@
+# persistence.py - Write-behind persistence of chat turns
+from models import ChatConflictError, ChatMessage, assemble_chat, build_chat_header
+from typing import Dict, List, Optional, Tuple
+import queue
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+class WriteBehindChatStore:
+    """Queues chat turns and persists them from background workers.
+    
+    Turns are routed to a worker by user id, so each user's writes stay in
+    order. A worker drains whatever has queued up and coalesces the turns of
+    a chat into one ``append_messages`` call. That call is one transactional
+    batch in the user's partition. Until a chat's pending turns are written,
+    ``get_chat_by_id`` serves it from an in-memory overlay so the next turn
+    sees the previous one. When a worker queue is full the caller blocks until
+    there is room.
+    
+    Reads other than ``get_chat_by_id``, ``get_chat_header`` and
+    ``get_chat_messages`` fall through to the wrapped CosmosDBManager and may
+    briefly miss pending turns. Overlay
+    messages are shared with readers and must not be modified.
+    """
+    
+    def __init__(self, db_manager, workers: int = 2, queue_size: int = 1000,
+                 max_retries: int = 5, retry_backoff_seconds: float = 0.5, max_drain: int = 100):
+        self.db_manager = db_manager
+        self.max_retries = max_retries
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self.max_drain = max_drain
+        self._queues = [queue.Queue(maxsize=max(1, queue_size // workers)) for _ in range(workers)]
+        # (user_id, chat_id) -> {"chat": chat as readers should see it, "durable": last persisted header, "pending": n}
+        self._overlay: Dict[Tuple[str, str], Dict] = {}
+        self._lock = threading.Lock()
+        self._closed = False
+        self.written = 0
+        self.failed = 0
+        self._threads = [
+            threading.Thread(target=self._run, args=(q,), name=f"chat-write-behind-{i}", daemon=True)
+            for i, q in enumerate(self._queues)
+        ]
+        for thread in self._threads:
+            thread.start()
+    
+    @classmethod
+    def from_config(cls, config, db_manager) -> Optional['WriteBehindChatStore']:
+        """Build the store when CHAT_WRITE_MODE is 'write_behind'"""
+        if (config.CHAT_WRITE_MODE or "sync").lower() != "write_behind":
+            return None
+        logger.info(f"Chat write-behind enabled with {config.WRITE_BEHIND_WORKERS} workers")
+        return cls(
+            db_manager,
+            workers=config.WRITE_BEHIND_WORKERS,
+            queue_size=config.WRITE_BEHIND_QUEUE_SIZE,
+            max_retries=config.WRITE_BEHIND_MAX_RETRIES
+        )
+    
+    def __getattr__(self, name):
+        return getattr(self.db_manager, name)
+    
+    def append_messages(self, user_id: str, chat_id: str, chat_name: str, new_messages: List[ChatMessage],
+                        existing_chat: Optional[Dict] = None, history_summary: Optional[Dict] = None) -> Dict:
+        """Record the turn in the overlay and queue it; returns the header readers will see"""
+        if self._closed:
+            return self.db_manager.append_messages(user_id, chat_id, chat_name, new_messages, existing_chat, history_summary)
+        
+        key = (user_id, chat_id)
+        with self._lock:
+            entry = self._overlay.get(key)
+            if entry is None:
+                # existing_chat came from Cosmos, so it carries the ETag the first write must match
+                entry = {"chat": existing_chat, "durable": existing_chat, "pending": 0}
+                self._overlay[key] = entry
+            chat = entry["chat"]
+            messages = (chat or {}).get("messages", [])
+            header = build_chat_header(
+                user_id, chat_id, chat["title"] if chat else chat_name, len(messages) + len(new_messages),
+                history_summary or (chat or {}).get("historySummary")
+            )
+            entry["chat"] = assemble_chat(header, messages + new_messages)
+            entry["pending"] += 1
+        
+        turn = {"user_id": user_id, "chat_id": chat_id, "chat_name": chat_name,
+                "messages": new_messages, "history_summary": history_summary}
+        work_queue = self._queues[hash(user_id) % len(self._queues)]
+        try:
+            work_queue.put_nowait(turn)
+        except queue.Full:
+            # Writing inline could overtake this chat's queued turns, so wait for room instead
+            logger.warning(f"Write-behind queue full, waiting to queue chat {chat_id}")
+            work_queue.put(turn)
+        return header
+    
+    def get_chat_by_id(self, user_id: str, chat_id: str, with_references: bool = True,
+                       header: Optional[Dict] = None) -> Optional[Dict]:
+        with self._lock:
+            entry = self._overlay.get((user_id, chat_id))
+            chat = assemble_chat(entry["chat"], list(entry["chat"]["messages"])) if entry is not None else None
+        if chat is None:
+            # A header taken from the overlay bounds the read to the messages it counts
+            return self.db_manager.get_chat_by_id(user_id, chat_id, with_references, header)
+        if with_references:
+            # Pending turns carry their references; older messages may have been read without them
+            self.db_manager.resolve_references(user_id, chat_id, chat["messages"])
+        return chat
+    
+    def get_chat_header(self, user_id: str, chat_id: str) -> Optional[Dict]:
+        with self._lock:
+            entry = self._overlay.get((user_id, chat_id))
+            if entry is not None:
+                return {key: value for key, value in entry["chat"].items() if key != "messages"}
+        return self.db_manager.get_chat_header(user_id, chat_id)
+    
+    def get_chat_messages(self, user_id: str, chat_id: str, header: Optional[Dict] = None,
+                          page_size: Optional[int] = None, continuation: Optional[str] = None,
+                          with_references: bool = True) -> Tuple[List[ChatMessage], Optional[str]]:
+        """Page through the persisted messages; pending ones are added to the last page"""
+        with self._lock:
+            entry = self._overlay.get((user_id, chat_id))
+            if entry is not None:
+                durable = entry["durable"]
+                durable_count = durable.get("messageCount", len(durable.get("messages", []))) if durable else 0
+                pending = [message for message in entry["chat"]["messages"] if message.seq > durable_count]
+        if entry is None:
+            return self.db_manager.get_chat_messages(user_id, chat_id, header, page_size, continuation, with_references)
+        
+        # Read only what the last persisted header counts, so nothing is returned twice
+        messages, continuation = (
+            self.db_manager.get_chat_messages(user_id, chat_id, durable, page_size, continuation, with_references)
+            if durable else ([], None)
+        )
+        return (messages, continuation) if continuation else (messages + pending, None)
+    
+    def _run(self, work_queue: queue.Queue):
+        while True:
+            turn = work_queue.get()
+            if turn is _STOP:
+                work_queue.task_done()
+                return
+            
+            turns = [turn]
+            stop = False
+            while len(turns) < self.max_drain:
+                try:
+                    turn = work_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if turn is _STOP:
+                    stop = True
+                    work_queue.task_done()
+                    break
+                turns.append(turn)
+            
+            try:
+                self._write(turns)
+            finally:
+                for _ in turns:
+                    work_queue.task_done()
+            if stop:
+                return
+    
+    def _write(self, turns: List[Dict]):
+        """Persist turns, coalescing consecutive turns of the same chat into one batch"""
+        by_chat: Dict[Tuple[str, str], List[Dict]] = {}
+        for turn in turns:
+            by_chat.setdefault((turn["user_id"], turn["chat_id"]), []).append(turn)
+        
+        for key, chat_turns in by_chat.items():
+            messages = [message for turn in chat_turns for message in turn["messages"]]
+            summaries = [turn["history_summary"] for turn in chat_turns if turn["history_summary"]]
+            written = self._write_chat(key, chat_turns[0]["chat_name"], messages, summaries[-1] if summaries else None)
+            
+            with self._lock:
+                entry = self._overlay.get(key)
+                if entry is None:
+                    continue
+                entry["pending"] -= len(chat_turns)
+                if written is not None:
+                    entry["durable"] = written
+                if entry["pending"] <= 0 or written is None:
+                    # Either Cosmos is now current or the write was abandoned; stop serving the overlay
+                    del self._overlay[key]
+    
+    def _write_chat(self, key: Tuple[str, str], chat_name: str, messages: List[ChatMessage],
+                    history_summary: Optional[Dict]) -> Optional[Dict]:
+        user_id, chat_id = key
+        with self._lock:
+            entry = self._overlay.get(key)
+            base = entry["durable"] if entry else None
+        
+        for attempt in range(self.max_retries + 1):
+            try:
+                header = self.db_manager.append_messages(user_id, chat_id, chat_name, messages, base, history_summary)
+                self.written += 1
+                return header
+            except ChatConflictError:
+                # Another instance wrote to the chat; append after whatever it stored
+                logger.warning(f"Write-behind conflict on chat {chat_id}, reloading header")
+                base = self.db_manager.get_chat_header(user_id, chat_id)
+            except Exception as e:
+                logger.warning(f"Write-behind attempt {attempt + 1} for chat {chat_id} failed: {str(e)}")
+            if attempt < self.max_retries:
+                time.sleep(self.retry_backoff_seconds * (2 ** attempt))
+        
+        self.failed += 1
+        logger.error(f"Dropping {len(messages)} messages for chat {chat_id} after {self.max_retries + 1} attempts")
+        return None
+    
+    def flush(self):
+        """Block until every queued turn has been written (or abandoned)"""
+        for work_queue in self._queues:
+            work_queue.join()
+    
+    def close(self, timeout: float = 30.0):
+        """Stop accepting queued turns, write what is pending and stop the workers"""
+        if self._closed:
+            return
+        self._closed = True
+        for work_queue in self._queues:
+            work_queue.put(_STOP)
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        with self._lock:
+            pending = sum(entry["pending"] for entry in self._overlay.values())
+        if pending:
+            logger.error(f"Write-behind shut down with {pending} turns still pending")
+    
+    def stats(self) -> Dict:
+        with self._lock:
+            pending = sum(entry["pending"] for entry in self._overlay.values())
+        return {
+            "queued": sum(work_queue.qsize() for work_queue in self._queues),
+            "pendingTurns": pending,
+            "written": self.written,
+            "failed": self.failed
+        }
@@ -0,0 +1,37 @@
+# provision.py - Create the Cosmos DB database and containers the backends use
+#
+# Usage: python provision.py [--with-cache-container]
+#
+# Run once per environment (e.g. from the deployment pipeline) before the app
+# starts; app.py and main.py no longer create them on startup unless
+# COSMOS_AUTO_PROVISION is set. Idempotent: existing resources are left as is.
+# Reads the APPSETTING_* settings used by app.py; main.py shares the container.
+import argparse
+import logging
+import sys
+
+from config import get_config
+from models import CosmosDBManager
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s %(levelname)s %(name)s %(message)s',
+    handlers=[logging.StreamHandler(sys.stdout)]
+)
+logger = logging.getLogger(__name__)
+
+def main():
+    parser = argparse.ArgumentParser(description="Create the Cosmos DB database and containers if missing")
+    parser.add_argument("--with-cache-container", action="store_true",
+                        help="Also create the answer cache container (implied by ANSWER_CACHE_BACKEND=cosmos)")
+    args = parser.parse_args()
+    
+    config = get_config()
+    with_cache = args.with_cache_container or config.ANSWER_CACHE_BACKEND == 'cosmos'
+    db_manager = CosmosDBManager(config)
+    db_manager.provision(config.COSMOS_CACHE_CONTAINER_NAME if with_cache else None)
+    db_manager.ping()
+    logger.info("Cosmos DB is provisioned and reachable")
+
+if __name__ == '__main__':
+    main()
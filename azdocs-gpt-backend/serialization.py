@@ -0,0 +1,200 @@
+# serialization.py - JSON encoding, response compression and ETags shared by both apps
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import datetime
+import gzip
+import importlib.util
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Event streams are flushed per event and are never buffered for compression
+COMPRESSIBLE_TYPES = ("application/json", "text/plain", "text/html", "text/css", "application/javascript")
+ENCODINGS = ("gzip", "br")
+# Per-user responses: browsers keep them but revalidate with If-None-Match before every reuse
+REVALIDATE = "private, no-cache"
+
+def _default(obj):
+    """Types neither encoder handles: API records (models.ChatMessage, Reference) and dates"""
+    to_api = getattr(obj, "to_api", None)
+    if to_api is not None:
+        return to_api()
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+class JSONCodec:
+    """``dumps`` to UTF-8 bytes and ``loads``, with orjson or the standard library.
+    
+    "auto" picks orjson when the package is installed. Output is compact and
+    keys keep their insertion order under both.
+    """
+    
+    def __init__(self, name: str = "auto"):
+        name = (name or "auto").lower()
+        has_orjson = importlib.util.find_spec("orjson") is not None
+        if name == "auto":
+            name = "orjson" if has_orjson else "json"
+        elif name == "orjson" and not has_orjson:
+            logger.warning("JSON_ENCODER is 'orjson' but the package is not installed; using the standard library")
+            name = "json"
+        self.name = name
+        
+        if name == "orjson":
+            import orjson
+            option = orjson.OPT_NON_STR_KEYS
+            self.dumps: Callable[[Any], bytes] = lambda obj: orjson.dumps(obj, default=_default, option=option)
+            self.loads: Callable[[Any], Any] = orjson.loads
+        else:
+            encoder = json.JSONEncoder(default=_default, ensure_ascii=False, separators=(",", ":"))
+            self.dumps = lambda obj: encoder.encode(obj).encode("utf-8")
+            self.loads = json.loads
+
+_codec = JSONCodec()
+
+def configure(name: str = "auto") -> JSONCodec:
+    """Select the encoder ('auto', 'orjson' or 'json') for every dumps/loads below"""
+    global _codec
+    _codec = JSONCodec(name)
+    logger.info(f"JSON encoder: {_codec.name}")
+    return _codec
+
+def dumps(obj: Any) -> bytes:
+    return _codec.dumps(obj)
+
+def loads(data) -> Any:
+    return _codec.loads(data)
+
+# Response compression
+
+HAS_BROTLI = importlib.util.find_spec("brotli") is not None
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """Pick "br" (when the brotli package is installed) or "gzip" from an Accept-Encoding header"""
+    accepted: Dict[str, float] = {}
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        if coding:
+            accepted[coding.strip().lower()] = quality
+    if HAS_BROTLI and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", accepted.get("*", 0)) > 0:
+        return "gzip"
+    return None
+
+class Compressor:
+    """Which responses to compress, and the compression itself.
+    
+    Only buffered bodies of at least ``min_bytes`` with a compressible type
+    are compressed; small JSON errors and event streams are left alone.
+    """
+    
+    def __init__(self, enabled: bool = True, min_bytes: int = 1024, gzip_level: int = 1, brotli_quality: int = 4):
+        self.enabled = enabled
+        self.min_bytes = min_bytes
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+    
+    def choose(self, accept_encoding: Optional[str], content_type: Optional[str], size: int,
+               content_encoding: Optional[str] = None) -> Optional[str]:
+        """The encoding to apply to this response, or None to send it as is"""
+        if not self.enabled or size < self.min_bytes or content_encoding or not content_type:
+            return None
+        if content_type.split(";")[0].strip().lower() not in COMPRESSIBLE_TYPES:
+            return None
+        return negotiate_encoding(accept_encoding)
+    
+    def compress(self, data: bytes, encoding: str) -> bytes:
+        if encoding == "br":
+            import brotli
+            return brotli.compress(data, quality=self.brotli_quality)
+        return gzip.compress(data, compresslevel=self.gzip_level, mtime=0)
+
+# Conditional requests
+
+def encoded_etag(etag: str, encoding: str) -> str:
+    """The ETag of the compressed representation: strong ETags must differ per content coding"""
+    if not etag or etag.startswith("W/"):
+        return etag
+    return f'{etag[:-1]}-{encoding}"'
+
+def matching_etag(if_none_match: Optional[str], etag: str) -> Optional[str]:
+    """The entity tag of an If-None-Match header that matches ``etag``, or None.
+    
+    Uses the weak comparison If-None-Match calls for and accepts the
+    ``encoded_etag`` variants, so the client's cached copy is still current
+    whichever encoding it was sent with. The match is what a 304 should carry.
+    """
+    if not if_none_match:
+        return None
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return etag
+        tag = candidate[2:] if candidate.startswith("W/") else candidate
+        base, _, encoding = tag.rpartition("-")
+        if tag == opaque or (encoding[:-1] in ENCODINGS and base + '"' == opaque):
+            return candidate
+    return None
+
+def _header(headers: List[Tuple[bytes, bytes]], name: bytes) -> Optional[str]:
+    for key, value in headers:
+        if key.lower() == name:
+            return value.decode("latin-1")
+    return None
+
+class CompressionMiddleware:
+    """ASGI middleware applying a Compressor to single-body responses.
+    
+    The response start is held back until the first body message: when it
+    is the whole body it may be compressed, when more follows (streaming,
+    SSE) both are passed through unchanged.
+    """
+    
+    def __init__(self, app, compressor: Compressor):
+        self.app = app
+        self.compressor = compressor
+    
+    async def __call__(self, scope, receive, send):
+        accept_encoding = _header(scope.get("headers", []), b"accept-encoding") if scope["type"] == "http" else None
+        if not accept_encoding or not self.compressor.enabled:
+            await self.app(scope, receive, send)
+            return
+        
+        held = None
+        
+        async def send_compressed(message):
+            nonlocal held
+            if message["type"] == "http.response.start":
+                held = message
+                return
+            if held is not None:
+                start, held = held, None
+                body = message.get("body", b"")
+                headers = list(start.get("headers", []))
+                encoding = None if message.get("more_body") else self.compressor.choose(
+                    accept_encoding, _header(headers, b"content-type"), len(body), _header(headers, b"content-encoding")
+                )
+                if encoding:
+                    body = self.compressor.compress(body, encoding)
+                    headers = [
+                        (key, encoded_etag(value.decode("latin-1"), encoding).encode("latin-1")) if key.lower() == b"etag"
+                        else (key, value)
+                        for key, value in headers if key.lower() != b"content-length"
+                    ]
+                    headers += [(b"content-encoding", encoding.encode("latin-1")),
+                                (b"content-length", str(len(body)).encode("latin-1")),
+                                (b"vary", b"Accept-Encoding")]
+                    start = dict(start, headers=headers)
+                    message = dict(message, body=body)
+                await send(start)
+            await send(message)
+        
+        await self.app(scope, receive, send_compressed)
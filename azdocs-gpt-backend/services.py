@@ -1,59 +1,248 @@
 # services.py - Business logic services
 from openai import AzureOpenAI
+from openai.types.chat import ChatCompletionMessageToolCall
+from openai.types.chat.chat_completion_message_tool_call import Function
 from azure.identity import ClientSecretCredential
 from azure.search.documents import SearchClient
-from azure.search.documents.models import VectorizableTextQuery
+from azure.search.documents.models import VectorizableTextQuery, VectorizedQuery
 from azure.core.credentials import AzureKeyCredential
+from cache import LRUCache, CosmosCache
+from governor import OpenAIGovernor, estimate_tokens
+from telemetry import timed, record_tokens
+from transport import LazyClient, get_transport
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
 import msal
 import jwt
 import json
+import hashlib
+import re
+import time
 import datetime
-from typing import Tuple, List, Dict, Optional
+import uuid
+from typing import Tuple, List, Dict, Optional, Iterator
 import logging
 
 logger = logging.getLogger(__name__)
 
+def format_search_content(references: List[Dict]) -> str:
+    """Render search results as the grounding text given to the model"""
+    return "".join(f"[{ref['title']}]: {ref['content']}\n----\n" for ref in references)
+
+def reciprocal_rank_fusion(result_lists: List[List[Dict]], top: int, k: int = 60) -> List[Dict]:
+    """Fuse several ranked result lists, scoring each chunk by sum(1 / (k + rank)).
+    
+    Chunks returned by more than one query are deduplicated on (title, content)
+    and rise to the top; ties keep the order in which chunks were first seen.
+    """
+    scores: Dict[Tuple[str, str], float] = {}
+    chunks: Dict[Tuple[str, str], Dict] = {}
+    for results in result_lists:
+        for rank, ref in enumerate(results, start=1):
+            key = (ref["title"], ref["content"])
+            chunks.setdefault(key, ref)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    ranked = sorted(chunks, key=lambda key: scores[key], reverse=True)
+    return [chunks[key] for key in ranked[:top]]
+
+class ContextPacker:
+    """Turns retrieved chunks into the grounding text for the answer prompt.
+    
+    Near-identical chunks (word-shingle Jaccard similarity at or above
+    ``dedup_threshold``) are dropped, chunks from the same document are merged
+    into one block with any overlap between neighbouring chunks removed, blocks
+    are ordered by their best reranker score, and blocks are added until
+    ``token_budget`` is spent - the last one truncated at a word boundary if at
+    least ``min_block_tokens`` still fit. Returns both the prompt text and the
+    references that actually made it in.
+    """
+    
+    SHINGLE_SIZE = 3
+    
+    def __init__(self, token_budget: int = 2000, dedup_threshold: float = 0.85, min_block_tokens: int = 64):
+        self.token_budget = token_budget
+        self.dedup_threshold = dedup_threshold
+        self.min_block_tokens = min_block_tokens
+    
+    @classmethod
+    def from_config(cls, config) -> Optional['ContextPacker']:
+        if not config.CONTEXT_PACKING_ENABLED:
+            return None
+        return cls(config.CONTEXT_TOKEN_BUDGET, config.CONTEXT_DEDUP_THRESHOLD)
+    
+    @classmethod
+    def _shingles(cls, text: str) -> set:
+        words = re.findall(r"\w+", text.lower())
+        if len(words) < cls.SHINGLE_SIZE:
+            return {" ".join(words)}
+        return {" ".join(words[i:i + cls.SHINGLE_SIZE]) for i in range(len(words) - cls.SHINGLE_SIZE + 1)}
+    
+    def deduplicate(self, references: List[Dict]) -> List[Dict]:
+        kept, kept_shingles = [], []
+        for ref in references:
+            shingles = self._shingles(ref["content"])
+            if any(len(shingles & other) / max(1, len(shingles | other)) >= self.dedup_threshold for other in kept_shingles):
+                continue
+            kept.append(ref)
+            kept_shingles.append(shingles)
+        return kept
+    
+    @staticmethod
+    def _join(first: str, second: str, min_overlap: int = 20, max_overlap: int = 2000) -> str:
+        """Concatenate two chunks of one document, dropping the text they share at the seam"""
+        tail = first[-max_overlap:]
+        start = tail.find(second[:min_overlap])
+        while start != -1:
+            if second.startswith(tail[start:]):
+                return first + second[len(tail) - start:]
+            start = tail.find(second[:min_overlap], start + 1)
+        return f"{first}\n...\n{second}"
+    
+    def merge_documents(self, references: List[Dict]) -> List[Dict]:
+        """One block per title, in order of first appearance, scored by its best chunk"""
+        blocks: Dict[str, Dict] = {}
+        for ref in references:
+            block = blocks.get(ref["title"])
+            if block is None:
+                blocks[ref["title"]] = dict(ref)
+                continue
+            block["content"] = self._join(block["content"], ref["content"])
+            if ref.get("score") is not None and (block.get("score") is None or ref["score"] > block["score"]):
+                block["score"] = ref["score"]
+        return list(blocks.values())
+    
+    def pack(self, references: List[Dict]) -> Tuple[str, List[Dict]]:
+        blocks = self.merge_documents(self.deduplicate(references))
+        # Stable sort: blocks without a reranker score keep their retrieval order after scored ones
+        blocks.sort(key=lambda block: -block["score"] if block.get("score") is not None else float("inf"))
+        
+        packed = []
+        budget = self.token_budget
+        for block in blocks:
+            cost = HistoryCompactor.estimate_tokens(f"[{block['title']}]: {block['content']}")
+            if cost <= budget:
+                packed.append(block)
+                budget -= cost
+                continue
+            if budget >= self.min_block_tokens:
+                chars = max(0, (budget - HistoryCompactor.estimate_tokens(block["title"]) - 4) * 4)
+                content = block["content"][:chars].rsplit(" ", 1)[0]
+                packed.append(dict(block, content=content + " ..."))
+            break
+        
+        logger.info(f"Packed {len(references)} chunks into {len(packed)} blocks ({self.token_budget - budget} tokens budgeted)")
+        return format_search_content(packed), packed
+
 class AzureSearchService:
-    """Handles Azure AI Search operations"""
+    """Handles Azure AI Search operations.
     
-    def __init__(self, config):
+    Query vectors are computed by the index's vectorizer unless an
+    ``embedding_service`` is given (SEARCH_QUERY_VECTORS=client), in which case
+    they come from its cache and are sent as a VectorizedQuery.
+    """
+    
+    def __init__(self, config, embedding_service=None):
         self.client = SearchClient(
             endpoint=config.AZURE_SEARCH_ENDPOINT,
             index_name=config.AZURE_SEARCH_INDEX,
-            credential=AzureKeyCredential(config.AZURE_SEARCH_KEY)
+            credential=AzureKeyCredential(config.AZURE_SEARCH_KEY),
+            **get_transport(config).azure_options("search")
         )
         self.semantic_config = config.AZURE_SEARCH_SEMANTIC_CONFIG
+        self.select = "title,chunk"
+        self.embedding_service = embedding_service
+        self._init_retrieval(config)
+    
+    def _init_retrieval(self, config):
+        """Result count, fusion, packing, fan-out and caching settings shared with LocalSearchService"""
         self.results_count = config.SEARCH_RESULTS_COUNT
+        self.rrf_k = config.SEARCH_RRF_K
+        self.packer = ContextPacker.from_config(config)
+        self.max_parallel_queries = config.SEARCH_MAX_PARALLEL_QUERIES
+        self.executor = ThreadPoolExecutor(max_workers=self.max_parallel_queries, thread_name_prefix="search")
+        self.cache = None
+        if config.SEARCH_CACHE_ENABLED:
+            self.cache = LRUCache(
+                max_entries=config.SEARCH_CACHE_MAX_ENTRIES,
+                ttl_seconds=config.SEARCH_CACHE_TTL_SECONDS,
+                max_bytes=config.SEARCH_CACHE_MAX_BYTES,
+                size_of=lambda result: len(result[0]) + sum(len(r["title"]) + len(r["content"]) for r in result[1])
+            )
+    
+    def _cache_key(self, query: str) -> str:
+        return json.dumps([query, self.results_count, self.semantic_config, self.select])
     
-    def search(self, query: str) -> Tuple[str, List[Dict]]:
-        """Search Azure AI Search and return formatted content and references"""
+    def invalidate_cache(self):
+        """Drop cached results, e.g. after the index has been re-ingested"""
+        if self.cache:
+            self.cache.clear()
+            logger.info("Search result cache invalidated")
+    
+    def cache_stats(self) -> Optional[Dict]:
+        return self.cache.stats() if self.cache else None
+    
+    def _vector_query(self, query: str, vector: Optional[List[float]]):
+        if vector is None and self.embedding_service:
+            vector = self.embedding_service.embed_query(query)
+        if vector is not None:
+            return VectorizedQuery(vector=vector, k_nearest_neighbors=50, fields="text_vector")
+        return VectorizableTextQuery(text=query, k_nearest_neighbors=50, fields="text_vector")
+    
+    @timed("search.query")
+    def _query(self, query: str, vector: Optional[List[float]] = None) -> List[Dict]:
+        results = self.client.search(
+            search_text=query,
+            query_type="semantic",
+            semantic_configuration_name=self.semantic_config,
+            select=self.select,
+            top=self.results_count,
+            vector_queries=[self._vector_query(query, vector)]
+        )
+        return [
+            {"title": result['title'], "content": result['chunk'], "score": result.get('@search.reranker_score')}
+            for result in results
+        ]
+    
+    def search(self, query: str, vector: Optional[List[float]] = None) -> Tuple[str, List[Dict]]:
+        """Search the index and return formatted content and references.
+        
+        ``vector`` is a precomputed query embedding; pass it to skip vectorizing the query again.
+        """
+        if self.cache:
+            cached = self.cache.get(self._cache_key(query))
+            if cached is not None:
+                logger.info(f"Search cache hit for query: {query[:50]}...")
+                return cached
+        
         try:
-            results = self.client.search(
-                search_text=query,
-                query_type="semantic",
-                semantic_configuration_name=self.semantic_config,
-                select="title,chunk",
-                top=self.results_count,
-                vector_queries=[VectorizableTextQuery(text=query, k_nearest_neighbors=50, fields="text_vector")]
-            )
-            
-            references = []
-            content = ""
-            
-            for result in results:
-                content += f"[{result['title']}]: {result['chunk']}\n----\n"
-                references.append({
-                    "title": result['title'],
-                    "content": result['chunk']
-                })
+            references = self._query(query, vector)
+            content = format_search_content(references)
             
             logger.info(f"Search completed for query: {query[:50]}... Found {len(references)} results")
+            if self.cache:
+                self.cache.set(self._cache_key(query), (content, references))
             return content, references
             
         except Exception as e:
             logger.error(f"Search error for query '{query}': {str(e)}")
             raise
 
+    def search_many(self, queries: List[str]) -> Tuple[str, List[Dict]]:
+        """Run several queries concurrently, fuse their rankings and pack the result into the prompt budget"""
+        queries = list(dict.fromkeys(queries))[:self.max_parallel_queries]
+        if len(queries) == 1:
+            references = self.search(queries[0])[1]
+        else:
+            # Each worker runs in a copy of the request's context (request id, trace span)
+            futures = [self.executor.submit(contextvars.copy_context().run, self.search, query) for query in queries]
+            result_lists = [future.result()[1] for future in futures]
+            references = reciprocal_rank_fusion(result_lists, self.results_count, self.rrf_k)
+            logger.info(f"Fused {sum(len(r) for r in result_lists)} results from {len(queries)} queries into {len(references)}")
+        
+        if self.packer:
+            return self.packer.pack(references)
+        return format_search_content(references), references
+
 class OpenAIService:
     """Handles Azure OpenAI operations"""
     
@@ -61,11 +250,17 @@ class OpenAIService:
         self.client = AzureOpenAI(
             api_version=config.AZURE_OPENAI_API_VERSION,
             azure_endpoint=config.AZURE_OPENAI_ENDPOINT,
-            api_key=config.AZURE_OPENAI_KEY
+            api_key=config.AZURE_OPENAI_KEY,
+            **get_transport(config).openai_options()
         )
         self.deployment = config.AZURE_OPENAI_DEPLOYMENT
+        self.embedding_deployment = config.AZURE_OPENAI_EMBEDDING_DEPLOYMENT
         self.system_prompt = self._get_system_prompt()
         self.search_tools = self._get_search_tools()
+        self.governor = OpenAIGovernor.from_config(config)
+        self.completion_token_estimate = config.OPENAI_COMPLETION_TOKEN_ESTIMATE
+        # The governor owns retries of chat calls so that it sees (and backs everyone off on) 429s
+        self.chat = self.client.with_options(max_retries=0).chat if self.governor else self.client.chat
     
     def _get_system_prompt(self) -> str:
         return (
@@ -99,50 +294,375 @@ class OpenAIService:
             }
         ]
     
-    def generate_search_query(self, messages: List[Dict]) -> str:
-        """Generate a search query using OpenAI"""
+    def _complete(self, messages: List[Dict], user_id: Optional[str] = None, completion_tokens: Optional[int] = None, **options):
+        """chat.completions.create through the rate governor, when one is configured"""
+        def create():
+            return self.chat.completions.create(model=self.deployment, messages=messages, **options)
+        
+        if options.get("stream"):
+            # Streamed responses carry no usage, so they are not counted in the token metrics
+            if not self.governor:
+                return create()
+            tokens = estimate_tokens(messages, completion_tokens or self.completion_token_estimate)
+            return self.governor.stream(create, tokens, user_id)
+        if not self.governor:
+            completion = create()
+        else:
+            tokens = estimate_tokens(messages, completion_tokens or self.completion_token_estimate)
+            completion = self.governor.call(create, tokens, user_id)
+        record_tokens(getattr(completion, "usage", None))
+        return completion
+    
+    @timed("openai.plan")
+    def generate_search_queries(self, messages: List[Dict], user_id: Optional[str] = None) -> List[Tuple[str, ChatCompletionMessageToolCall]]:
+        """Ask the model for search queries; returns every (query, tool_call) it requested"""
         try:
-            completion = self.client.chat.completions.create(
-                model=self.deployment,
-                messages=messages,
-                tools=self.search_tools
-            )
+            completion = self._complete(messages, user_id, completion_tokens=100, tools=self.search_tools)
             
+            searches = []
             if completion.choices[0].finish_reason == "tool_calls":
                 for call in completion.choices[0].message.tool_calls:
                     if call.function.name == "search":
                         query_data = json.loads(call.function.arguments)
-                        return query_data["query"], call
-            
-            return None, None
+                        searches.append((query_data["query"], call))
+            return searches
             
         except Exception as e:
             logger.error(f"Error generating search query: {str(e)}")
             raise
+
     
-    def generate_answer(self, messages: List[Dict]) -> str:
+    @timed("openai.answer")
+    def generate_answer(self, messages: List[Dict], user_id: Optional[str] = None) -> str:
         """Generate answer based on search results"""
         try:
-            completion = self.client.chat.completions.create(
-                model=self.deployment,
-                messages=messages
-            )
+            completion = self._complete(messages, user_id)
             return completion.choices[0].message.content
             
         except Exception as e:
             logger.error(f"Error generating answer: {str(e)}")
             raise
+    
+    @timed("openai.summarize")
+    def summarize_history(self, previous_summary: Optional[str], messages: List[Dict]) -> str:
+        """Fold older conversation turns into a short running summary"""
+        transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+        prompt = (
+            "Summarize the following conversation between a developer and an Azure documentation assistant "
+            "in at most 150 words. Keep product names, resource names and any decisions or open questions."
+        )
+        if previous_summary:
+            transcript = f"Summary so far: {previous_summary}\n{transcript}"
+        try:
+            completion = self._complete(
+                [
+                    {"role": "system", "content": prompt},
+                    {"role": "user", "content": transcript}
+                ],
+                completion_tokens=250
+            )
+            return completion.choices[0].message.content
+            
+        except Exception as e:
+            logger.error(f"Error summarizing history: {str(e)}")
+            raise
+    
+    @timed("openai.embed")
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        """Embed a batch of texts in one call, returning vectors in input order"""
+        try:
+            response = self.client.embeddings.create(model=self.embedding_deployment, input=texts)
+            return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+            
+        except Exception as e:
+            logger.error(f"Error embedding {len(texts)} texts: {str(e)}")
+            raise
+    
+    @timed("openai.stream_answer")
+    def stream_answer(self, messages: List[Dict], user_id: Optional[str] = None) -> Iterator[str]:
+        """Stream answer tokens based on search results as they are generated"""
+        try:
+            stream = self._complete(messages, user_id, stream=True)
+            for chunk in stream:
+                # Azure sends a leading chunk with only content filter results
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+            
+        except Exception as e:
+            logger.error(f"Error streaming answer: {str(e)}")
+            raise
+
+class QueryPlanner:
+    """Derives the search query locally when the user message can stand on its own.
+    
+    Strategies: ``llm`` always defers to the tool-call round trip, ``local``
+    plans every turn without history locally, and ``auto`` additionally plans
+    short follow-ups locally unless they look like they refer back to earlier
+    turns. When ``plan_locally`` returns None the caller falls back to
+    ``OpenAIService.generate_search_queries``.
+    """
+    
+    STOPWORDS = frozenset((
+        "a", "an", "the", "i", "me", "my", "we", "our", "you", "your", "is", "are", "was", "were", "be",
+        "been", "do", "does", "did", "can", "could", "should", "would", "will", "shall", "may", "might",
+        "must", "to", "of", "in", "on", "for", "with", "about", "from", "by", "at", "as", "into", "please",
+        "tell", "explain", "show", "help", "need", "want", "know", "how", "what", "which", "when", "where",
+        "why", "who", "there", "any", "some", "way", "ways", "and", "or", "hi", "hello", "thanks", "thank"
+    ))
+    # Words that usually point back at something said earlier in the conversation
+    COREFERENCE_MARKERS = frozenset((
+        "it", "its", "that", "this", "those", "these", "they", "them", "their", "above", "previous",
+        "earlier", "same", "also", "instead", "else", "one", "ones", "former", "latter", "about"
+    ))
+    
+    def __init__(self, strategy: str = "llm", max_local_words: int = 24):
+        self.strategy = (strategy or "llm").lower()
+        self.max_local_words = max_local_words
+    
+    @classmethod
+    def from_config(cls, config) -> 'QueryPlanner':
+        return cls(config.QUERY_PLANNING_STRATEGY, config.QUERY_LOCAL_MAX_WORDS)
+    
+    @staticmethod
+    def _tokenize(text: str) -> List[str]:
+        return re.findall(r"[A-Za-z0-9][\w.\-/']*", text)
+    
+    def extract_keywords(self, message: str) -> str:
+        """Keep the content words of the message, preserving product names as written"""
+        keywords = []
+        for token in self._tokenize(message):
+            token = token.rstrip(".'")
+            if token and token.lower() not in self.STOPWORDS and token.lower() not in keywords:
+                keywords.append(token)
+        return " ".join(keywords)
+    
+    def is_self_contained(self, message: str) -> bool:
+        words = [w.lower() for w in self._tokenize(message)]
+        if not words or len(words) > self.max_local_words:
+            return False
+        return not any(w in self.COREFERENCE_MARKERS for w in words)
+    
+    def plan_locally(self, chat_history: List, user_message: str) -> Optional[Tuple[str, ChatCompletionMessageToolCall]]:
+        """Return (query, tool_call) when the query can be derived without the LLM"""
+        if self.strategy == "llm":
+            return None
+        if chat_history and (self.strategy != "auto" or not self.is_self_contained(user_message)):
+            return None
+        
+        # Nothing searchable (e.g. a greeting): let the model decide whether to search
+        query = self.extract_keywords(user_message)
+        if not query:
+            return None
+        return query, self.make_tool_call(query)
+    
+    @staticmethod
+    def make_tool_call(query: str) -> ChatCompletionMessageToolCall:
+        """Synthesize the search tool call the answer prompt expects to follow"""
+        return ChatCompletionMessageToolCall(
+            id=f"call_local_{uuid.uuid4().hex[:24]}",
+            type="function",
+            function=Function(name="search", arguments=json.dumps({"query": query}))
+        )
+
+class HistoryCompactor:
+    """Fits replayed chat history into a prompt token budget.
+    
+    The most recent ``recent_messages`` are replayed verbatim; older messages
+    are either folded into a running summary (when a summarizer is given) or
+    truncated, newest first, until the budget is spent. Stored ``references``
+    are never replayed - the model only ever sees message content.
+    """
+    
+    SUMMARY_PREFIX = "Summary of the earlier conversation: "
+    
+    def __init__(self, token_budget: int = 3000, recent_messages: int = 6, truncate_chars: int = 400,
+                 summarizer=None):
+        self.token_budget = token_budget
+        self.recent_messages = recent_messages
+        self.truncate_chars = truncate_chars
+        self.summarizer = summarizer
+    
+    @classmethod
+    def from_config(cls, config, openai_service=None) -> 'HistoryCompactor':
+        summarizer = openai_service.summarize_history if config.HISTORY_SUMMARIZE and openai_service else None
+        return cls(config.HISTORY_TOKEN_BUDGET, config.HISTORY_RECENT_MESSAGES, config.HISTORY_TRUNCATE_CHARS, summarizer)
+    
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        """Rough token count (~4 characters per token for English prose)"""
+        return len(text) // 4 + 4
+    
+    @staticmethod
+    def to_prompt_message(msg) -> Dict:
+        """From a prompt message dict, or a stored chat message (models.ChatMessage)"""
+        if not isinstance(msg, dict):
+            return {"role": msg.role, "content": msg.content or ""}
+        role = msg.get("role") or ("assistant" if msg.get("sender") == "bot" else "user")
+        return {"role": role, "content": msg.get("content", "") or ""}
+    
+    def compact(self, chat_history: List, summary: Optional[Dict] = None) -> Tuple[List[Dict], Optional[Dict]]:
+        """Return (prompt messages, summary to store on the chat document)"""
+        history = [self.to_prompt_message(m) for m in chat_history]
+        recent = history[-self.recent_messages:] if self.recent_messages else []
+        
+        # Recent turns verbatim, newest first, while they fit
+        kept: List[Dict] = []
+        budget = self.token_budget
+        for msg in reversed(recent):
+            cost = self.estimate_tokens(msg["content"])
+            if cost > budget:
+                break
+            kept.append(msg)
+            budget -= cost
+        older = history[:len(history) - len(kept)]
+        kept.reverse()
+        
+        if not older:
+            return kept, summary
+        
+        if self.summarizer:
+            summary = self._summarize(older, summary)
+            return [{"role": "system", "content": self.SUMMARY_PREFIX + summary["content"]}] + kept, summary
+        
+        # Older turns truncated, newest first, until the budget runs out
+        truncated: List[Dict] = []
+        for msg in reversed(older):
+            content = msg["content"]
+            if len(content) > self.truncate_chars:
+                content = content[:self.truncate_chars].rstrip() + " ..."
+            cost = self.estimate_tokens(content)
+            if cost > budget:
+                break
+            truncated.append({"role": msg["role"], "content": content})
+            budget -= cost
+        truncated.reverse()
+        return truncated + kept, summary
+    
+    def _summarize(self, older: List[Dict], summary: Optional[Dict]) -> Dict:
+        """Reuse the stored summary, extending it only with messages that aged out since"""
+        covered = summary.get("messageCount", 0) if summary else 0
+        if summary and covered == len(older):
+            return summary
+        if covered > len(older):
+            # History shrank (e.g. edited chat); start over
+            summary, covered = None, 0
+        
+        content = self.summarizer(summary["content"] if summary else None, older[covered:])
+        return {"content": content, "messageCount": len(older)}
+
+class AnswerCache:
+    """Caches generated answers keyed by the search query and the retrieved chunk set"""
+    
+    def __init__(self, backend):
+        self.backend = backend
+    
+    @classmethod
+    def from_config(cls, config, db_manager=None) -> Optional['AnswerCache']:
+        """Build the cache selected by ANSWER_CACHE_BACKEND ('memory', 'cosmos' or 'none')"""
+        backend_name = (config.ANSWER_CACHE_BACKEND or "none").lower()
+        if backend_name == "memory":
+            backend = LRUCache(max_entries=config.ANSWER_CACHE_MAX_ENTRIES, ttl_seconds=config.ANSWER_CACHE_TTL_SECONDS)
+        elif backend_name == "cosmos":
+            container = db_manager.get_cache_container(config.COSMOS_CACHE_CONTAINER_NAME)
+            backend = CosmosCache(container, ttl_seconds=config.ANSWER_CACHE_TTL_SECONDS)
+        else:
+            return None
+        logger.info(f"Answer cache enabled with {backend_name} backend")
+        return cls(backend)
+    
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        """Lowercase, drop punctuation and collapse whitespace so trivial variations share an entry"""
+        return " ".join(re.sub(r"[^\w\s]", " ", query.lower()).split())
+    
+    @classmethod
+    def turn_key(cls, messages: List[Dict]) -> str:
+        """Identity of a chat turn: the prompt and (compacted) history plus the normalized question.
+        
+        Used to coalesce identical questions that are in flight at the same time.
+        """
+        context = json.dumps([[m["role"], m.get("content")] for m in messages[:-1]], ensure_ascii=False)
+        key = hashlib.sha256(f"{context}\n{cls.normalize_query(messages[-1]['content'])}".encode("utf-8"))
+        return key.hexdigest()
+    
+    def make_key(self, query: str, references: List[Dict]) -> str:
+        chunks = hashlib.sha256()
+        for ref in sorted(references, key=lambda r: (r.get("title", ""), r.get("content", ""))):
+            chunks.update(ref.get("title", "").encode("utf-8"))
+            chunks.update(b"\0")
+            chunks.update(hashlib.sha256(ref.get("content", "").encode("utf-8")).digest())
+        key = hashlib.sha256(f"{self.normalize_query(query)}\n{chunks.hexdigest()}".encode("utf-8"))
+        return f"answer:{key.hexdigest()}"
+    
+    def get(self, query: str, references: List[Dict]) -> Optional[Dict]:
+        """Return the cached {"answer", "references"} entry for this query and chunk set"""
+        return self.backend.get(self.make_key(query, references))
+    
+    def set(self, query: str, references: List[Dict], answer: str):
+        self.backend.set(self.make_key(query, references), {"answer": answer, "references": references})
+    
+    def clear(self):
+        self.backend.clear()
+    
+    def stats(self) -> Dict:
+        return self.backend.stats()
+
+class TokenVerifier:
+    """Verifies HS256 bearer tokens, caching the claims of tokens already seen.
+    
+    Entries are keyed by a SHA-256 digest of the token (the raw token is never
+    stored) and expire at the token's ``exp`` or after ``max_ttl_seconds``,
+    whichever comes first. Rejected tokens are not cached.
+    """
+    
+    def __init__(self, secret_key: str, max_entries: int = 4096, max_ttl_seconds: float = 300):
+        self.secret_key = secret_key
+        self.max_ttl_seconds = max_ttl_seconds
+        self.cache = LRUCache(max_entries=max_entries, ttl_seconds=max_ttl_seconds)
+    
+    def verify(self, token: str) -> Optional[Dict]:
+        """Return the token's claims, or None if it is invalid or expired"""
+        key = hashlib.sha256(token.encode("utf-8")).hexdigest()
+        claims = self.cache.get(key)
+        if claims is not None:
+            if claims.get("exp") is None or claims["exp"] > time.time():
+                return dict(claims)
+            self.cache.delete(key)
+        
+        try:
+            claims = jwt.decode(token, self.secret_key, algorithms=["HS256"])
+        except Exception as e:
+            logger.error(f"Token decode error: {str(e)}")
+            return None
+        
+        ttl = self.max_ttl_seconds
+        if claims.get("exp") is not None:
+            ttl = min(ttl, claims["exp"] - time.time())
+        if ttl > 0:
+            self.cache.set(key, claims, ttl_seconds=ttl)
+        return dict(claims)
 
 class AuthService:
     """Handles authentication operations"""
     
     def __init__(self, config):
         self.config = config
-        self.msal_app = msal.ConfidentialClientApplication(
+        self.token_verifier = TokenVerifier(
+            config.SECRET_KEY,
+            max_entries=config.AUTH_CLAIMS_CACHE_MAX_ENTRIES,
+            max_ttl_seconds=config.AUTH_CLAIMS_CACHE_TTL_SECONDS
+        )
+        # MSAL discovers the authority when constructed, so defer that to first use
+        msal_options = get_transport(config).msal_options()
+        self.msal_app = LazyClient(lambda: msal.ConfidentialClientApplication(
             config.AZURE_AD_CLIENT_ID,
             authority=config.AZURE_AD_AUTHORITY,
-            client_credential=config.AZURE_AD_CLIENT_SECRET
-        )
+            client_credential=config.AZURE_AD_CLIENT_SECRET,
+            **msal_options
+        ), "MSAL client")
     
     def get_authorization_url(self) -> str:
         """Get Microsoft authorization URL"""
@@ -172,8 +692,4 @@ class AuthService:
     
     def decode_jwt_token(self, token: str) -> Optional[Dict]:
         """Decode and validate JWT token"""
-        try:
-            return jwt.decode(token, self.config.SECRET_KEY, algorithms=["HS256"])
-        except Exception as e:
-            logger.error(f"Token decode error: {str(e)}")
-            return None
\ No newline at end of file
+        return self.token_verifier.verify(token)
\ No newline at end of file
@@ -0,0 +1,280 @@
+# telemetry.py - Request IDs, per-stage timings and Prometheus metrics
+from contextlib import nullcontext
+from contextvars import ContextVar
+from functools import wraps
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import importlib.util
+import inspect
+import re
+import threading
+import time
+import uuid
+import logging
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+    
+    def inc(self, amount: float = 1, *labels: str):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per-bucket counts..., +Inf count, sum]
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+        self._lock = threading.Lock()
+    
+    def observe(self, value: float, *labels: str):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            else:
+                series[len(self.buckets)] += 1
+            series[-1] += value
+    
+    def summary(self, quantiles: Tuple[float, ...] = (0.5, 0.95, 0.99)) -> Dict[Tuple[str, ...], Dict]:
+        """Per label set: count, mean and each quantile as the upper bound of its bucket (None past the last)"""
+        summaries = {}
+        with self._lock:
+            for labels, series in self._series.items():
+                count = sum(series[:-1])
+                summary = {"count": count, "mean": series[-1] / count if count else 0.0}
+                for q in quantiles:
+                    cumulative = 0
+                    for bound, bucket_count in zip(self.buckets + (None,), series):
+                        cumulative += bucket_count
+                        if cumulative >= q * count:
+                            break
+                    summary[f"p{round(q * 100):g}"] = bound
+                summaries[labels] = summary
+        return summaries
+    
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), series):
+                    cumulative += count
+                    le = 'le="+Inf"' if bound == float("inf") else f'le="{_format_value(bound)}"'
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(series[-1])}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+class Gauge:
+    """Value read from a callback at scrape time (queue depths, in-flight counts)"""
+    
+    def __init__(self, name: str, documentation: str, read: Callable[[], float]):
+        self.name = name
+        self.documentation = documentation
+        self.read = read
+    
+    def render(self) -> List[str]:
+        try:
+            value = self.read()
+        except Exception as e:
+            logger.warning(f"Gauge {self.name} failed: {str(e)}")
+            return []
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge",
+                f"{self.name} {_format_value(value)}"]
+
+class MetricsRegistry:
+    """The process's metrics, rendered in the Prometheus text exposition format"""
+    
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+    
+    def _register(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+    
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+    
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+    
+    def gauge(self, name: str, documentation: str, read: Callable[[], float]) -> Gauge:
+        return self._register(Gauge(name, documentation, read))
+    
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+registry = MetricsRegistry()
+
+STAGE_SECONDS = registry.histogram(
+    "azdocs_stage_duration_seconds", "Time spent in each chat pipeline stage and service call", ("stage", "outcome")
+)
+HTTP_SECONDS = registry.histogram(
+    "azdocs_http_request_duration_seconds", "HTTP request latency until the response headers", ("method", "route", "status")
+)
+OPENAI_TOKENS = registry.counter("azdocs_openai_tokens_total", "Tokens reported by Azure OpenAI", ("kind",))
+COSMOS_REQUEST_UNITS = registry.counter("azdocs_cosmos_request_units_total", "Cosmos DB request charge", ("operation",))
+COSMOS_SECONDS = registry.histogram(
+    "azdocs_cosmos_operation_duration_seconds", "Cosmos DB call latency", ("operation",)
+)
+
+# Off until configure(); every hook below is a flag check when disabled
+_enabled = False
+_tracer = None
+
+def configure(metrics_enabled: bool, otel_enabled: bool = False, service_name: str = "azdocs-gpt-backend"):
+    """Turn metrics and, if the opentelemetry package is installed, tracing spans on or off"""
+    global _enabled, _tracer
+    _enabled = metrics_enabled
+    _tracer = None
+    if otel_enabled:
+        if importlib.util.find_spec("opentelemetry") is None:
+            logger.warning("OTEL_ENABLED is set but the 'opentelemetry-api' package is not installed; spans are off")
+        else:
+            from opentelemetry import trace
+            _tracer = trace.get_tracer(service_name)
+
+def is_enabled() -> bool:
+    return _enabled or _tracer is not None
+
+# Request IDs
+
+_request_id: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+_REQUEST_ID_PATTERN = re.compile(r"^[\w.\-]{1,64}$")
+
+def begin_request(request_id: Optional[str] = None) -> str:
+    """Adopt the caller's X-Request-ID when it is well-formed, else mint one, for the current request"""
+    if not request_id or not _REQUEST_ID_PATTERN.match(request_id):
+        request_id = uuid.uuid4().hex
+    _request_id.set(request_id)
+    return request_id
+
+def current_request_id() -> Optional[str]:
+    return _request_id.get()
+
+class RequestIdFilter(logging.Filter):
+    """Adds ``request_id`` to log records so log lines of one request can be correlated"""
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = _request_id.get() or "-"
+        return True
+
+# Stage timing
+
+class _Stage:
+    __slots__ = ("name", "started", "span", "token")
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.span = None
+        self.token = None
+    
+    def __enter__(self):
+        if _tracer is not None:
+            from opentelemetry import context, trace
+            self.span = _tracer.start_span(self.name)
+            request_id = _request_id.get()
+            if request_id:
+                self.span.set_attribute("request.id", request_id)
+            self.token = context.attach(trace.set_span_in_context(self.span))
+        self.started = time.perf_counter()
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.started
+        if _enabled:
+            STAGE_SECONDS.observe(elapsed, self.name, "error" if exc_type else "ok")
+        if self.span is not None:
+            from opentelemetry import context
+            from opentelemetry.trace import Status, StatusCode
+            if exc is not None:
+                self.span.record_exception(exc)
+                self.span.set_status(Status(StatusCode.ERROR))
+            context.detach(self.token)
+            self.span.end()
+        return False
+
+_NOOP = nullcontext()
+
+def stage(name: str):
+    """Time a block as one pipeline stage (and span); a shared no-op when telemetry is off"""
+    if not _enabled and _tracer is None:
+        return _NOOP
+    return _Stage(name)
+
+def timed(name: str):
+    """Decorator form of ``stage`` for service methods; generators are timed until exhausted or closed"""
+    def decorator(fn):
+        if inspect.isgeneratorfunction(fn):
+            @wraps(fn)
+            def generator_wrapper(*args, **kwargs):
+                with stage(name):
+                    yield from fn(*args, **kwargs)
+            return generator_wrapper
+        
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def record_http(method: str, route: str, status: int, seconds: float):
+    if _enabled:
+        HTTP_SECONDS.observe(seconds, method, route, str(status))
+
+def record_tokens(usage):
+    """Count prompt/completion tokens from an OpenAI ``usage`` object"""
+    if _enabled and usage is not None:
+        OPENAI_TOKENS.inc(getattr(usage, "prompt_tokens", 0) or 0, "prompt")
+        OPENAI_TOKENS.inc(getattr(usage, "completion_tokens", 0) or 0, "completion")
+
+def record_cosmos(operation: str, seconds: float, request_units: float):
+    if _enabled:
+        COSMOS_SECONDS.observe(seconds, operation)
+        COSMOS_REQUEST_UNITS.inc(request_units, operation)
@@ -0,0 +1,263 @@
+# transport.py - Pooled HTTP transports shared by the Azure clients
+from azure.core.pipeline.transport import RequestsTransport
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import Any, Callable, Dict, Optional
+import importlib.util
+import threading
+import time
+import os
+import httpx
+import requests
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEPENDENCIES = ("openai", "search", "cosmos", "auth")
+
+# (connect timeout s, read timeout s, retries) used when a setting is not configured
+DEFAULT_POLICIES = {
+    "openai": (5, 60, 2),
+    "search": (5, 15, 3),
+    "cosmos": (5, 10, 3),
+    "auth": (5, 10, 2)
+}
+
+class DependencyPolicy:
+    """Timeouts and retry budget for one upstream service"""
+    
+    def __init__(self, connect_timeout: float, read_timeout: float, max_retries: int):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+
+class TransportSettings:
+    """Connection pool, keep-alive and per-dependency timeout/retry settings"""
+    
+    def __init__(self, pool_size: int = 50, keepalive_seconds: float = 30, http2: bool = True,
+                 policies: Optional[Dict[str, DependencyPolicy]] = None):
+        self.pool_size = pool_size
+        self.keepalive_seconds = keepalive_seconds
+        self.http2 = http2 and importlib.util.find_spec("h2") is not None
+        if http2 and not self.http2:
+            logger.warning("HTTP/2 requested but the 'h2' package is not installed; using HTTP/1.1")
+        self.policies = policies or {
+            name: DependencyPolicy(*DEFAULT_POLICIES[name]) for name in DEPENDENCIES
+        }
+    
+    @classmethod
+    def _build(cls, get: Callable[[str, object], object]) -> 'TransportSettings':
+        policies = {}
+        for name in DEPENDENCIES:
+            connect, read, retries = DEFAULT_POLICIES[name]
+            prefix = name.upper()
+            policies[name] = DependencyPolicy(
+                float(get(f"{prefix}_CONNECT_TIMEOUT", connect)),
+                float(get(f"{prefix}_READ_TIMEOUT", read)),
+                int(get(f"{prefix}_MAX_RETRIES", retries))
+            )
+        return cls(
+            pool_size=int(get("HTTP_POOL_SIZE", 50)),
+            keepalive_seconds=float(get("HTTP_KEEPALIVE_SECONDS", 30)),
+            http2=str(get("HTTP2_ENABLED", "true")).lower() == "true",
+            policies=policies
+        )
+    
+    @classmethod
+    def from_config(cls, config) -> 'TransportSettings':
+        return cls._build(lambda name, default: getattr(config, name, default))
+    
+    @classmethod
+    def from_env(cls) -> 'TransportSettings':
+        """Read unprefixed environment variables (the FastAPI app's convention)"""
+        return cls._build(lambda name, default: os.getenv(name, default))
+
+def _httpx_options(settings: TransportSettings, policy: DependencyPolicy) -> Dict:
+    return {
+        "http2": settings.http2,
+        "timeout": httpx.Timeout(policy.read_timeout, connect=policy.connect_timeout),
+        "limits": httpx.Limits(
+            max_connections=settings.pool_size,
+            max_keepalive_connections=settings.pool_size,
+            keepalive_expiry=settings.keepalive_seconds
+        )
+    }
+
+class Transport:
+    """Owns the pooled HTTP sessions used by every synchronous client in the process.
+    
+    The Azure SDK clients (Search, Cosmos) share one keep-alive ``requests``
+    session, so bursts reuse warm TLS connections instead of handshaking per
+    client. MSAL gets its own pooled session with connect retries, and OpenAI
+    an ``httpx`` client (HTTP/2 when available). Elsewhere retries are left to
+    each SDK's own policy, sized per dependency.
+    """
+    
+    def __init__(self, settings: TransportSettings):
+        self.settings = settings
+        self._session: Optional[requests.Session] = None
+        self._auth_session: Optional[requests.Session] = None
+        self._lock = threading.Lock()
+    
+    def _pooled_session(self, retries: int) -> requests.Session:
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.settings.pool_size,
+            pool_maxsize=self.settings.pool_size,
+            max_retries=Retry(total=retries, connect=retries, read=0, backoff_factor=0.5) if retries else 0
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+    
+    @property
+    def session(self) -> requests.Session:
+        with self._lock:
+            if self._session is None:
+                # No adapter-level retries: the Azure SDK retry policy owns them
+                self._session = self._pooled_session(0)
+            return self._session
+    
+    def policy(self, dependency: str) -> DependencyPolicy:
+        return self.settings.policies[dependency]
+    
+    def openai_options(self) -> Dict:
+        """Keyword arguments for AzureOpenAI"""
+        policy = self.policy("openai")
+        options = _httpx_options(self.settings, policy)
+        return {
+            "http_client": httpx.Client(**options),
+            "timeout": options["timeout"],
+            "max_retries": policy.max_retries
+        }
+    
+    def azure_options(self, dependency: str) -> Dict:
+        """Keyword arguments for an azure-core based client (SearchClient, CosmosClient)"""
+        policy = self.policy(dependency)
+        options = {
+            "transport": RequestsTransport(
+                session=self.session,
+                session_owner=False,
+                connection_timeout=policy.connect_timeout,
+                read_timeout=policy.read_timeout
+            ),
+            "retry_total": policy.max_retries
+        }
+        if dependency == "cosmos":
+            # Cosmos applies its own request timeout on top of the transport's
+            options["connection_timeout"] = policy.connect_timeout + policy.read_timeout
+        return options
+    
+    def msal_options(self) -> Dict:
+        """Keyword arguments for msal.ConfidentialClientApplication"""
+        policy = self.policy("auth")
+        with self._lock:
+            if self._auth_session is None:
+                # MSAL has no retry policy of its own, so retry failed connects at the adapter
+                self._auth_session = self._pooled_session(policy.max_retries)
+        return {"http_client": self._auth_session, "timeout": (policy.connect_timeout, policy.read_timeout)}
+    
+    def close(self):
+        for session in (self._session, self._auth_session):
+            if session is not None:
+                session.close()
+
+class AsyncTransport(Transport):
+    """Async counterpart for the FastAPI app: one aiohttp session for the Azure SDK clients.
+    
+    Create it inside the running event loop (the app lifespan) and close it on shutdown.
+    """
+    
+    def __init__(self, settings: TransportSettings):
+        super().__init__(settings)
+        self._aiohttp_session = None
+        self._httpx_clients = []
+    
+    def openai_options(self) -> Dict:
+        """Keyword arguments for AsyncAzureOpenAI"""
+        policy = self.policy("openai")
+        options = _httpx_options(self.settings, policy)
+        client = httpx.AsyncClient(**options)
+        self._httpx_clients.append(client)
+        return {"http_client": client, "timeout": options["timeout"], "max_retries": policy.max_retries}
+    
+    def azure_options(self, dependency: str) -> Dict:
+        """Keyword arguments for an azure-core aio client"""
+        import aiohttp
+        from azure.core.pipeline.transport import AioHttpTransport
+        
+        policy = self.policy(dependency)
+        if self._aiohttp_session is None:
+            self._aiohttp_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.settings.pool_size,
+                    keepalive_timeout=self.settings.keepalive_seconds
+                )
+            )
+        options = {
+            "transport": AioHttpTransport(
+                session=self._aiohttp_session,
+                session_owner=False,
+                connection_timeout=policy.connect_timeout,
+                read_timeout=policy.read_timeout
+            ),
+            "retry_total": policy.max_retries
+        }
+        if dependency == "cosmos":
+            # Cosmos applies its own request timeout on top of the transport's
+            options["connection_timeout"] = policy.connect_timeout + policy.read_timeout
+        return options
+    
+    async def aclose(self):
+        for client in self._httpx_clients:
+            await client.aclose()
+        if self._aiohttp_session is not None:
+            await self._aiohttp_session.close()
+        self.close()
+
+_transport: Optional[Transport] = None
+_transport_lock = threading.Lock()
+
+def get_transport(config) -> Transport:
+    """Process-wide Transport built from Config, shared by every service"""
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = Transport(TransportSettings.from_config(config))
+        return _transport
+
+class LazyClient:
+    """Builds a client on first use and forwards attribute access to it.
+    
+    Some SDK clients talk to the network as soon as they are constructed
+    (CosmosClient reads the account's regions, MSAL discovers the
+    authority). Wrapped in a LazyClient they cost nothing at import or
+    worker start; the first request - or the warm-up in health.py - pays
+    for it instead. A failed construction is not remembered, so the next
+    use retries.
+    """
+    
+    def __init__(self, factory: Callable[[], Any], description: str):
+        self._factory = factory
+        self._description = description
+        self._client = None
+        self._lock = threading.Lock()
+    
+    @property
+    def created(self) -> bool:
+        return self._client is not None
+    
+    def get(self) -> Any:
+        client = self._client
+        if client is None:
+            with self._lock:
+                if self._client is None:
+                    started = time.perf_counter()
+                    self._client = self._factory()
+                    logger.info(f"Created {self._description} in {(time.perf_counter() - started) * 1000:.0f} ms")
+                client = self._client
+        return client
+    
+    def __getattr__(self, name: str) -> Any:
+        # Only reached for attributes the wrapper itself doesn't have
+        return getattr(self.get(), name)
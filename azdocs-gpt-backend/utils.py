@@ -1,21 +1,52 @@
 # utils.py - Utility functions
-from flask import request
+from flask import Response, g, jsonify, request
+from flask.json.provider import DefaultJSONProvider
 import datetime
-from typing import Optional, Dict, TYPE_CHECKING
+import functools
+import serialization
+from typing import Any, Optional, Dict, TYPE_CHECKING
 
 if TYPE_CHECKING:
     from services import AuthService
 
-def get_user_id_from_token(auth_service: 'AuthService') -> Optional[str]:
-    """Extract user ID from JWT token in Authorization header"""
+def get_token_claims(auth_service: 'AuthService') -> Optional[Dict]:
+    """Decode the JWT token in the Authorization header"""
     auth_header = request.headers.get('Authorization')
     if not auth_header or not auth_header.startswith('Bearer '):
         return None
     
-    token = auth_header.split(' ')[1]
-    decoded = auth_service.decode_jwt_token(token)
+    # Verified once per request; AuthService also caches claims across requests
+    if 'token_claims' not in g:
+        g.token_claims = auth_service.decode_jwt_token(auth_header.split(' ')[1])
+    return g.token_claims
+
+def get_user_id_from_token(auth_service: 'AuthService') -> Optional[str]:
+    """Extract user ID from JWT token in Authorization header"""
+    decoded = get_token_claims(auth_service)
     return decoded.get("sub") if decoded else None
 
+def is_admin(claims: Optional[Dict], admin_role: str) -> bool:
+    """Check whether the decoded token carries the admin app role"""
+    return bool(claims) and admin_role in claims.get("roles", [])
+
+def require_auth(auth_service: 'AuthService', role: Optional[str] = None):
+    """Route decorator that rejects requests without a valid bearer token (401) or without ``role`` (403).
+    
+    The caller's user ID is available to the view as ``g.user_id``.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            claims = get_token_claims(auth_service)
+            if not claims or not claims.get("sub"):
+                return jsonify({"error": "Unauthorized"}), 401
+            if role and not is_admin(claims, role):
+                return jsonify({"error": "Forbidden"}), 403
+            g.user_id = claims["sub"]
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
 def generate_chat_id() -> str:
     """Generate a unique chat ID"""
     return str(datetime.datetime.utcnow().timestamp())
@@ -25,6 +56,39 @@ def format_chat_response(chat_data: Dict) -> Dict:
     return {
         "title": chat_data["title"],
         "id": chat_data["id"],
-        "messages": chat_data["messages"],
+        "messages": [message.to_api() for message in chat_data["messages"]],
         "lastUpdated": chat_data["lastUpdated"]
-    }
\ No newline at end of file
+    }
+
+def not_modified(etag: str) -> Optional[Response]:
+    """A 304 response when the request's If-None-Match matches ``etag``, else None"""
+    matched = serialization.matching_etag(request.headers.get('If-None-Match'), etag)
+    if matched is None:
+        return None
+    response = Response(status=304)
+    response.headers['ETag'] = matched
+    response.headers['Cache-Control'] = serialization.REVALIDATE
+    return response
+
+def with_etag(response: Response, etag: str) -> Response:
+    """Tag a per-user response so the browser revalidates it with If-None-Match"""
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = serialization.REVALIDATE
+    return response
+
+def format_sse_event(event: str, data: Any) -> str:
+    """Format a Server-Sent Events message with a JSON payload"""
+    return f"event: {event}\ndata: {serialization.dumps(data).decode('utf-8')}\n\n"
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider (jsonify, request.get_json) backed by serialization, i.e. orjson when installed"""
+    
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return serialization.dumps(obj).decode("utf-8")
+    
+    def loads(self, s, **kwargs: Any) -> Any:
+        return serialization.loads(s)
+    
+    def response(self, *args: Any, **kwargs: Any) -> Response:
+        # The encoded bytes go straight into the body, without a str round trip
+        return self._app.response_class(serialization.dumps(self._prepare_response_obj(args, kwargs)), mimetype=self.mimetype)
\ No newline at end of file